@@ -1,23 +1,49 @@
 import os
 import json
+import argparse
 import requests
 from pathlib import Path
 from datetime import datetime
 import re
 import sys
+import time
+import hashlib
+import functools
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Assume call_mcp is in the same directory or accessible via PYTHONPATH
-from call_mcp import call_mcp
+import call_mcp as call_mcp_module
+from call_mcp import call_mcp, call_mcp_batch
+import http_transport
+import metrics
+import session_checkpoint
+from llm_cache import LLMResponseCache, LLM_CACHE_WORKFLOWS, make_cache_key
+from approval_policy import APPROVAL_POLICY_FILE, PolicyApproval, load_policy
+from model_router import MODEL_ROUTES_FILE, ModelRouter, load_routes
+from ollama_pool import OllamaPool
+from session_checkpoint import CHECKPOINTS_ENABLED, SessionCheckpoint
+import output_store
+import secrets_client
+from output_store import OUTPUT_STORE_ENABLED
+from log_writer import get_log_writer, close_log_writer
 
 # --- Configuration (Adjust as needed) ---
 PROJECT_ROOT = Path(__file__).parent.resolve()
 TEMPLATES_DIR = PROJECT_ROOT / "templates"
+AGENT_TEMPLATES_DIR = TEMPLATES_DIR / "agents"
 MCP_DEFINITIONS_DIR = TEMPLATES_DIR / "mcp_definitions"
 OUTPUT_DIR = PROJECT_ROOT / "output"
 LOG_DIR = PROJECT_ROOT / "log"
 LOG_FILE = LOG_DIR / "ai-rails.log"
 
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://10.0.0.2:11434")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://10.0.0.2:11434") # Comma-separated for several nodes (see ollama_pool.py)
+OLLAMA_MODEL = os.getenv("AI_RAILS_OLLAMA_MODEL", "qwen2.5-coder:32b")
+CLAUDE_MODEL = os.getenv("AI_RAILS_CLAUDE_MODEL", "claude-3-opus-20240229")
+CLAUDE_MAX_TOKENS = 4096 # Adjust as needed
 CLAUDE_API_KEY = os.getenv("ANTHROPIC_API_KEY") # Will be retrieved via SecretsMCP
 
 # List of sensitive secrets that require explicit human approval
@@ -39,9 +65,34 @@ SENSITIVE_SECRETS = [
 # Ensure log directory exists
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
+# Echo every logged event to the console (LOGGED [...] lines).
+LOG_ECHO = os.getenv("AI_RAILS_LOG_ECHO", "true").lower() == "true"
+
+# Optional per-session copy of the log for the current context (see session_log_file).
+_session_log_file = contextvars.ContextVar("ai_rails_session_log_file", default=None)
+
+
+@contextmanager
+def session_log_file(path: Path):
+    """Additionally writes every event logged inside the block to path (e.g. one log per batch job)."""
+    token = _session_log_file.set(Path(path))
+    try:
+        yield
+    finally:
+        _session_log_file.reset(token)
+        close_log_writer(path)
+
+
 # --- Logging Function ---
 def log_event(event_type: str, message: str, agent_role: str = "Orchestrator", session_id: str = "default", llm_model: str = "N/A", details: dict = None):
-    """Logs an event to the ai-rails.log file."""
+    """
+    Logs an event to the ai-rails.log file.
+    The entry is serialized here and handed to the background writer (see log_writer.py),
+    so the calling thread never blocks on file I/O.
+    Events logged without a session_id are attributed to the current metrics session.
+    """
+    if session_id == "default":
+        session_id = metrics.current_session()
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "session_id": session_id,
@@ -51,141 +102,549 @@ def log_event(event_type: str, message: str, agent_role: str = "Orchestrator", s
         "message": message,
         "details": details if details is not None else {}
     }
-    with open(LOG_FILE, "a") as f:
-        f.write(json.dumps(log_entry) + "\n")
-    print(f"LOGGED [{agent_role}/{event_type}]: {message}") # Also print to console for immediate feedback
+    line = json.dumps(log_entry, default=str)
+    get_log_writer(LOG_FILE).write(line)
+    session_log = _session_log_file.get()
+    if session_log is not None:
+        get_log_writer(session_log).write(line)
+    if LOG_ECHO:
+        print(f"LOGGED [{agent_role}/{event_type}]: {message}") # Also print to console for immediate feedback
+
+# --- MCP Definition Registry ---
+# How often (in seconds) the registry re-stats templates/mcp_definitions/ for changes.
+MCP_REGISTRY_POLL_INTERVAL = float(os.getenv("AI_RAILS_MCP_REGISTRY_POLL_INTERVAL", "2.0"))
+
+
+def _build_role_index(definitions: list) -> dict:
+    """Maps each agent role to {"tools": [...], "guidance": [(tool_name, text), ...]} of the definitions it may use."""
+    role_index = {}
+    for definition in definitions:
+        guidance = definition.get("agent_specific_guidance", {})
+        for role in definition.get("access_control", {}):
+            entry = role_index.setdefault(role, {"tools": [], "guidance": []})
+            # Only include tool_name, description, and request_schema
+            entry["tools"].append({k: v for k, v in definition.items() if k in ["tool_name", "description", "request_schema"]})
+            if role in guidance:
+                entry["guidance"].append((definition["tool_name"], guidance[role]))
+    return role_index
+
+
+class MCPDefinitionRegistry:
+    """
+    In-memory registry of MCP definitions.
+    Definitions are loaded once and re-read incrementally: only files whose mtime/size
+    changed are re-parsed (mtime polling, at most once per poll_interval). A per-role
+    index of allowed tools and agent_specific_guidance is rebuilt on change so prompt
+    building is a dictionary lookup.
+    """
+
+    def __init__(self, definitions_dir: Path, poll_interval: float = MCP_REGISTRY_POLL_INTERVAL):
+        self.definitions_dir = definitions_dir
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._files = {}        # filename -> {"stat": (mtime_ns, size), "tool_name": str | None}
+        self._definitions = {}  # tool_name -> definition
+        self._role_index = {}   # agent role -> {"tools": [...], "guidance": [(tool_name, text), ...]}
+        self._last_poll = None
+        self.fingerprint = ""
+
+    def refresh(self, force: bool = False) -> bool:
+        """Re-reads changed, added or removed definition files. Returns True if anything changed."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_poll is not None and now - self._last_poll < self.poll_interval:
+                return False
+            self._last_poll = now
+
+            current = {}
+            try:
+                for entry in os.scandir(self.definitions_dir):
+                    if entry.is_file() and entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                log_event("ERROR", f"MCP definitions directory not found: {self.definitions_dir}", agent_role="Orchestrator")
+
+            changed = False
+            for filename in set(self._files) - set(current):
+                tool_name = self._files.pop(filename)["tool_name"]
+                self._definitions.pop(tool_name, None)
+                changed = True
+
+            for filename, file_stat in current.items():
+                known = self._files.get(filename)
+                if known and known["stat"] == file_stat:
+                    continue
+                previous_tool_name = known["tool_name"] if known else None
+                try:
+                    with open(self.definitions_dir / filename, "r") as f:
+                        definition = json.load(f)
+                except json.JSONDecodeError as e:
+                    # Keep the last good version of this file (if any) until it parses again.
+                    log_event("ERROR", f"Failed to parse MCP definition {filename}: {e}", agent_role="Orchestrator")
+                    self._files[filename] = {"stat": file_stat, "tool_name": previous_tool_name}
+                    continue
+                except FileNotFoundError:
+                    log_event("ERROR", f"MCP definition file not found: {filename}", agent_role="Orchestrator")
+                    continue
+
+                tool_name = definition.get("tool_name")
+                if previous_tool_name and previous_tool_name != tool_name:
+                    self._definitions.pop(previous_tool_name, None)
+                self._definitions[tool_name] = definition
+                self._files[filename] = {"stat": file_stat, "tool_name": tool_name}
+                changed = True
+
+            if changed:
+                self._rebuild_index()
+            return changed
+
+    def _rebuild_index(self):
+        """Rebuilds the per-role tool index and the content fingerprint (lock held)."""
+        ordered = [self._definitions.get(self._files[filename]["tool_name"]) for filename in sorted(self._files)]
+        self._role_index = _build_role_index([definition for definition in ordered if definition is not None])
+
+        serialized = json.dumps(self._definitions, sort_keys=True, separators=(",", ":"))
+        self.fingerprint = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get_definitions(self) -> dict:
+        """Returns a snapshot of all definitions, keyed by tool_name."""
+        self.refresh()
+        with self._lock:
+            return dict(self._definitions)
+
+    def get_definition(self, tool_name: str):
+        """Returns a single definition, or None if the tool is unknown."""
+        self.refresh()
+        with self._lock:
+            return self._definitions.get(tool_name)
+
+    def tools_for_role(self, agent_role: str) -> dict:
+        """Returns {"tools": [...], "guidance": [(tool_name, text), ...]} for an agent role."""
+        self.refresh()
+        with self._lock:
+            return self._role_index.get(agent_role, {"tools": [], "guidance": []})
+
+
+class StaticMCPDefinitions:
+    """
+    Read-only registry over a fixed {tool_name: definition} dict, for callers that still
+    pass build_agent_prompt the dict returned by load_mcp_definitions().
+    """
+
+    def __init__(self, definitions: dict):
+        self._role_index = _build_role_index([definitions[tool_name] for tool_name in sorted(definitions)])
+        serialized = json.dumps(definitions, sort_keys=True, separators=(",", ":"))
+        self.fingerprint = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def tools_for_role(self, agent_role: str) -> dict:
+        return self._role_index.get(agent_role, {"tools": [], "guidance": []})
+
+
+@functools.lru_cache(maxsize=16)
+def _static_definitions(serialized: str) -> StaticMCPDefinitions:
+    """One StaticMCPDefinitions per distinct dict, so compiled prompts built from it stay cached."""
+    return StaticMCPDefinitions(json.loads(serialized))
+
+
+MCP_REGISTRY = MCPDefinitionRegistry(MCP_DEFINITIONS_DIR)
+
+# call_mcp reads per-tool "caching" policies from the same registry
+call_mcp_module.set_definition_lookup(MCP_REGISTRY.get_definition)
+
 
 # --- Load MCP Definitions ---
 def load_mcp_definitions() -> dict:
-    """Loads all MCP definitions from the mcp_definitions directory."""
-    mcp_defs = {}
-    for mcp_file in MCP_DEFINITIONS_DIR.glob("*.json"):
-        try:
-            with open(mcp_file, "r") as f:
-                definition = json.load(f)
-                mcp_defs[definition.get("tool_name")] = definition
-        except json.JSONDecodeError as e:
-            log_event("ERROR", f"Failed to parse MCP definition {mcp_file.name}: {e}", agent_role="Orchestrator")
-        except FileNotFoundError:
-            log_event("ERROR", f"MCP definition file not found: {mcp_file.name}", agent_role="Orchestrator")
-    return mcp_defs
+    """Returns all MCP definitions from the mcp_definitions directory (via MCP_REGISTRY)."""
+    return MCP_REGISTRY.get_definitions()
 
 # --- Dynamic Prompt Builder ---
-def build_agent_prompt(agent_template_path: Path, tool_definitions: dict, additional_context: str = "") -> str:
+# Marker blocks in common_agent_components.md that are replaced at compile time.
+TOOL_DEFINITIONS_PLACEHOLDER = (
+    "--- TOOL_DEFINITIONS_START ---\n"
+    "// This section will be dynamically injected by ai_rails_backend.py\n"
+    "// Do NOT modify or remove the '--- TOOL_DEFINITIONS_START ---' and '--- TOOL_DEFINITIONS_END ---' markers.\n"
+    "--- TOOL_DEFINITIONS_END ---"
+)
+TOOL_SPECIFIC_GUIDANCE_PLACEHOLDER = (
+    "--- TOOL_SPECIFIC_GUIDANCE_START ---\n"
+    "// This section will be dynamically injected by ai_rails_backend.py with\n"
+    "// agent_specific_guidance from the MCP definitions that you have access to.\n"
+    "// DO NOT EDIT THIS SECTION MANUALLY.\n"
+    "--- TOOL_SPECIFIC_GUIDANCE_END ---"
+)
+
+# Maps template filename slugs to the 'agent_role' names used in MCP access_control.
+AGENT_ROLE_MAP = {
+    "planning": "Planning Agent",
+    "coder": "Coder Agent",
+    "unit_tester": "Unit Tester Agent",
+    "debugger": "Debugger Agent",
+    "documentation": "Documentation Agent",
+    "code_review": "Code Review Agent",
+    "refactor": "Refactor Agent",
+    "n8n_flow_creator": "n8n Flow Creator Agent",
+    "overseer": "Overseer Agent"
+}
+
+# Compiled static system prompts, keyed on (template path, agent role).
+# Each entry keeps the fingerprint of the inputs it was built from, so editing a
+# template or an MCP definition invalidates it without restarting the process.
+_COMPILED_PROMPT_CACHE = {}
+
+
+def _agent_role_from_template(agent_template_path: Path) -> str:
+    """Determines the agent's role from its template filename."""
+    agent_role_slug = agent_template_path.stem.replace('_agent_system_prompt', '').replace('_system_prompt', '')
+    return AGENT_ROLE_MAP.get(agent_role_slug, agent_role_slug.replace('_', ' ').title() + " Agent") # Default fallback
+
+
+def _file_fingerprint(path: Path):
+    """Returns (mtime_ns, size) for a file, or None if it does not exist."""
+    try:
+        stat = path.stat()
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def compile_agent_prompt(agent_template_path: Path, mcp_registry: MCPDefinitionRegistry = None) -> str:
     """
-    Reads an agent's system prompt template and dynamically injects tool definitions and common components.
+    Builds the static system prompt for an agent (template + common components + tools).
+    The result is cached per process and rebuilt only when the template, the common
+    components file or the MCP definitions change.
+    Raises FileNotFoundError if the agent template does not exist.
     """
+    mcp_registry = mcp_registry or MCP_REGISTRY
+    common_components_path = AGENT_TEMPLATES_DIR / "common_agent_components.md"
+    current_agent_role = _agent_role_from_template(agent_template_path)
+    role_tools = mcp_registry.tools_for_role(current_agent_role)
+
+    cache_key = (str(agent_template_path), current_agent_role)
+    fingerprint = (
+        _file_fingerprint(agent_template_path),
+        _file_fingerprint(common_components_path),
+        id(mcp_registry),
+        mcp_registry.fingerprint,
+    )
+    cached = _COMPILED_PROMPT_CACHE.get(cache_key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    with open(agent_template_path, "r") as f:
+        template_content = f.read()
+
+    # Read common agent components
+    common_components_content = ""
     try:
-        with open(agent_template_path, "r") as f:
-            template_content = f.read()
+        with open(common_components_path, "r") as f:
+            common_components_content = f.read()
+    except FileNotFoundError:
+        log_event("ERROR", f"Common agent components file not found: {common_components_path}", agent_role="Orchestrator")
+        # Continue without common components, but log the error
 
-        # Read common agent components
-        common_components_path = TEMPLATES_DIR / "agent" / "common_agent_components.md"
-        common_components_content = ""
-        try:
-            with open(common_components_path, "r") as f:
-                common_components_content = f.read()
-        except FileNotFoundError:
-            log_event("ERROR", f"Common agent components file not found: {common_components_path}", agent_role="Orchestrator")
-            # Continue without common components, but log the error
-
-
-        tool_json_str = ""
-        tool_specific_guidance_str = ""
-        # Determine the agent's role from the template filename for filtering guidance
-        agent_role_slug = agent_template_path.stem.replace('_agent_system_prompt', '').replace('_system_prompt', '')
-        # Convert slug to a more readable format if needed for comparison with 'agent_role' in MCP JSON
-        agent_role_map = {
-            "planning": "Planning Agent",
-            "coder": "Coder Agent",
-            "unit_tester": "Unit Tester Agent",
-            "debugger": "Debugger Agent",
-            "documentation": "Documentation Agent",
-            "code_review": "Code Review Agent",
-            "refactor": "Refactor Agent",
-            "n8n_flow_creator": "n8n Flow Creator Agent",
-            "overseer": "Overseer Agent"
-        }
-        current_agent_role = agent_role_map.get(agent_role_slug, agent_role_slug.replace('_', ' ').title() + " Agent") # Default fallback
-
-
-        if tool_definitions:
-            tool_list = []
-            for name, definition in tool_definitions.items():
-                # Check access_control for the current agent's role
-                if current_agent_role in definition.get("access_control", {}):
-                    # Only include tool_name, description, and request_schema
-                    tool_info = {k: v for k, v in definition.items() if k in ["tool_name", "description", "request_schema"]}
-                    tool_list.append(tool_info)
-                    
-                    # Also collect agent_specific_guidance for this tool, if it exists for this agent's role
-                    if "agent_specific_guidance" in definition and current_agent_role in definition["agent_specific_guidance"]:
-                        tool_specific_guidance_str += f"\n### Guidance for {definition['tool_name']}:\n"
-                        tool_specific_guidance_str += definition["agent_specific_guidance"][current_agent_role] + "\n"
-
-            tool_json_str = json.dumps(tool_list, indent=2)
-
-        # First, inject common components
-        full_prompt = template_content.replace(
-            "--- COMMON_AGENT_COMPONENTS_PLACEHOLDER ---",
-            common_components_content
-        )
+    # Tools and guidance come pre-filtered by access_control from the registry's role index
+    tool_json_str = json.dumps(role_tools["tools"], indent=2) if role_tools["tools"] else ""
+    tool_specific_guidance_str = ""
+    for tool_name, guidance in role_tools["guidance"]:
+        tool_specific_guidance_str += f"\n### Guidance for {tool_name}:\n"
+        tool_specific_guidance_str += guidance + "\n"
 
-        # Then, replace the placeholder for tool definitions within the common components
-        # We need to use re.escape here because the placeholder contains special regex characters
-        full_prompt = re.sub(
-            r"--- TOOL_DEFINITIONS_START ---\n// This section will be dynamically injected by ai_rails_backend.py\n// Do NOT modify or remove the '--- TOOL_DEFINITIONS_START ---' and '--- TOOL_DEFINITIONS_END ---' markers.\n--- TOOL_DEFINITIONS_END ---",
-            f"--- TOOL_DEFINITIONS_START ---\n{tool_json_str}\n--- TOOL_DEFINITIONS_END ---",
-            full_prompt,
-            flags=re.DOTALL # Ensure . matches newlines
-        )
-        
-        # Finally, replace the placeholder for tool-specific guidance within the common components
-        full_prompt = re.sub(
-            r"--- TOOL_SPECIFIC_GUIDANCE_START ---\n// This section will be dynamically injected by ai_rails_backend.py with\n// agent_specific_guidance from the MCP definitions that you have access to.\n// DO NOT EDIT THIS SECTION MANUALLY.\n--- TOOL_SPECIFIC_GUIDANCE_END ---",
-            f"--- TOOL_SPECIFIC_GUIDANCE_START ---\n{tool_specific_guidance_str}\n--- TOOL_SPECIFIC_GUIDANCE_END ---",
-            full_prompt,
-            flags=re.DOTALL # Ensure . matches newlines
-        )
+    # First, inject common components
+    full_prompt = template_content.replace(
+        "--- COMMON_AGENT_COMPONENTS_PLACEHOLDER ---",
+        common_components_content
+    )
+
+    # Then, replace the placeholders for tool definitions and tool-specific guidance
+    # within the common components. Plain string replacement keeps backslashes in the
+    # tool JSON intact (re.sub would interpret them as escapes).
+    full_prompt = full_prompt.replace(
+        TOOL_DEFINITIONS_PLACEHOLDER,
+        f"--- TOOL_DEFINITIONS_START ---\n{tool_json_str}\n--- TOOL_DEFINITIONS_END ---"
+    )
+    full_prompt = full_prompt.replace(
+        TOOL_SPECIFIC_GUIDANCE_PLACEHOLDER,
+        f"--- TOOL_SPECIFIC_GUIDANCE_START ---\n{tool_specific_guidance_str}\n--- TOOL_SPECIFIC_GUIDANCE_END ---"
+    )
 
-        # Append any additional context at the end
-        if additional_context:
-            full_prompt += f"\n\n--- ADDITIONAL CONTEXT ---\n{additional_context}\n--------------------------"
+    _COMPILED_PROMPT_CACHE[cache_key] = (fingerprint, full_prompt)
+    log_event("PROMPT_COMPILED", f"Compiled system prompt for {current_agent_role}.", agent_role="Orchestrator", details={"template": agent_template_path.name, "prompt_length": len(full_prompt)})
+    return full_prompt
 
-        return full_prompt
+
+def build_agent_prompt(agent_template_path: Path, tool_definitions=None, additional_context: str = "") -> str:
+    """
+    Returns the agent's compiled system prompt with the per-turn context appended.
+    Only the additional context is rebuilt on each call; see compile_agent_prompt.
+    tool_definitions is an MCPDefinitionRegistry (default MCP_REGISTRY) or, as before the
+    registry existed, a {tool_name: definition} dict such as load_mcp_definitions() returns.
+    """
+    if isinstance(tool_definitions, dict):
+        mcp_registry = _static_definitions(json.dumps(tool_definitions, sort_keys=True, separators=(",", ":")))
+    else:
+        mcp_registry = tool_definitions
+    try:
+        with metrics.span("prompt_build", agent_role=_agent_role_from_template(agent_template_path)):
+            full_prompt = compile_agent_prompt(agent_template_path, mcp_registry)
     except FileNotFoundError:
         log_event("ERROR", f"Agent template not found: {agent_template_path}", agent_role="Orchestrator")
         return ""
 
+    # Append any additional context at the end
+    if additional_context:
+        full_prompt += f"\n\n--- ADDITIONAL CONTEXT ---\n{additional_context}\n--------------------------"
+
+    return full_prompt
+
 # --- LLM Interaction Functions ---
-def call_ollama(prompt: str, model: str = "qwen2.5-coder:32b") -> str:
-    """Calls the local Ollama LLM."""
-    url = f"{OLLAMA_BASE_URL}/api/generate"
+# Streaming writes tokens to the agent's output file as they arrive and lets the
+# orchestrator stop generation once a complete tool_request block has been emitted.
+STREAM_RESPONSES = os.getenv("AI_RAILS_STREAM_RESPONSES", "true").lower() == "true"
+STOP_ON_TOOL_REQUEST = os.getenv("AI_RAILS_STOP_ON_TOOL_REQUEST", "true").lower() == "true"
+
+ANTHROPIC_API_URL = os.getenv("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")
+
+# Send the compiled agent prompt as a system block marked with cache_control so Anthropic
+# caches it across turns (cache reads are cheaper and faster than full input tokens).
+CLAUDE_PROMPT_CACHING = os.getenv("AI_RAILS_CLAUDE_PROMPT_CACHING", "true").lower() == "true"
+
+# Token counters reported in the Messages API 'usage' field that are logged per call.
+CLAUDE_USAGE_FIELDS = ["input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"]
+
+# Seconds to wait for an LLM backend to accept the connection, and then for each response
+# chunk (the whole response when not streaming). A stalled host fails after LLM_TIMEOUT
+# and the model router fails over to the next target (see model_router.py).
+LLM_CONNECT_TIMEOUT = float(os.getenv("AI_RAILS_LLM_CONNECT_TIMEOUT", "10"))
+LLM_TIMEOUT = float(os.getenv("AI_RAILS_LLM_TIMEOUT", "300"))
+
+TOOL_REQUEST_BLOCK_PATTERN = re.compile(r"```json\s*(.*?)\s*```", re.DOTALL)
+
+
+class ToolRequestDetector:
+    """
+    Incrementally scans streamed text for closed ```json blocks containing tool_requests.
+    Only the unscanned tail of the text is searched on each feed() call.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._scan_from = 0
+        self.tool_requests = []
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Appends a chunk and returns True once at least one tool_request block has closed
+        and the model has moved on to something other than another ```json block.
+        """
+        self.text += chunk
+        while True:
+            match = TOOL_REQUEST_BLOCK_PATTERN.search(self.text, self._scan_from)
+            if not match:
+                break
+            self._scan_from = match.end()
+            try:
+                candidate = json.loads(match.group(1))
+            except json.JSONDecodeError:
+                continue
+            if isinstance(candidate, dict) and candidate.get("type") == "tool_request":
+                self.tool_requests.append(candidate)
+
+        # Resume at the last unclosed fence, if any
+        open_fence = self.text.find("```json", self._scan_from)
+        if open_fence != -1:
+            self._scan_from = open_fence
+            return False
+        if not self.tool_requests:
+            return False
+        # Agents may emit several tool_request blocks back to back; keep streaming while the
+        # text after the last block could still be the start of another one.
+        tail = self.text[self._scan_from:].lstrip()
+        return bool(tail) and not "```json".startswith(tail)
+
+
+def _emit_stream_chunk(text: str, output_file, detector: ToolRequestDetector) -> bool:
+    """Writes a streamed chunk to the output file and returns True if generation can stop."""
+    if output_file:
+        output_file.write(text)
+        output_file.flush()
+    return detector.feed(text) and STOP_ON_TOOL_REQUEST
+
+
+# How long Ollama keeps the model (and its KV cache) loaded between turns. Follow-up turns
+# of a conversation share the system prompt and history as a prefix, so while the model
+# stays loaded Ollama only prefills the newly appended messages.
+OLLAMA_KEEP_ALIVE = os.getenv("AI_RAILS_OLLAMA_KEEP_ALIVE", "30m")
+
+# Optional context window override (0 = model default). Set it large enough for long
+# sessions: once the context overflows, Ollama shifts it and the cached prefix is lost.
+OLLAMA_NUM_CTX = int(os.getenv("AI_RAILS_OLLAMA_NUM_CTX", "0"))
+
+
+OLLAMA_POOL = OllamaPool.from_env(OLLAMA_BASE_URL, log_event=log_event)
+
+
+class OllamaSession:
+    """
+    Per-engagement Ollama prefill accounting.
+    Ollama reports prompt_eval_count/prompt_eval_duration for the tokens it actually had to
+    prefill; tokens served from the KV cache are not counted. The first full prefill gives
+    a chars-per-token and ms-per-token baseline, from which the prefill time saved on later
+    turns is estimated.
+    """
+
+    def __init__(self):
+        self.turns = []
+        self._chars_per_token = None
+        self._ms_per_token = None
+
+    def record(self, prompt_chars: int, result: dict) -> dict:
+        """Records the stats from Ollama's final response chunk for one turn."""
+        evaluated = result.get("prompt_eval_count", 0) or 0
+        duration_ms = (result.get("prompt_eval_duration", 0) or 0) / 1e6
+        turn = {"prompt_chars": prompt_chars, "prompt_eval_count": evaluated, "prompt_eval_ms": round(duration_ms, 1),
+                "estimated_prompt_tokens": evaluated, "estimated_saved_ms": 0.0}
+        if self._chars_per_token is None:
+            if evaluated:
+                self._chars_per_token = prompt_chars / evaluated
+                self._ms_per_token = duration_ms / evaluated
+        else:
+            expected = int(prompt_chars / self._chars_per_token)
+            saved_tokens = max(0, expected - evaluated)
+            turn["estimated_prompt_tokens"] = expected
+            turn["estimated_saved_ms"] = round(saved_tokens * self._ms_per_token, 1)
+        self.turns.append(turn)
+        return turn
+
+    def summary(self) -> dict:
+        return {
+            "turns": len(self.turns),
+            "prompt_eval_count": sum(t["prompt_eval_count"] for t in self.turns),
+            "prompt_eval_ms": round(sum(t["prompt_eval_ms"] for t in self.turns), 1),
+            "estimated_saved_ms": round(sum(t["estimated_saved_ms"] for t in self.turns), 1),
+        }
+
+
+def call_ollama_chat(messages: list, system_prompt: str = "", model: str = OLLAMA_MODEL, stream: bool = False, output_file=None, ollama_session: OllamaSession = None, timeout: float = None) -> str:
+    """
+    Calls the local Ollama LLM with a multi-turn conversation (/api/chat).
+    With stream=True, tokens are written to output_file as they arrive and generation is
+    cut short once a complete tool_request block has closed.
+    If an OllamaSession is given, the turn's prefill stats are recorded on it.
+    The request goes to a node picked by OLLAMA_POOL; if a node cannot be reached before
+    anything was streamed, the request is retried on the next node.
+    """
     headers = {"Content-Type": "application/json"}
+    chat_messages = ([{"role": "system", "content": system_prompt}] if system_prompt else []) + messages
     data = {
         "model": model,
-        "prompt": prompt,
-        "stream": False # We want the full response at once
+        "messages": chat_messages,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
-    log_event("LLM_CALL", f"Calling Ollama model: {model}", llm_model=model, details={"prompt_length": len(prompt)})
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=300) # 5 min timeout
+    if OLLAMA_NUM_CTX:
+        data["options"] = {"num_ctx": OLLAMA_NUM_CTX}
+    prompt_length = sum(len(m["content"]) for m in chat_messages)
+    tried_nodes = []
+    while True:
+        node = OLLAMA_POOL.acquire(model, metrics.current_session(), exclude=tuple(tried_nodes))
+        tried_nodes.append(node.url)
+        log_event("LLM_CALL", f"Calling Ollama model: {model}", llm_model=model, details={"prompt_length": prompt_length, "messages": len(chat_messages), "stream": stream, "node": node.url})
+        llm_span = metrics.span("llm_call", backend="ollama", model=model, node=node.url, status="ok")
+        streamed_from = output_file.tell() if hasattr(output_file, "tell") else 0
+        started = time.perf_counter()
+        try:
+            with llm_span:
+                result = _call_ollama_chat(f"{node.url}/api/chat", headers, data, model, prompt_length, stream, output_file, ollama_session, llm_span, (LLM_CONNECT_TIMEOUT, timeout or LLM_TIMEOUT))
+            OLLAMA_POOL.release(node, time.perf_counter() - started)
+            return result
+        except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+            unreachable = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            OLLAMA_POOL.release(node, time.perf_counter() - started, ok=False, connection_failed=unreachable)
+            streamed = hasattr(output_file, "tell") and output_file.tell() > streamed_from
+            if isinstance(e, requests.exceptions.ConnectionError) and not streamed and len(tried_nodes) < len(OLLAMA_POOL.nodes):
+                log_event("LLM_NODE_RETRY", f"Ollama node {node.url} unreachable; retrying on another node.", llm_model=model, details={"node": node.url, "error": str(e)})
+                continue
+            log_event("LLM_ERROR", f"Ollama call failed: {e}", llm_model=model, details={"duration_ms": llm_span.elapsed_ms, "node": node.url})
+            print(f"Error calling Ollama: {e}")
+            return f"Error: Could not communicate with Ollama. {e}"
+        except BaseException:
+            # e.g. a hedged call abandoned by the model router
+            OLLAMA_POOL.release(node, time.perf_counter() - started, ok=False)
+            raise
+
+def _call_ollama_chat(url: str, headers: dict, data: dict, model: str, prompt_length: int, stream: bool, output_file, ollama_session: OllamaSession, llm_span, timeout: tuple) -> str:
+    """The request/response part of call_ollama_chat, run inside its timing span."""
+    if not stream:
+        # With several nodes, a node that cannot be reached is skipped rather than retried
+        response = http_transport.post(url, retry=len(OLLAMA_POOL.nodes) == 1, headers=headers, json=data, timeout=timeout)
         response.raise_for_status()
         result = response.json()
-        log_event("LLM_RESPONSE", f"Received response from Ollama: {result.get('done', False)}", llm_model=model, details={"response_length": len(result.get('response', ''))})
-        return result.get("response", "")
-    except requests.exceptions.RequestException as e:
-        log_event("LLM_ERROR", f"Ollama call failed: {e}", llm_model=model)
-        print(f"Error calling Ollama: {e}")
-        return f"Error: Could not communicate with Ollama. {e}"
-
-def call_claude(prompt: str, model: str = "claude-3-opus-20240229") -> str:
-    """Calls the Anthropic Claude API."""
+        content = result.get("message", {}).get("content", "")
+        log_event("LLM_RESPONSE", f"Received response from Ollama: {result.get('done', False)}", llm_model=model, details={"response_length": len(content), "duration_ms": llm_span.elapsed_ms, **_ollama_prefill_details(prompt_length, result, ollama_session), **_ollama_eval_details(model, result)})
+        return content
+
+    detector = ToolRequestDetector()
+    stopped_early = False
+    done = False
+    final_chunk = {}
+    with http_transport.post(url, retry=len(OLLAMA_POOL.nodes) == 1, headers=headers, json=data, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise requests.exceptions.RequestException(chunk["error"])
+            if _emit_stream_chunk(chunk.get("message", {}).get("content", ""), output_file, detector):
+                # Closing the connection makes Ollama abort the remaining generation
+                stopped_early = True
+                break
+            if chunk.get("done"):
+                done = True
+                final_chunk = chunk
+                break
+    # Prefill and eval stats are only reported in the final chunk, i.e. not when generation was stopped early
+    log_event("LLM_RESPONSE", f"Received streamed response from Ollama: {done}", llm_model=model, details={"response_length": len(detector.text), "stopped_early": stopped_early, "duration_ms": llm_span.elapsed_ms, **_ollama_prefill_details(prompt_length, final_chunk, ollama_session), **_ollama_eval_details(model, final_chunk)})
+    return detector.text
+
+def _ollama_prefill_details(prompt_length: int, result: dict, ollama_session: OllamaSession = None) -> dict:
+    """Extracts prefill stats from Ollama's final response for logging (and records them on the session)."""
+    if "prompt_eval_duration" not in result:
+        return {}
+    if ollama_session is not None:
+        return ollama_session.record(prompt_length, result)
+    return {"prompt_eval_count": result.get("prompt_eval_count", 0), "prompt_eval_ms": round(result["prompt_eval_duration"] / 1e6, 1)}
+
+def _ollama_eval_details(model: str, result: dict) -> dict:
+    """Records Ollama's prompt-eval and generation timings as metrics and returns tokens/sec for logging."""
+    labels = {"backend": "ollama", "model": model}
+    if result.get("prompt_eval_duration"):
+        metrics.METRICS.observe("llm_prompt_eval", result["prompt_eval_duration"] / 1e9, labels)
+        metrics.METRICS.inc("llm_prompt_tokens", result.get("prompt_eval_count", 0) or 0, labels)
+    eval_count = result.get("eval_count", 0) or 0
+    eval_duration = result.get("eval_duration", 0) or 0
+    if not eval_duration:
+        return {}
+    metrics.METRICS.observe("llm_eval", eval_duration / 1e9, labels)
+    metrics.METRICS.inc("llm_eval_tokens", eval_count, labels)
+    return {"eval_count": eval_count, "eval_ms": round(eval_duration / 1e6, 1), "tokens_per_second": round(eval_count / (eval_duration / 1e9), 1)}
+
+def call_ollama(prompt: str, model: str = OLLAMA_MODEL, stream: bool = False, output_file=None) -> str:
+    """Calls the local Ollama LLM with a single prompt."""
+    return call_ollama_chat([{"role": "user", "content": prompt}], model=model, stream=stream, output_file=output_file)
+
+def call_claude_chat(messages: list, system_prompt: str = "", model: str = CLAUDE_MODEL, stream: bool = False, output_file=None, timeout: float = None) -> str:
+    """
+    Calls the Anthropic Claude API with a multi-turn conversation.
+    With stream=True, text deltas are written to output_file as they arrive and the
+    stream is closed once a complete tool_request block has closed.
+    """
     if not CLAUDE_API_KEY:
         log_event("LLM_ERROR", "Claude API Key not set. Cannot call Claude.", llm_model=model)
         return "Error: Claude API Key is not configured."
 
-    url = "https://api.anthropic.com/v1/messages"
+    url = ANTHROPIC_API_URL
     headers = {
         "x-api-key": CLAUDE_API_KEY,
         "anthropic-version": "2023-06-01",
@@ -193,82 +652,256 @@ def call_claude(prompt: str, model: str = "claude-3-opus-20240229") -> str:
     }
     data = {
         "model": model,
-        "max_tokens": 4096, # Adjust as needed
-        "messages": [{"role": "user", "content": prompt}]
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "messages": messages
     }
-    log_event("LLM_CALL", f"Calling Claude model: {model}", llm_model=model, details={"prompt_length": len(prompt)})
+    if system_prompt:
+        if CLAUDE_PROMPT_CACHING:
+            data["system"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        else:
+            data["system"] = system_prompt
+    if stream:
+        data["stream"] = True
+    prompt_length = len(system_prompt) + sum(len(m["content"]) for m in messages)
+    log_event("LLM_CALL", f"Calling Claude model: {model}", llm_model=model, details={"prompt_length": prompt_length, "messages": len(messages), "stream": stream})
+    llm_span = metrics.span("llm_call", backend="claude", model=model, status="ok")
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=300) # 5 min timeout
+        with llm_span:
+            return _call_claude_chat(url, headers, data, model, stream, output_file, llm_span, (LLM_CONNECT_TIMEOUT, timeout or LLM_TIMEOUT))
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        log_event("LLM_ERROR", f"Claude call failed: {e}", llm_model=model, details={"duration_ms": llm_span.elapsed_ms})
+        print(f"Error calling Claude: {e}")
+        return f"Error: Could not communicate with Claude API. {e}"
+
+def _call_claude_chat(url: str, headers: dict, data: dict, model: str, stream: bool, output_file, llm_span, timeout: tuple) -> str:
+    """The request/response part of call_claude_chat, run inside its timing span."""
+    if not stream:
+        response = http_transport.post(url, retry=True, headers=headers, json=data, timeout=timeout)
         response.raise_for_status()
         result = response.json()
-        log_event("LLM_RESPONSE", f"Received response from Claude: {result.get('id', 'N/A')}", llm_model=model, details={"response_length": len(result.get('content', [{}])[0].get('text', ''))})
+        log_event("LLM_RESPONSE", f"Received response from Claude: {result.get('id', 'N/A')}", llm_model=model, details={"response_length": len(result.get('content', [{}])[0].get('text', '')), "duration_ms": llm_span.elapsed_ms, **_claude_usage_details(model, result.get("usage", {}))})
         return result.get("content", [{}])[0].get("text", "")
-    except requests.exceptions.RequestException as e:
-        log_event("LLM_ERROR", f"Claude call failed: {e}", llm_model=model)
-        print(f"Error calling Claude: {e}")
-        return f"Error: Could not communicate with Claude API. {e}"
 
-# --- Agent Orchestration Function ---
-def engage_agent(
-    agent_role: str,
-    agent_template_filename: str,
-    user_input_content: str,
-    project_output_path: Path,
-    session_id: str,
-    llm_choice: str = "ollama",
-    previous_tool_output: str = "" # New parameter for tool output feedback
-):
+    detector = ToolRequestDetector()
+    stopped_early = False
+    message_id = "N/A"
+    usage = {}
+    with http_transport.post(url, retry=True, headers=headers, json=data, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        # Server-sent events: only the 'data:' lines carry the JSON payloads
+        for raw_line in response.iter_lines():
+            line = raw_line.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[len("data:"):].strip())
+            event_type = event.get("type")
+            if event_type == "message_start":
+                message_id = event.get("message", {}).get("id", "N/A")
+                usage.update(event.get("message", {}).get("usage", {}))
+            elif event_type == "message_delta":
+                usage.update(event.get("usage", {}))
+            elif event_type == "content_block_delta" and event.get("delta", {}).get("type") == "text_delta":
+                if _emit_stream_chunk(event["delta"].get("text", ""), output_file, detector):
+                    stopped_early = True
+                    break
+            elif event_type == "error":
+                raise requests.exceptions.RequestException(event.get("error", {}).get("message", "stream error"))
+            elif event_type == "message_stop":
+                break
+    log_event("LLM_RESPONSE", f"Received streamed response from Claude: {message_id}", llm_model=model, details={"response_length": len(detector.text), "stopped_early": stopped_early, "duration_ms": llm_span.elapsed_ms, **_claude_usage_details(model, usage)})
+    return detector.text
+
+def _claude_usage_details(model: str, usage: dict) -> dict:
     """
-    Engages a specific AI agent with a prompt and handles its output,
-    including tool request detection and human gating.
+    Picks the token counters (including prompt cache reads/creations) out of a Messages API
+    usage field, and records the input/output token counts as metrics.
     """
-    log_event("AGENT_ENGAGE", f"Engaging {agent_role} agent.", agent_role=agent_role, session_id=session_id)
+    labels = {"backend": "claude", "model": model}
+    if usage.get("input_tokens"):
+        metrics.METRICS.inc("llm_prompt_tokens", usage["input_tokens"], labels)
+    if usage.get("output_tokens"):
+        metrics.METRICS.inc("llm_eval_tokens", usage["output_tokens"], labels)
+    return {field: usage[field] for field in CLAUDE_USAGE_FIELDS if usage.get(field) is not None}
 
-    agent_template_path = TEMPLATES_DIR / "agent" / agent_template_filename
-    
-    # Load all MCP definitions to inject into the agent's prompt
-    all_mcp_definitions = load_mcp_definitions()
+def call_claude(prompt: str, model: str = CLAUDE_MODEL, stream: bool = False, output_file=None) -> str:
+    """Calls the Anthropic Claude API with a single prompt."""
+    return call_claude_chat([{"role": "user", "content": prompt}], model=model, stream=stream, output_file=output_file)
 
-    # Add previous tool output as additional context
-    context_for_agent = user_input_content
-    if previous_tool_output:
-        context_for_agent += f"\n\n--- PREVIOUS TOOL OUTPUT ---\n{previous_tool_output}\n--------------------------"
-        log_event("CONTEXT_INJECTED", "Previous tool output injected into agent prompt.", agent_role=agent_role, session_id=session_id)
+# --- Agent Orchestration Function ---
+# Maximum number of LLM turns (initial turn + re-engagements after tool results) per engagement.
+AGENT_MAX_TURNS = int(os.getenv("AI_RAILS_AGENT_MAX_TURNS", "20"))
 
-    full_prompt = build_agent_prompt(
-        agent_template_path,
-        all_mcp_definitions,
-        additional_context=context_for_agent
-    )
+# Maximum number of conversation messages sent on each turn, in addition to the original
+# task message. 0 disables windowing and sends the full history.
+AGENT_HISTORY_WINDOW = int(os.getenv("AI_RAILS_AGENT_HISTORY_WINDOW", "16"))
 
-    if not full_prompt:
-        print("Failed to build agent prompt. Exiting agent engagement.")
-        return
 
-    print(f"\n--- Sending prompt to {agent_role} ({llm_choice}) ---")
-    # print(f"DEBUG: Full Prompt Content:\n{full_prompt[:500]}...") # Print first 500 chars for debug
+def _window_messages(messages: list, window: int = None) -> list:
+    """
+    Trims a conversation to the original task message plus at most `window` later messages.
+    Messages are dropped from the middle, right after the pinned task message, in blocks of
+    half a window: the kept prefix then stays identical for several turns, so Ollama can keep
+    reusing its KV cache for it (sliding the window by one turn would change it every turn).
+    The kept part always starts with an assistant message so user/assistant turns alternate.
+    """
+    window = AGENT_HISTORY_WINDOW if window is None else window
+    if window <= 0 or len(messages) <= window + 1:
+        return messages
+    step = max(2, window // 2 // 2 * 2)  # Even, so the cut stays on a turn boundary
+    overflow = len(messages) - 1 - window
+    dropped = -(-overflow // step) * step
+    if messages[1 + dropped]["role"] == "user":
+        dropped += 1
+    return [messages[0]] + messages[1 + dropped:]
+
 
-    agent_response = ""
+def _llm_cache_key(llm_choice: str, system_prompt: str, messages: list, model: str = None) -> str:
+    """Content address of a turn: backend, model, full prompt and the parameters that shape the output."""
     if llm_choice == "ollama":
-        agent_response = call_ollama(full_prompt)
-    elif llm_choice == "claude":
-        agent_response = call_claude(full_prompt)
+        model, params = model or OLLAMA_MODEL, {"num_ctx": OLLAMA_NUM_CTX}
     else:
-        print("Invalid LLM choice.")
+        model, params = model or CLAUDE_MODEL, {"max_tokens": CLAUDE_MAX_TOKENS}
+    params["stop_on_tool_request"] = STREAM_RESPONSES and STOP_ON_TOOL_REQUEST
+    return make_cache_key(llm_choice, model, system_prompt, messages, params)
+
+
+# --- Model Routing ---
+_model_router = None
+_model_router_lock = threading.Lock()
+
+
+def get_model_router(session_id: str = "default") -> ModelRouter:
+    """
+    Returns the process-wide model router, loading the routes in AI_RAILS_MODEL_ROUTES on
+    first use. If they cannot be loaded, every turn uses the session default route.
+    """
+    global _model_router
+    with _model_router_lock:
+        if _model_router is None:
+            routes = []
+            if MODEL_ROUTES_FILE:
+                try:
+                    routes = load_routes(Path(MODEL_ROUTES_FILE))
+                    log_event("MODEL_ROUTES_LOADED", f"Model routes loaded from {MODEL_ROUTES_FILE} ({len(routes)} routes).", session_id=session_id)
+                except (OSError, ValueError) as e:
+                    print(f"Warning: could not load model routes {MODEL_ROUTES_FILE}: {e}. Using the session's LLM choice for every agent.")
+                    log_event("ERROR", f"Failed to load model routes {MODEL_ROUTES_FILE}: {e}", session_id=session_id)
+            _model_router = ModelRouter(routes, clients={"ollama": call_ollama_chat, "claude": call_claude_chat}, log_event=log_event,
+                                        default_models={"ollama": OLLAMA_MODEL, "claude": CLAUDE_MODEL})
+        return _model_router
+
+
+def _store_agent_output(agent_role: str, session_id: str, turn: int, output_filename: Path, agent_response: str):
+    """Adds a turn's output to the content-addressed output store (see output_store.py)."""
+    try:
+        entry = output_store.get_store(output_filename.parent).add(agent_role, session_id, turn, output_filename, agent_response)
+    except OSError as e:
+        log_event("ERROR", f"Failed to add {agent_role} output to the output store: {e}", agent_role=agent_role, session_id=session_id)
         return
+    message = f"{agent_role} output stored as {entry['hash'][:12]}" + (" (identical to an earlier output)." if entry["deduplicated"] else ".")
+    log_event("AGENT_OUTPUT_STORED", message, agent_role=agent_role, session_id=session_id, details=entry)
+    if output_store.OUTPUT_KEEP_FILES > 0:
+        try:
+            output_store.get_store(output_filename.parent).trim_files(output_store.OUTPUT_KEEP_FILES, role=agent_role)
+        except OSError as e:
+            log_event("ERROR", f"Failed to trim {agent_role} output files: {e}", agent_role=agent_role, session_id=session_id)
+
+
+def _save_agent_output(agent_role: str, agent_response: str, output_filename: Path, session_id: str, source: str):
+    """Saves a response that did not come from a live LLM call (source: "cached" or "replayed")."""
+    try:
+        with open(output_filename, "w") as f:
+            f.write(agent_response)
+        log_event("AGENT_OUTPUT_SAVED", f"{agent_role} output saved to: {output_filename}", agent_role=agent_role, session_id=session_id, details={"path": str(output_filename), source: True})
+        print(f"\n--- {agent_role} Output Saved ({source}) ---")
+        print(f"You can review it at: {output_filename}")
+    except IOError as e:
+        log_event("ERROR", f"Failed to save agent output: {e}", agent_role=agent_role, session_id=session_id)
+        print(f"Error saving agent output: {e}")
+        print("\n--- Raw Agent Output ---")
+        print(agent_response)
+
+
+def _run_agent_turn(agent_role: str, system_prompt: str, messages: list, output_filename: Path, session_id: str, llm_choice: str, ollama_session: OllamaSession = None, llm_cache: LLMResponseCache = None) -> str:
+    """
+    Runs one conversation turn. In a checkpointed session the turn is replayed from the
+    checkpoint when resuming, and checkpointed once it has a response (see session_checkpoint.py).
+    """
+    checkpoint = session_checkpoint.current()
+    if checkpoint is None:
+        return _call_agent_turn(agent_role, system_prompt, messages, output_filename, session_id, llm_choice, ollama_session, llm_cache)
+
+    prompt_hash = session_checkpoint.content_hash(llm_choice, system_prompt, messages)
+    recorded = checkpoint.replay(agent_role, "llm_turn", prompt_hash)
+    if recorded is not None:
+        log_event("CHECKPOINT_REPLAY", f"Replayed {agent_role} turn from the session checkpoint.", agent_role=agent_role, session_id=session_id, details={"prompt_hash": prompt_hash})
+        _save_agent_output(agent_role, recorded["response"], output_filename, session_id, "replayed")
+        return recorded["response"]
+
+    agent_response = _call_agent_turn(agent_role, system_prompt, messages, output_filename, session_id, llm_choice, ollama_session, llm_cache)
+    if agent_response and not agent_response.startswith("Error:"):
+        checkpoint.record(agent_role, "llm_turn", prompt_hash, response=agent_response)
+    return agent_response
+
+
+def _call_agent_turn(agent_role: str, system_prompt: str, messages: list, output_filename: Path, session_id: str, llm_choice: str, ollama_session: OllamaSession = None, llm_cache: LLMResponseCache = None) -> str:
+    """
+    Sends one conversation turn through the model router (the session's LLM choice unless a
+    route says otherwise) and saves the raw response to output_filename.
+    If an LLMResponseCache is given, identical requests are answered from it.
+    """
+    router = get_model_router(session_id)
+    cache_key = None
+    if llm_cache is not None:
+        # Keyed on the route's first target, whichever target ends up answering
+        _, targets = router.route(agent_role, len(system_prompt) + sum(len(m["content"]) for m in messages), llm_choice)
+        cache_key = _llm_cache_key(targets[0].backend, system_prompt, messages, targets[0].model)
+        cached_response = llm_cache.get(cache_key)
+        if cached_response:
+            log_event("LLM_CACHE_HIT", f"Served {agent_role} turn from the LLM response cache.", agent_role=agent_role, session_id=session_id, llm_model=llm_choice, details={"key": cache_key})
+            _save_agent_output(agent_role, cached_response, output_filename, session_id, "cached")
+            return cached_response
+        log_event("LLM_CACHE_MISS", f"No cached response for {agent_role} turn.", agent_role=agent_role, session_id=session_id, llm_model=llm_choice, details={"key": cache_key})
+
+    # When streaming, the LLM client writes tokens straight into the output file
+    output_file = None
+    if STREAM_RESPONSES:
+        try:
+            output_file = open(output_filename, "w")
+        except IOError as e:
+            log_event("ERROR", f"Failed to open agent output file for streaming: {e}", agent_role=agent_role, session_id=session_id)
+            print(f"Error opening agent output file, falling back to buffered output: {e}")
+
+    agent_response = ""
+    target = None
+    try:
+        agent_response, target = router.chat(agent_role, llm_choice, messages, system_prompt, stream=output_file is not None, output_file=output_file,
+                                             session_id=session_id, client_kwargs={"ollama": {"ollama_session": ollama_session}})
+    finally:
+        if output_file:
+            output_file.close()
+
+    if output_file and agent_response.startswith("Error:"):
+        # Record the failure in the output file, as the buffered path does
+        with open(output_filename, "w") as f:
+            f.write(agent_response)
 
     if not agent_response:
+        if output_file and output_filename.exists():
+            output_filename.unlink()
         print(f"Agent ({agent_role}) did not return a response.")
         log_event("AGENT_NO_RESPONSE", f"{agent_role} did not return a response.", agent_role=agent_role, session_id=session_id, llm_model=llm_choice)
-        return
+        return ""
 
-    # Save the raw agent output
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_filename = project_output_path / f"{agent_role.lower().replace(' ', '_')}_output_{timestamp}.md"
+    if cache_key and not agent_response.startswith("Error:"):
+        llm_cache.put(cache_key, agent_response, metadata={"agent_role": agent_role, "llm_choice": llm_choice, "answered_by": repr(target)})
+
+    # Save the raw agent output (already on disk if it was streamed)
     try:
-        with open(output_filename, "w") as f:
-            f.write(agent_response)
-        log_event("AGENT_OUTPUT_SAVED", f"{agent_role} output saved to: {output_filename}", agent_role=agent_role, session_id=session_id, details={"path": str(output_filename)})
+        if not output_file:
+            with open(output_filename, "w") as f:
+                f.write(agent_response)
+        log_event("AGENT_OUTPUT_SAVED", f"{agent_role} output saved to: {output_filename}", agent_role=agent_role, session_id=session_id, llm_model=target.model if target else "N/A", details={"path": str(output_filename), "backend": target.backend if target else llm_choice})
         print(f"\n--- {agent_role} Output Saved ---")
         print(f"You can review it at: {output_filename}")
     except IOError as e:
@@ -277,119 +910,609 @@ def engage_agent(
         print("\n--- Raw Agent Output ---")
         print(agent_response)
 
+    return agent_response
 
-    # --- Tool Request Detection ---
-    tool_request_match = re.search(r"```json\s*(.*?)\s*```", agent_response, re.DOTALL)
-    if tool_request_match:
-        try:
-            tool_request_json = json.loads(tool_request_match.group(1))
-            if tool_request_json.get("type") == "tool_request":
-                tool_name = tool_request_json.get("tool_name")
-                parameters = tool_request_json.get("parameters", {})
-                explanation = tool_request_json.get("explanation", "No explanation provided.")
-
-                log_event("MCP_REQUEST_FORMULATED", f"Agent formulated tool request for {tool_name}.", 
-                          agent_role=agent_role, session_id=session_id, 
-                          details={"tool_name": tool_name, "parameters": parameters, "explanation": explanation})
-                
-                # Check if this is a sensitive secret request
-                is_sensitive_secret = False
-                if tool_name == "SecretsMCP":
-                    secret_name = parameters.get("secret_name", "")
-                    project_context = os.getenv("AI_RAILS_PROJECT_NAME")
-                    
-                    if secret_name in SENSITIVE_SECRETS:
-                        is_sensitive_secret = True
-                        print(f"\n--- !!! SENSITIVE SECRET REQUEST !!! ---")
-                        print(f"⚠️  The {agent_role} has requested access to a SENSITIVE secret:")
-                        print(f"Secret Name: {secret_name}")
-                        if project_context:
-                            print(f"Project Context: {project_context}")
-                        print(f"This secret is classified as SENSITIVE and requires explicit approval.")
-                        print(f"Explanation: {explanation}")
-                    else:
-                        print(f"\n--- HUMAN INTERVENTION REQUIRED ---")
-                        print(f"The {agent_role} has requested secret: {secret_name}")
-                        if project_context:
-                            print(f"Project Context: {project_context}")
-                        print(f"Explanation: {explanation}")
-                else:
-                    print(f"\n--- !!! HUMAN INTERVENTION REQUIRED !!! ---")
-                    print(f"The {agent_role} has requested to use a tool:")
-                    print(f"Tool Name: {tool_name}")
-                    print(f"Explanation: {explanation}")
-                    print(f"Raw Request: {json.dumps(parameters, indent=2)}")
-
-                # Get human approval with appropriate prompt
-                if is_sensitive_secret:
-                    confirm = input("Do you approve this SENSITIVE secret request? (yes/no): ").lower().strip()
-                else:
-                    confirm = input("Do you approve this tool request? (yes/no): ").lower().strip()
-                
-                if confirm == "yes":
-                    log_event("HUMAN_DECISION", f"Human approved tool request for {tool_name}.", agent_role="Orchestrator", session_id=session_id)
-                    print(f"Executing tool: {tool_name}...")
-                    tool_output = call_mcp(tool_name, parameters)
-                    log_event("TOOL_EXECUTION_RESULT", f"Tool {tool_name} executed. Status: {tool_output.get('status', 'N/A')}", 
-                              agent_role="Orchestrator", session_id=session_id, details=tool_output)
-                    
-                    print("\n--- Tool Execution Result ---")
-                    print(json.dumps(tool_output, indent=2))
-                    
-                    # Recursively call engage_agent to feed tool output back to the agent
-                    print(f"\n--- Re-engaging {agent_role} with tool output ---")
-                    engage_agent(
-                        agent_role=agent_role,
-                        agent_template_filename=agent_template_filename,
-                        user_input_content=user_input_content, # Pass original user input
-                        project_output_path=project_output_path,
-                        session_id=session_id,
-                        llm_choice=llm_choice,
-                        previous_tool_output=json.dumps(tool_output, indent=2) # Pass tool output
-                    )
-
-                else:
-                    log_event("HUMAN_DECISION", f"Human denied tool request for {tool_name}.", agent_role="Orchestrator", session_id=session_id)
-                    custom_feedback = input("Please provide feedback to the agent (e.g., 'Deny: MCP not available', 'Refine request to...'): ")
-                    # Recursively call engage_agent to feed human feedback back
-                    print(f"\n--- Re-engaging {agent_role} with human feedback ---")
-                    engage_agent(
-                        agent_role=agent_role,
-                        agent_template_filename=agent_template_filename,
-                        user_input_content=user_input_content, # Pass original user input
-                        project_output_path=project_output_path,
-                        session_id=session_id,
-                        llm_choice=llm_choice,
-                        previous_tool_output=f"Human Feedback: {custom_feedback}" # Pass human feedback
-                    )
-            else:
-                log_event("AGENT_OUTPUT_JSON_NOT_TOOL_REQUEST", "Agent output contained JSON but not a valid tool_request.", agent_role=agent_role, session_id=session_id, details={"json": tool_request_json})
-                print("\nAgent output contained a JSON block, but it was not a recognized 'tool_request'.")
-                print("Please review the agent's output manually.")
 
+def _extract_tool_requests(agent_response: str, agent_role: str, session_id: str) -> list:
+    """Returns every tool_request block in the agent output, logging when there are none."""
+    tool_requests = []
+    malformed_blocks = 0
+    non_tool_json = []
+    for block_match in TOOL_REQUEST_BLOCK_PATTERN.finditer(agent_response):
+        try:
+            block_json = json.loads(block_match.group(1))
         except json.JSONDecodeError:
+            malformed_blocks += 1
+            continue
+        if isinstance(block_json, dict) and block_json.get("type") == "tool_request":
+            tool_requests.append(block_json)
+        else:
+            non_tool_json.append(block_json)
+
+    if not tool_requests:
+        if malformed_blocks:
             log_event("AGENT_OUTPUT_INVALID_JSON", "Agent output contained a malformed JSON block.", agent_role=agent_role, session_id=session_id)
             print("\nAgent output contained a JSON-like block, but it was malformed.")
             print("Please review the agent's output manually for parsing errors.")
-        except Exception as e:
-            log_event("ERROR", f"Error processing agent's tool request: {e}", agent_role=agent_role, session_id=session_id)
-            print(f"An unexpected error occurred while processing the agent's output: {e}")
+        elif non_tool_json:
+            log_event("AGENT_OUTPUT_JSON_NOT_TOOL_REQUEST", "Agent output contained JSON but not a valid tool_request.", agent_role=agent_role, session_id=session_id, details={"json": non_tool_json[0]})
+            print("\nAgent output contained a JSON block, but it was not a recognized 'tool_request'.")
             print("Please review the agent's output manually.")
-    else:
-        log_event("AGENT_OUTPUT_NO_TOOL_REQUEST", "Agent output did not contain a tool request.", agent_role=agent_role, session_id=session_id)
-        print("\n--- No Tool Request Detected in Agent Output ---")
-        print("Please review the agent's output and decide the next step manually.")
+        else:
+            log_event("AGENT_OUTPUT_NO_TOOL_REQUEST", "Agent output did not contain a tool request.", agent_role=agent_role, session_id=session_id)
+            print("\n--- No Tool Request Detected in Agent Output ---")
+            print("Please review the agent's output and decide the next step manually.")
+    elif malformed_blocks:
+        log_event("AGENT_OUTPUT_INVALID_JSON", f"Agent output contained {malformed_blocks} malformed JSON block(s) alongside tool requests.", agent_role=agent_role, session_id=session_id)
+        print(f"\nNote: {malformed_blocks} malformed JSON block(s) in the agent output were ignored.")
+    return tool_requests
 
 
-# --- Main Orchestration Loop (called by run_workflow.sh) ---
-def main_workflow_loop(
-    project_name: str,
-    workflow_type: str, # "new_project" or "feature_update" or "execution"
-    plan_path: Path = None # Only for execution phase
+def engage_agent(
+    agent_role: str,
+    agent_template_filename: str,
+    user_input_content: str,
+    project_output_path: Path,
+    session_id: str,
+    llm_choice: str = "ollama",
+    previous_tool_output: str = "", # Optional tool output/feedback to seed the first turn with
+    llm_cache: LLMResponseCache = None, # Optional response cache (see llm_cache.py)
+    approval=None, # Decides on tool requests; defaults to asking the human (InteractiveApproval)
+    output_label: str = None # Added to the output file names, e.g. the workflow node running the agent
 ):
+    """
+    Engages a specific AI agent and runs its multi-turn conversation,
+    including tool request detection and human gating.
+
+    The compiled agent prompt is sent as the system prompt and the conversation is kept
+    as a list of messages: each tool result (or human feedback) is appended as a new user
+    message and the agent is re-engaged in a loop, up to AGENT_MAX_TURNS turns.
+    Returns the agent's last response ("" if it never responded, None if it could not start).
+    """
+    log_event("AGENT_ENGAGE", f"Engaging {agent_role} agent.", agent_role=agent_role, session_id=session_id)
+
+    if llm_choice not in ["ollama", "claude"]:
+        print("Invalid LLM choice.")
+        return
+
+    agent_template_path = AGENT_TEMPLATES_DIR / agent_template_filename
+    try:
+        with metrics.session_context(session_id), metrics.span("prompt_build", agent_role=agent_role):
+            system_prompt = compile_agent_prompt(agent_template_path, MCP_REGISTRY)
+    except FileNotFoundError:
+        log_event("ERROR", f"Agent template not found: {agent_template_path}", agent_role="Orchestrator")
+        system_prompt = ""
+
+    if not system_prompt:
+        print("Failed to build agent prompt. Exiting agent engagement.")
+        return
+
+    first_message = f"--- ADDITIONAL CONTEXT ---\n{user_input_content}\n--------------------------"
+    if previous_tool_output:
+        first_message += f"\n\n--- PREVIOUS TOOL OUTPUT ---\n{previous_tool_output}\n--------------------------"
+        log_event("CONTEXT_INJECTED", "Previous tool output injected into agent prompt.", agent_role=agent_role, session_id=session_id)
+    messages = [{"role": "user", "content": first_message}]
+
+    # Routes may send any turn to Ollama, whatever the session's LLM choice
+    ollama_session = OllamaSession()
+    try:
+        # Spans recorded during the conversation (LLM, MCP, approval wait) count towards this session
+        with metrics.session_context(session_id):
+            return _run_agent_conversation(agent_role, system_prompt, messages, project_output_path, session_id, llm_choice, ollama_session, llm_cache, approval, output_label)
+    finally:
+        if ollama_session and ollama_session.turns:
+            summary = ollama_session.summary()
+            log_event("OLLAMA_PREFILL_SUMMARY", f"{agent_role} prefill: {summary['prompt_eval_ms']} ms spent, ~{summary['estimated_saved_ms']} ms saved by KV cache reuse.", agent_role=agent_role, session_id=session_id, details=summary)
+        _write_metrics_textfile()
+
+
+def _run_agent_conversation(agent_role: str, system_prompt: str, messages: list, project_output_path: Path, session_id: str, llm_choice: str, ollama_session: OllamaSession = None, llm_cache: LLMResponseCache = None, approval=None, output_label: str = None):
+    """
+    The turn loop of engage_agent: call the LLM, handle tool requests, append the results,
+    repeat. Returns the agent's last response.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    role_slug = agent_role.lower().replace(' ', '_')
+    if output_label:
+        # Engagements of one role running at once (e.g. two coder nodes of a workflow DAG)
+        # would otherwise write the same files whenever they start in the same second
+        timestamp = f"{re.sub(r'[^A-Za-z0-9-]+', '-', output_label)}_{timestamp}"
+    last_response = ""
+    for turn in range(1, AGENT_MAX_TURNS + 1):
+        print(f"\n--- Sending prompt to {agent_role} ({llm_choice}, turn {turn}) ---")
+        output_filename = project_output_path / f"{role_slug}_output_{timestamp}_turn{turn}.md"
+        agent_response = _run_agent_turn(agent_role, system_prompt, _window_messages(messages), output_filename, session_id, llm_choice, ollama_session, llm_cache)
+        if not agent_response:
+            return last_response
+        last_response = agent_response
+        messages.append({"role": "assistant", "content": agent_response})
+        if OUTPUT_STORE_ENABLED and not agent_response.startswith("Error:"):
+            _store_agent_output(agent_role, session_id, turn, output_filename, agent_response)
+
+        # --- Tool Request Detection ---
+        # Agents may emit several tool_request blocks in one response; they are approved as
+        # one batch and executed concurrently.
+        tool_requests = _extract_tool_requests(agent_response, agent_role, session_id)
+        if not tool_requests:
+            return agent_response
+
+        checkpoint = session_checkpoint.current()
+        recorded = checkpoint.replay(agent_role, "tool_batch", session_checkpoint.content_hash(tool_requests)) if checkpoint else None
+        if recorded is not None:
+            # Already decided and executed before the session was interrupted
+            log_event("CHECKPOINT_REPLAY", f"Replayed {len(tool_requests)} tool request(s) from the session checkpoint.", agent_role=agent_role, session_id=session_id,
+                      details={"approved": recorded["approved"], "decided_by": recorded["decided_by"]})
+            print(f"\n--- Tool results replayed from checkpoint ({len(recorded['approved'])} of {len(tool_requests)} approved) ---")
+            next_tool_output = _replayed_tool_output(tool_requests, recorded)
+        else:
+            try:
+                next_tool_output = _handle_tool_requests(agent_role, tool_requests, session_id, approval)
+            except Exception as e:
+                log_event("ERROR", f"Error processing agent's tool request: {e}", agent_role=agent_role, session_id=session_id)
+                print(f"An unexpected error occurred while processing the agent's output: {e}")
+                print("Please review the agent's output manually.")
+                return agent_response
+
+        # Feed the tool output (or human feedback) back to the agent as the next user message
+        messages.append({"role": "user", "content": f"--- PREVIOUS TOOL OUTPUT ---\n{next_tool_output}\n--------------------------"})
+        log_event("CONTEXT_INJECTED", "Tool output appended to agent conversation.", agent_role=agent_role, session_id=session_id, details={"turn": turn, "messages": len(messages)})
+        print(f"\n--- Re-engaging {agent_role} with tool output ---")
+
+    log_event("AGENT_MAX_TURNS_REACHED", f"{agent_role} reached the maximum of {AGENT_MAX_TURNS} turns.", agent_role=agent_role, session_id=session_id)
+    print(f"\n{agent_role} reached the maximum of {AGENT_MAX_TURNS} turns. Please review its output and decide the next step manually.")
+    return last_response
+
+
+def _is_sensitive_request(tool_name: str, parameters: dict) -> bool:
+    """True if a tool request asks for one of SENSITIVE_SECRETS."""
+    return tool_name == "SecretsMCP" and parameters.get("secret_name", "") in SENSITIVE_SECRETS
+
+
+def _print_tool_request(agent_role: str, tool_name: str, parameters: dict, explanation: str):
+    """Prints a tool request for human review."""
+    if tool_name == "SecretsMCP":
+        secret_name = parameters.get("secret_name", "")
+        project_context = os.getenv("AI_RAILS_PROJECT_NAME")
+
+        if _is_sensitive_request(tool_name, parameters):
+            print(f"\n--- !!! SENSITIVE SECRET REQUEST !!! ---")
+            print(f"⚠️  The {agent_role} has requested access to a SENSITIVE secret:")
+            print(f"Secret Name: {secret_name}")
+            if project_context:
+                print(f"Project Context: {project_context}")
+            print(f"This secret is classified as SENSITIVE and requires explicit approval.")
+            print(f"Explanation: {explanation}")
+            return
+
+        print(f"\n--- HUMAN INTERVENTION REQUIRED ---")
+        print(f"The {agent_role} has requested secret: {secret_name}")
+        if project_context:
+            print(f"Project Context: {project_context}")
+        print(f"Explanation: {explanation}")
+        return
+
+    print(f"\n--- !!! HUMAN INTERVENTION REQUIRED !!! ---")
+    print(f"The {agent_role} has requested to use a tool:")
+    print(f"Tool Name: {tool_name}")
+    print(f"Explanation: {explanation}")
+    print(f"Raw Request: {json.dumps(parameters, indent=2)}")
+
+
+def _ask_batch_approval(count: int, any_sensitive: bool) -> set:
+    """
+    Asks the human to approve a batch of tool requests.
+    Returns the set of approved 0-based indices (empty if denied).
+    """
+    if count == 1:
+        if any_sensitive:
+            confirm = input("Do you approve this SENSITIVE secret request? (yes/no): ").lower().strip()
+        else:
+            confirm = input("Do you approve this tool request? (yes/no): ").lower().strip()
+        return {0} if confirm == "yes" else set()
+
+    label = "tool requests (including a SENSITIVE secret)" if any_sensitive else "tool requests"
+    confirm = input(f"Do you approve all {count} {label}? (yes/no, or numbers to approve a subset, e.g. 1,3): ").lower().strip()
+    if confirm == "yes":
+        return set(range(count))
+    approved = set()
+    for part in confirm.replace(" ", "").split(","):
+        if part.isdigit() and 1 <= int(part) <= count:
+            approved.add(int(part) - 1)
+    return approved
+
+
+class InteractiveApproval:
+    """
+    Default approval handler: prints the requests for review and asks the human at the console.
+
+    Approval handlers decide on a batch of tool requests. Any object with the same
+    attributes can be passed to engage_agent(approval=...), e.g. the headless handler in
+    batch_runner.py:
+      - decided_by: "human" or "policy", used to label the logged decisions
+      - approve(agent_role, tool_requests, sensitive, session_id) -> set of approved indices,
+        where sensitive[i] is True if request i asks for one of SENSITIVE_SECRETS
+      - feedback(agent_role, tool_requests, session_id) -> text returned to the agent when
+        every request was denied
+      - logs_decisions (optional): True if the handler logs its own per-request decisions,
+        as PolicyApproval in approval_policy.py does
+      - turn(agent_role, session_id) (optional): context manager held while a batch is
+        presented and decided, as ApprovalQueue does for agents running in parallel
+    """
+
+    decided_by = "human"
+
+    def approve(self, agent_role: str, tool_requests: list, sensitive: list, session_id: str) -> set:
+        for index, tool_request in enumerate(tool_requests, start=1):
+            if len(tool_requests) > 1:
+                print(f"\n=== Tool Request {index} of {len(tool_requests)} ===")
+            _print_tool_request(agent_role, tool_request.get("tool_name"), tool_request.get("parameters", {}),
+                                tool_request.get("explanation", "No explanation provided."))
+        return _ask_batch_approval(len(tool_requests), any(sensitive))
+
+    def feedback(self, agent_role: str, tool_requests: list, session_id: str) -> str:
+        return input("Please provide feedback to the agent (e.g., 'Deny: MCP not available', 'Refine request to...'): ")
+
+
+INTERACTIVE_APPROVAL = InteractiveApproval()
+
+
+def default_approval(session_id: str = "default"):
+    """
+    Returns the approval handler for interactive workflows: the approval policy in
+    AI_RAILS_APPROVAL_POLICY with escalations going to the human, or just the human if no
+    policy is configured or it cannot be loaded.
+    """
+    if not APPROVAL_POLICY_FILE:
+        return INTERACTIVE_APPROVAL
+    try:
+        policy = load_policy(Path(APPROVAL_POLICY_FILE))
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not load approval policy {APPROVAL_POLICY_FILE}: {e}. Every tool request will need your approval.")
+        log_event("ERROR", f"Failed to load approval policy {APPROVAL_POLICY_FILE}: {e}", session_id=session_id)
+        return INTERACTIVE_APPROVAL
+    log_event("APPROVAL_POLICY_LOADED", f"Approval policy loaded from {policy.source} ({len(policy.rules)} rules, default '{policy.default}').", session_id=session_id)
+    return PolicyApproval(policy, INTERACTIVE_APPROVAL, log_event)
+
+
+_parallel_console = contextvars.ContextVar("ai_rails_parallel_console", default=None)  # (ParallelConsole, label)
+
+
+class _ParallelStdout:
+    """sys.stdout replacement that hands prints from agents running under a ParallelConsole to it."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def write(self, text: str) -> int:
+        entry = _parallel_console.get()
+        if entry is None:
+            return self.fallback.write(text)
+        console, label = entry
+        return console.write(label, text)
+
+    def flush(self):
+        self.fallback.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+_parallel_stdout_lock = threading.Lock()
+_parallel_stdout_users = 0
+
+
+class ParallelConsole:
+    """
+    Console output of agents running in parallel (fan_out_agents, workflow_dag). Inside
+    agent(label), prints are written a line at a time with a "[label] " prefix, so
+    streamed responses of different agents do not mix. While one agent's tool requests are
+    presented for approval (see ApprovalQueue), the other agents' lines are held back and
+    written once the decision is made, so they never run into the approval prompt.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._partial = {}       # label -> unfinished line
+        self._held = []          # lines held back during an approval
+        self._presenting = None  # label of the agent whose requests are being presented
+        self._stream = None
+
+    @contextmanager
+    def active(self):
+        """Routes sys.stdout through this console while agents run (nestable across threads)."""
+        global _parallel_stdout_users
+        with _parallel_stdout_lock:
+            if _parallel_stdout_users == 0:
+                sys.stdout = _ParallelStdout(sys.stdout)
+            _parallel_stdout_users += 1
+            self._stream = sys.stdout.fallback
+        try:
+            yield self
+        finally:
+            self.flush_all()
+            with _parallel_stdout_lock:
+                _parallel_stdout_users -= 1
+                if _parallel_stdout_users == 0 and isinstance(sys.stdout, _ParallelStdout):
+                    sys.stdout = sys.stdout.fallback
+
+    @contextmanager
+    def agent(self, label: str):
+        """Marks the calling thread's prints as label's."""
+        token = _parallel_console.set((self, label))
+        try:
+            yield
+        finally:
+            _parallel_console.reset(token)
+            with self._lock:
+                self._emit(self._finish_line(label))
+
+    def write(self, label: str, text: str) -> int:
+        with self._lock:
+            if label == self._presenting:
+                # The agent being approved writes straight through: banners and the input() prompt
+                return self._stream.write(text)
+            lines = (self._partial.pop(label, "") + text).split("\n")
+            if lines[-1]:
+                self._partial[label] = lines[-1]
+            self._emit("".join(f"[{label}] {line}\n" for line in lines[:-1]))
+        return len(text)
+
+    def presenting(self, label: str):
+        """Starts (label) or ends (None) an agent's approval turn."""
+        with self._lock:
+            if label is not None:
+                pending = self._finish_line(label)
+                self._presenting = None
+                self._emit(pending)
+            self._presenting = label
+            if label is None and self._held:
+                held, self._held = "".join(self._held), []
+                self._stream.write(held)
+                self._stream.flush()
+
+    def flush_all(self):
+        with self._lock:
+            for label in list(self._partial):
+                self._emit(self._finish_line(label))
+
+    def _finish_line(self, label: str) -> str:
+        partial = self._partial.pop(label, "")
+        return f"[{label}] {partial}\n" if partial else ""
+
+    def _emit(self, text: str):
+        """Writes complete lines, or holds them while another agent is being approved (lock held)."""
+        if not text:
+            return
+        if self._presenting is not None:
+            self._held.append(text)
+        else:
+            self._stream.write(text)
+
+
+class ApprovalQueue:
+    """
+    Wraps an approval handler for agents running in parallel (see fan_out_agents): their
+    tool request batches are presented and decided one at a time, in arrival order, while
+    the other agents keep generating. With a ParallelConsole, the other agents' output is
+    held back while a batch is presented.
+    """
+
+    def __init__(self, approval, console: ParallelConsole = None):
+        self.approval = approval
+        self.console = console
+        self.decided_by = approval.decided_by
+        self.logs_decisions = getattr(approval, "logs_decisions", False)
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    @contextmanager
+    def turn(self, agent_role: str, session_id: str):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._condition.wait_for(lambda: self._serving == ticket)
+            waiting = self._next_ticket - ticket - 1
+        entry = _parallel_console.get()
+        presenting = self.console is not None and entry is not None and entry[0] is self.console
+        if presenting:
+            self.console.presenting(entry[1])
+        print(f"\n=== Approval queue: {agent_role}" + (f" ({waiting} more waiting)" if waiting else "") + " ===")
+        try:
+            yield
+        finally:
+            if presenting:
+                self.console.presenting(None)
+            with self._condition:
+                self._serving += 1
+                self._condition.notify_all()
+
+    def approve(self, agent_role: str, tool_requests: list, sensitive: list, session_id: str) -> set:
+        return self.approval.approve(agent_role, tool_requests, sensitive, session_id)
+
+    def feedback(self, agent_role: str, tool_requests: list, session_id: str) -> str:
+        return self.approval.feedback(agent_role, tool_requests, session_id)
+
+
+def _handle_tool_requests(agent_role: str, tool_requests: list, session_id: str, approval=None) -> str:
+    """
+    Presents a batch of tool requests for one approval decision (by the human, unless
+    another approval handler is given), runs the approved ones concurrently via
+    call_mcp_batch and returns the text fed back to the agent.
+    """
+    approval = approval or INTERACTIVE_APPROVAL
+    decision_event = "HUMAN_DECISION" if approval.decided_by == "human" else "AUTO_DECISION"
+    log_decisions = not getattr(approval, "logs_decisions", False)
+    decider = "Human" if approval.decided_by == "human" else "Approval policy"
+    for tool_request in tool_requests:
+        log_event("MCP_REQUEST_FORMULATED", f"Agent formulated tool request for {tool_request.get('tool_name')}.",
+                  agent_role=agent_role, session_id=session_id,
+                  details={"tool_name": tool_request.get("tool_name"), "parameters": tool_request.get("parameters", {}),
+                           "explanation": tool_request.get("explanation", "No explanation provided.")})
+
+    # Agents running in parallel share one ApprovalQueue: one batch is presented at a time.
+    # Only requests that reach a human are printed for review (by the human's handler).
+    with approval.turn(agent_role, session_id) if hasattr(approval, "turn") else contextlib.nullcontext():
+        sensitive = [_is_sensitive_request(r.get("tool_name"), r.get("parameters", {})) for r in tool_requests]
+        with metrics.span("approval_wait", kind="decision", decided_by=approval.decided_by):
+            approved = approval.approve(agent_role, tool_requests, sensitive, session_id)
+        if approval.decided_by != "human":
+            print(f"\n{decider} decision for {agent_role}: " + ", ".join(
+                f"{r.get('tool_name')} {'approved' if i in approved else 'denied'}" for i, r in enumerate(tool_requests)))
+
+        if not approved:
+            if log_decisions:
+                for tool_request in tool_requests:
+                    log_event(decision_event, f"{decider} denied tool request for {tool_request.get('tool_name')}.", agent_role="Orchestrator",
+                              session_id=session_id, details={"tool_name": tool_request.get("tool_name")})
+            with metrics.span("approval_wait", kind="feedback", decided_by=approval.decided_by):
+                custom_feedback = approval.feedback(agent_role, tool_requests, session_id)
+            return _checkpoint_tool_batch(agent_role, tool_requests, approved, approval, f"{decider} Feedback: {custom_feedback}")
+
+    for index, tool_request in enumerate(tool_requests if log_decisions else []):
+        decision = "approved" if index in approved else "denied"
+        log_event(decision_event, f"{decider} {decision} tool request for {tool_request.get('tool_name')}.", agent_role="Orchestrator",
+                  session_id=session_id, details={"tool_name": tool_request.get("tool_name")})
+
+    batch = [(tool_requests[i].get("tool_name"), tool_requests[i].get("parameters", {})) for i in sorted(approved)]
+    print(f"Executing tool(s): {', '.join(name for name, _ in batch)}...")
+    results = dict(zip(sorted(approved), call_mcp_batch(batch)))
+
+    for index in sorted(approved):
+        tool_output = results[index]
+        tool_name = tool_requests[index].get("tool_name")
+        # Secret values go only into the text returned to the agent, never to the log or console
+        redacted_output = _redact_tool_result(tool_name, tool_output)
+        log_event("TOOL_EXECUTION_RESULT", f"Tool {tool_name} executed. Status: {tool_output.get('status', 'N/A')}",
+                  agent_role="Orchestrator", session_id=session_id, details=redacted_output)
+        print(f"\n--- Tool Execution Result ({tool_name}) ---")
+        print(json.dumps(redacted_output, indent=2))
+
+    return _checkpoint_tool_batch(agent_role, tool_requests, approved, approval,
+                                  _format_tool_output(tool_requests, approved, results, approval.decided_by), results)
+
+
+def _redact_tool_result(tool_name: str, tool_output: dict) -> dict:
+    """A tool result with any SecretsMCP secret value replaced, for the log, console and checkpoints."""
+    if tool_name == "SecretsMCP" and isinstance(tool_output, dict) and "value" in tool_output:
+        return {**tool_output, "value": session_checkpoint.REDACTED}
+    return tool_output
+
+
+def _format_tool_output(tool_requests: list, approved: set, results: dict, decided_by: str) -> str:
+    """The text fed back to the agent for an executed batch; results maps request index to tool output."""
+    if len(tool_requests) == 1:
+        return json.dumps(results[0], indent=2)
+
+    # Feed all results (and any denials) back together in one re-engagement
+    sections = []
+    for index, tool_request in enumerate(tool_requests):
+        header = f"### Tool Request {index + 1}: {tool_request.get('tool_name')}"
+        if index in approved:
+            sections.append(f"{header}\n{json.dumps(results[index], indent=2)}")
+        else:
+            sections.append(f"{header}\nDenied by {'human reviewer' if decided_by == 'human' else 'approval policy'}; not executed.")
+    return "\n\n".join(sections)
+
+
+def _checkpoint_tool_batch(agent_role: str, tool_requests: list, approved: set, approval, output: str, results: dict = None) -> str:
+    """
+    Checkpoints a decided and executed batch of tool requests (if the session is
+    checkpointed); returns output. An executed batch is stored as its per-request results
+    with secret values redacted, and rebuilt by _replayed_tool_output on resume.
+    """
+    checkpoint = session_checkpoint.current()
+    if checkpoint is not None:
+        if results is None:
+            data = {"output": output}
+        else:
+            data = {"results": [_redact_tool_result(tool_requests[i].get("tool_name"), results[i]) if i in results else None
+                                for i in range(len(tool_requests))]}
+        checkpoint.record(agent_role, "tool_batch", session_checkpoint.content_hash(tool_requests), requests=tool_requests,
+                          approved=sorted(approved), decided_by=approval.decided_by, **data)
+    return output
+
+
+def _replayed_tool_output(tool_requests: list, recorded: dict) -> str:
+    """Rebuilds the tool output of a checkpointed batch, fetching its redacted secrets again."""
+    if "results" not in recorded:
+        return recorded["output"]
+    results = {}
+    for index, result in enumerate(recorded["results"]):
+        if result is None:
+            continue
+        tool_request = tool_requests[index]
+        if tool_request.get("tool_name") == "SecretsMCP" and result.get("value") == session_checkpoint.REDACTED:
+            # Approved when the session first ran; not written to the checkpoint
+            result = call_mcp("SecretsMCP", tool_request.get("parameters", {}))
+        results[index] = result
+    return _format_tool_output(tool_requests, set(recorded["approved"]), results, recorded["decided_by"])
+
+
+# --- Main Orchestration Loop (called by run_workflow.sh) ---
+def _write_metrics_textfile():
+    """Exports the metrics registry for Prometheus; a failed export never interrupts a workflow."""
+    try:
+        metrics.METRICS.write_textfile()
+    except OSError as e:
+        log_event("ERROR", f"Failed to write metrics textfile: {e}")
+
+def _log_session_metrics(session_id: str):
+    """Logs the session's timing summary and prints where the time went, then drops it."""
+    summary = metrics.METRICS.session_summary(session_id)
+    metrics.METRICS.forget_session(session_id)
+    if not summary["spans"]:
+        return
+    totals = summary["totals_seconds"]
+    breakdown = (f"LLM {totals.get('llm_call', 0.0):.1f}s, tools {totals.get('mcp_call', 0.0):.1f}s, "
+                 f"human approval {totals.get('approval_wait', 0.0):.1f}s, prompt build {totals.get('prompt_build', 0.0):.2f}s")
+    log_event("SESSION_METRICS", f"Session time breakdown: {breakdown}.", session_id=session_id, details=summary)
+    print(f"\n--- Session time breakdown: {breakdown} ---")
+    _write_metrics_textfile()
+
+def _log_workflow_stats(session_id: str, llm_cache: LLMResponseCache = None):
+    """Logs end-of-workflow transport, cache and timing statistics."""
+    log_event("HTTP_TRANSPORT_STATS", "HTTP connection pool statistics.", session_id=session_id, details=http_transport.get_transport_stats())
+    tool_cache_stats = call_mcp_module.TOOL_RESULT_CACHE.stats()
+    log_event("TOOL_CACHE_STATS", f"Tool result cache: {tool_cache_stats['hits']} hits, {tool_cache_stats['misses']} misses.", session_id=session_id, details=tool_cache_stats)
+    if llm_cache:
+        stats = llm_cache.stats()
+        log_event("LLM_CACHE_STATS", f"LLM response cache: {stats['hits']} hits, {stats['misses']} misses.", session_id=session_id, details=stats)
+    if len(OLLAMA_POOL.nodes) > 1:
+        node_stats = OLLAMA_POOL.stats()
+        log_event("OLLAMA_POOL_STATS", f"Ollama pool: {sum(1 for n in node_stats.values() if n['healthy'])} of {len(node_stats)} nodes healthy.", session_id=session_id, details=node_stats)
+        print("\n--- Ollama nodes ---")
+        for url, stats in node_stats.items():
+            print(f"{url}: {'healthy' if stats['healthy'] else 'EJECTED'}, {stats['requests']} requests, {stats['failures']} failures, avg {stats['avg_ms']} ms")
+    OLLAMA_POOL.forget_session(session_id)
+    _log_session_metrics(session_id)
+
+# Execution-phase agents, keyed by their menu option: (agent role, template filename).
+EXECUTION_AGENTS = {
+    "a": ("Coder Agent", "coder_agent_system_prompt.md"),
+    "b": ("Unit Tester Agent", "unit_tester_agent_system_prompt.md"),
+    "c": ("Debugger Agent", "debugger_agent_system_prompt.md"),
+    "d": ("Documentation Agent", "documentation_agent_system_prompt.md"),
+    "e": ("Code Review Agent", "code_review_agent_system_prompt.md"),
+    "f": ("Refactor Agent", "refactor_agent_system_prompt.md"),
+    "g": ("n8n Flow Creator Agent", "n8n_flow_creator_agent_system_prompt.md"),
+}
+
+PLANNING_AGENT = ("Planning Agent", "planning_agent_system_prompt.md")
+
+
+def new_session_id(suffix: str = "") -> str:
+    """Returns a timestamp session id; concurrent sessions pass a suffix to keep theirs unique."""
     session_id = datetime.now().strftime("%Y%m%d%H%M%S")
-    log_event("WORKFLOW_START", f"AI Rails workflow started for {project_name} ({workflow_type}).", session_id=session_id)
+    return f"{session_id}-{suffix}" if suffix else session_id
+
 
+def prepare_workflow(project_name: str, workflow_type: str, session_id: str, plan_path: Path = None):
+    """
+    Creates the project's output directory and reads the content the agents start from:
+    the idea file for planning workflows, the plan for the execution phase.
+    Returns (output_dir, initial_content), or None if the workflow cannot start.
+    """
     current_project_output_dir = OUTPUT_DIR / f"{workflow_type}_plans" / project_name
     current_project_output_dir.mkdir(parents=True, exist_ok=True)
 
@@ -409,40 +1532,216 @@ def main_workflow_loop(
     if workflow_type == "execution" and not plan_path:
         print("Error: Execution phase requires a specified plan path.")
         log_event("ERROR", "Execution phase started without a plan path.", session_id=session_id)
-        return
+        return None
 
     if workflow_type == "execution" and plan_path.exists():
         with open(plan_path, "r") as f:
             user_initial_idea_content = f.read() # The 'plan' becomes the 'initial idea' for execution agents
 
-    print("\n--- Select LLM for current session ---")
-    llm_choice = input("Use Ollama (default) or Claude? (ollama/claude): ").lower().strip()
+    return current_project_output_dir, user_initial_idea_content
+
+
+def resolve_llm_choice(llm_choice: str, session_id: str = "default") -> str:
+    """
+    Validates the LLM choice (defaulting to Ollama) and, for Claude, retrieves the API key
+    via SecretsMCP if it is not set. Falls back to Ollama if the key cannot be retrieved.
+    """
+    global CLAUDE_API_KEY
     if llm_choice not in ["ollama", "claude"]:
         print("Invalid LLM choice. Defaulting to Ollama.")
         llm_choice = "ollama"
 
     if llm_choice == "claude" and not CLAUDE_API_KEY:
         print("Claude API Key not set. Attempting to retrieve via SecretsMCP.")
+        # Usually already prefetched by _run_workflow_session; the key stays in memory (not os.environ)
         secrets_result = call_mcp("SecretsMCP", {"secret_name": "ANTHROPIC_API_KEY"})
         if secrets_result.get("status") == "success" and secrets_result.get("value"):
-            os.environ["ANTHROPIC_API_KEY"] = secrets_result["value"]
-            global CLAUDE_API_KEY
             CLAUDE_API_KEY = secrets_result["value"]
             print("Claude API Key successfully retrieved.")
         else:
             print("Failed to retrieve Claude API Key. Falling back to Ollama.")
+            log_event("LLM_FALLBACK", "Claude API Key could not be retrieved; using Ollama.", session_id=session_id)
             llm_choice = "ollama"
+    return llm_choice
+
+
+# Maximum number of agents fan_out_agents runs at the same time.
+FAN_OUT_WORKERS = int(os.getenv("AI_RAILS_FAN_OUT_WORKERS", "4"))
+
+
+def fan_out_agents(agents: list, project_output_path: Path, session_id: str, llm_choice: str, llm_cache: LLMResponseCache = None, approval=None, workers: int = FAN_OUT_WORKERS) -> Path:
+    """
+    Runs several agents concurrently, e.g. the Unit Tester, Documentation and Code Review
+    agents over the same plan. agents is a list of (agent role, template filename, input
+    content). Their tool requests go through one ApprovalQueue around `approval`; each
+    agent writes its usual output files, and a combined summary with every agent's final
+    response is written to the project directory. Returns the summary's path.
+    """
+    console = ParallelConsole()
+    queue = ApprovalQueue(approval or INTERACTIVE_APPROVAL, console)
+    roles = [agent_role for agent_role, _, _ in agents]
+    log_event("FAN_OUT_START", f"Running {len(agents)} agents in parallel: {', '.join(roles)}.", session_id=session_id)
+    print(f"\n--- Running in parallel: {', '.join(roles)} ---")
+
+    def run(agent_role: str, agent_template_filename: str, user_input_content: str) -> dict:
+        started = time.perf_counter()
+        try:
+            with console.agent(agent_role):
+                response = engage_agent(
+                    agent_role=agent_role,
+                    agent_template_filename=agent_template_filename,
+                    user_input_content=user_input_content,
+                    project_output_path=project_output_path,
+                    session_id=session_id,
+                    llm_choice=llm_choice,
+                    llm_cache=llm_cache,
+                    approval=queue
+                )
+            status = "completed" if response else "no response"
+        except Exception as e:
+            log_event("ERROR", f"{agent_role} failed during parallel run: {e}", agent_role=agent_role, session_id=session_id)
+            response, status = "", f"failed: {e}"
+        return {"agent_role": agent_role, "status": status, "duration_s": round(time.perf_counter() - started, 1), "response": response or ""}
+
+    started = time.perf_counter()
+    with console.active(), ThreadPoolExecutor(max_workers=max(1, min(workers, len(agents))), thread_name_prefix="ai-rails-fan-out") as pool:
+        # Each agent runs in a copy of the caller's context (session log file, metrics session)
+        futures = [pool.submit(contextvars.copy_context().run, run, *agent) for agent in agents]
+        results = [future.result() for future in futures]
+    elapsed = round(time.perf_counter() - started, 1)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    summary_path = project_output_path / f"parallel_run_summary_{timestamp}.md"
+    lines = [f"# Parallel Agent Run ({timestamp})", "", f"Wall time: {elapsed}s for {len(results)} agents "
+             f"({sum(r['duration_s'] for r in results):.1f}s if run one after another).", "",
+             "| Agent | Status | Duration |", "| --- | --- | --- |"]
+    lines += [f"| {r['agent_role']} | {r['status']} | {r['duration_s']}s |" for r in results]
+    for result in results:
+        lines += ["", f"## {result['agent_role']}", "", result["response"].strip() or "_No response._"]
+    try:
+        with open(summary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    except IOError as e:
+        log_event("ERROR", f"Failed to write parallel run summary: {e}", session_id=session_id)
+        print(f"Error writing parallel run summary: {e}")
 
+    log_event("FAN_OUT_END", f"Parallel run of {len(results)} agents finished in {elapsed}s.", session_id=session_id,
+              details={"summary": str(summary_path), "agents": [{k: v for k, v in r.items() if k != "response"} for r in results]})
+    print(f"\n--- Parallel run finished in {elapsed}s. Combined summary: {summary_path} ---")
+    return summary_path
+
+
+def _ask(prompt: str) -> str:
+    """input() for the workflow's own prompts; in a checkpointed session the answers are replayed on resume."""
+    checkpoint = session_checkpoint.current()
+    recorded = checkpoint.replay(session_checkpoint.MAIN_STREAM, "input", prompt) if checkpoint else None
+    if recorded is not None:
+        print(f"{prompt}{recorded['answer']}  (replayed from checkpoint)")
+        return recorded["answer"]
+    answer = input(prompt)
+    if checkpoint:
+        checkpoint.record(session_checkpoint.MAIN_STREAM, "input", prompt, answer=answer)
+    return answer
+
+
+def main_workflow_loop(
+    project_name: str,
+    workflow_type: str, # "new_project" or "feature_update" or "execution"
+    plan_path: Path = None, # Only for execution phase
+    use_llm_cache: bool = None, # Defaults to whether workflow_type is in AI_RAILS_LLM_CACHE_WORKFLOWS
+    checkpoint: SessionCheckpoint = None # Given by resume_workflow to continue an interrupted session
+):
+    if checkpoint is not None:
+        session_id = checkpoint.session_id
+        log_event("WORKFLOW_RESUMED", f"AI Rails workflow resumed for {project_name} ({workflow_type}) from {checkpoint.path}.", session_id=session_id)
+    else:
+        session_id = new_session_id()
+        log_event("WORKFLOW_START", f"AI Rails workflow started for {project_name} ({workflow_type}).", session_id=session_id)
+        if CHECKPOINTS_ENABLED:
+            _prune_checkpoints(session_id)
+            params = {"project_name": project_name, "workflow_type": workflow_type, "plan_path": str(plan_path) if plan_path else None}
+            try:
+                checkpoint = SessionCheckpoint.create(session_id, params)
+                print(f"Session {session_id} is checkpointed. If it is interrupted, continue it with: python3 ai_rails_backend.py --resume {session_id}")
+            except OSError as e:
+                log_event("ERROR", f"Failed to create session checkpoint: {e}", session_id=session_id)
+                print(f"Warning: could not create a session checkpoint ({e}); this session cannot be resumed.")
+
+    try:
+        with session_checkpoint.checkpoint_context(checkpoint):
+            quit_requested = _run_workflow_session(project_name, workflow_type, session_id, plan_path, use_llm_cache)
+        if checkpoint is not None:
+            # Finished normally or quit (not interrupted): nothing left to resume
+            checkpoint.complete()
+            log_event("CHECKPOINT_COMPLETE", f"Session checkpoint {checkpoint.path.name} marked complete.", session_id=session_id)
+    finally:
+        secrets_client.clear_all()
+    if quit_requested:
+        sys.exit(0)
+
+
+def _prune_checkpoints(session_id: str = "default"):
+    """Deletes completed and expired session checkpoints (see session_checkpoint.prune_checkpoints)."""
+    deleted = session_checkpoint.prune_checkpoints()
+    if deleted:
+        log_event("CHECKPOINTS_PRUNED", f"Deleted {deleted} completed or expired session checkpoint(s).", session_id=session_id,
+                  details={"retention_days": session_checkpoint.CHECKPOINT_RETENTION_DAYS})
+
+
+def resume_workflow(session_id: str):
+    """
+    Continues an interrupted main_workflow_loop session from its checkpoint: the answers,
+    agent turns and tool results recorded so far are replayed, then the session goes on live.
+    """
+    try:
+        checkpoint = SessionCheckpoint.load(session_id)
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load the checkpoint of session {session_id}: {e}")
+        return False
+    if checkpoint.completed:
+        print(f"Session {session_id} finished normally; there is nothing to resume.")
+        return False
+    params = checkpoint.params
+    plan_path = Path(params["plan_path"]) if params.get("plan_path") else None
+    print(f"Resuming session {session_id}: {params['project_name']} ({params['workflow_type']}).")
+    main_workflow_loop(params["project_name"], params["workflow_type"], plan_path, checkpoint=checkpoint)
+    return True
+
+
+def _run_workflow_session(project_name: str, workflow_type: str, session_id: str, plan_path: Path = None, use_llm_cache: bool = None) -> bool:
+    """Runs the session's prompts and agents; returns True if the user chose to quit AI Rails."""
+    # Fetch the session's secrets (e.g. the Claude API key) while the human answers the prompts below
+    if secrets_client.prefetch_session_secrets() is not None:
+        log_event("SECRETS_PREFETCH", "Prefetching session secrets from SecretsMCP.", session_id=session_id,
+                  details={"secret_names": [name for name in secrets_client.SECRETS_PREFETCH if not os.getenv(name)]})
+
+    if use_llm_cache is None:
+        use_llm_cache = workflow_type in LLM_CACHE_WORKFLOWS
+    llm_cache = LLMResponseCache() if use_llm_cache else None
+    if llm_cache:
+        log_event("LLM_CACHE_ENABLED", f"LLM response cache enabled at {llm_cache.cache_dir}.", session_id=session_id)
+
+    prepared = prepare_workflow(project_name, workflow_type, session_id, plan_path)
+    if prepared is None:
+        return False
+    current_project_output_dir, user_initial_idea_content = prepared
+
+    print("\n--- Select LLM for current session ---")
+    llm_choice = resolve_llm_choice(_ask("Use Ollama (default) or Claude? (ollama/claude): ").lower().strip(), session_id)
+    approval = default_approval(session_id)
 
     if workflow_type in ["new_project", "feature_update"]:
         # Engage Planning Agent
+        agent_role, agent_template_filename = PLANNING_AGENT
         engage_agent(
-            agent_role="Planning Agent",
-            agent_template_filename="planning_agent_system_prompt.md",
+            agent_role=agent_role,
+            agent_template_filename=agent_template_filename,
             user_input_content=user_initial_idea_content,
             project_output_path=current_project_output_dir,
             session_id=session_id,
-            llm_choice=llm_choice
+            llm_choice=llm_choice,
+            llm_cache=llm_cache,
+            approval=approval
         )
         print(f"\nPlanning session for {project_name} complete. Review output in {current_project_output_dir}")
         print("You can now enter the Execution Phase or refine the plan manually.")
@@ -451,115 +1750,85 @@ def main_workflow_loop(
         # Loop for execution phase actions
         while True:
             print("\n--- Execution Actions ---")
-            print("A) Engage Coder Agent")
-            print("B) Engage Unit Tester Agent")
-            print("C) Engage Debugger Agent")
-            print("D) Engage Documentation Agent")
-            print("E) Engage Code Review Agent")
-            print("F) Engage Refactor Agent")
-            print("G) Engage n8n Flow Creator Agent") # New agent
+            for key, (agent_role, _) in EXECUTION_AGENTS.items():
+                print(f"{key.upper()}) Engage {agent_role}")
+            print("P) Engage several agents in parallel")
             print("M) Back to Main Menu")
             print("Q) Quit AI Rails")
-            exec_choice = input("Choose an action: ").lower().strip()
+            exec_choice = _ask("Choose an action: ").lower().strip()
 
-            if exec_choice == "a":
-                # Coder Agent
-                engage_agent(
-                    agent_role="Coder Agent",
-                    agent_template_filename="coder_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # The plan content
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "b":
-                # Unit Tester Agent
-                engage_agent(
-                    agent_role="Unit Tester Agent",
-                    agent_template_filename="unit_tester_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # The plan content
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "c":
-                # Debugger Agent
-                engage_agent(
-                    agent_role="Debugger Agent",
-                    agent_template_filename="debugger_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # Context for debugging
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "d":
-                # Documentation Agent
-                engage_agent(
-                    agent_role="Documentation Agent",
-                    agent_template_filename="documentation_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # Code/plan for docs
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "e":
-                # Code Review Agent
-                engage_agent(
-                    agent_role="Code Review Agent",
-                    agent_template_filename="code_review_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # Code for review
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "f":
-                # Refactor Agent
-                engage_agent(
-                    agent_role="Refactor Agent",
-                    agent_template_filename="refactor_agent_system_prompt.md",
-                    user_input_content=user_initial_idea_content, # Code for refactoring
-                    project_output_path=current_project_output_dir,
-                    session_id=session_id,
-                    llm_choice=llm_choice
-                )
-            elif exec_choice == "g":
-                # n8n Flow Creator Agent
-                # For this agent, the 'user_input_content' would be the 'n8n Automation Request'
-                # For now, let's just use the main plan as input. You might want to
-                # prompt the user for a specific n8n automation request here.
-                print("\n--- Engaging n8n Flow Creator Agent ---")
-                n8n_request_input = input("Please provide a natural language description of the n8n automation you need: ")
+            if exec_choice == "p":
+                keys = []
+                for key in _ask("Agents to run in parallel (letters, e.g. b,d,e): ").lower().replace(" ", "").split(","):
+                    if key in EXECUTION_AGENTS and key not in keys:
+                        keys.append(key)
+                if len(keys) < 2:
+                    print("Please choose at least two different agents.")
+                    continue
+                agents = []
+                for key in keys:
+                    agent_role, agent_template_filename = EXECUTION_AGENTS[key]
+                    user_input_content = user_initial_idea_content
+                    if key == "g":
+                        user_input_content = _ask("Please provide a natural language description of the n8n automation you need: ")
+                    agents.append((agent_role, agent_template_filename, user_input_content))
+                fan_out_agents(agents, current_project_output_dir, session_id, llm_choice, llm_cache, approval)
+
+            elif exec_choice in EXECUTION_AGENTS:
+                agent_role, agent_template_filename = EXECUTION_AGENTS[exec_choice]
+                # The plan content is the input for every execution agent, except the
+                # n8n Flow Creator, which takes a specific automation request.
+                user_input_content = user_initial_idea_content
+                if exec_choice == "g":
+                    print("\n--- Engaging n8n Flow Creator Agent ---")
+                    user_input_content = _ask("Please provide a natural language description of the n8n automation you need: ")
                 engage_agent(
-                    agent_role="n8n Flow Creator Agent",
-                    agent_template_filename="n8n_flow_creator_agent_system_prompt.md",
-                    user_input_content=n8n_request_input,
+                    agent_role=agent_role,
+                    agent_template_filename=agent_template_filename,
+                    user_input_content=user_input_content,
                     project_output_path=current_project_output_dir,
                     session_id=session_id,
-                    llm_choice=llm_choice
+                    llm_choice=llm_choice,
+                    llm_cache=llm_cache,
+                    approval=approval
                 )
 
             elif exec_choice == "m":
                 log_event("WORKFLOW_STATE_CHANGE", "Returning to Main Menu.", session_id=session_id)
                 break
             elif exec_choice == "q":
+                _log_workflow_stats(session_id, llm_cache)
                 log_event("WORKFLOW_END", "AI Rails workflow quit.", session_id=session_id)
-                sys.exit(0)
+                return True
             else:
                 print("Invalid choice. Please try again.")
 
+    _log_workflow_stats(session_id, llm_cache)
     log_event("WORKFLOW_END", f"AI Rails workflow ended for {project_name} ({workflow_type}).", session_id=session_id)
+    return False
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="AI Rails backend, usually launched by run_workflow.sh.")
+    parser.add_argument("project_name", nargs="?", help="Project (or feature) name")
+    parser.add_argument("workflow_type", nargs="?", choices=["new_project", "feature_update", "execution"], help="Workflow to run")
+    parser.add_argument("plan_path", nargs="?", type=Path, help="Plan file (execution phase only)")
+    parser.add_argument("--resume", metavar="SESSION_ID", help="Continue an interrupted session from its checkpoint")
+    parser.add_argument("--list-checkpoints", action="store_true", help="List the sessions that can be resumed")
+    args = parser.parse_args(argv)
+
+    if args.list_checkpoints:
+        _prune_checkpoints()
+        for session_id, params in session_checkpoint.list_checkpoints():
+            print(f"{session_id}  {params.get('project_name')} ({params.get('workflow_type')})")
+        return 0
+    if args.resume:
+        return 0 if resume_workflow(args.resume) else 1
+    if not args.project_name or not args.workflow_type:
+        print("Please use run_workflow.sh to start the AI Rails system.")
+        return 1
+    main_workflow_loop(args.project_name, args.workflow_type, args.plan_path)
+    return 0
+
 
 if __name__ == "__main__":
-    # This block will be used if ai_rails_backend.py is run directly for testing.
-    # When integrated with run_workflow.sh, main_workflow_loop will be called directly.
-    print("This script is usually called by run_workflow.sh. Running in standalone test mode.")
-    # Example: Simulating a new project kickoff
-    # main_workflow_loop(project_name="test-project", workflow_type="new_project")
-
-    # Example: Simulating an execution phase
-    # Assuming 'my-test-plan.md' exists in output/execution_plans/my-test-project/
-    # test_plan_path = OUTPUT_DIR / "execution_plans" / "my-test-project" / "my-test-plan.md"
-    # main_workflow_loop(project_name="my-test-project", workflow_type="execution", plan_path=test_plan_path)
-
-    # For now, just a placeholder. The real entry point will be run_workflow.sh
-    print("Please use run_workflow.sh to start the AI Rails system.")
\ No newline at end of file
+    sys.exit(main())
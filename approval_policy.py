@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import fnmatch
+import threading
+from pathlib import Path
+
+# --- Configuration Section: Approval Policy ---
+# A declarative policy that decides tool requests without asking the human, so harmless
+# read-only lookups no longer stall a session on input(). The policy is a JSON file:
+#
+#   {
+#     "default": "escalate",
+#     "rules": [
+#       {"name": "read-only lookups", "tools": ["CodebaseSummaryMCP", "Context7"], "decision": "approve"},
+#       {"name": "no n8n from reviewers", "tools": ["n8n_automation"],
+#        "agent_roles": ["Code Review Agent"], "decision": "deny", "reason": "Reviewers do not trigger automations."},
+#       {"name": "project defaults", "tools": ["SecretsMCP"],
+#        "parameters": {"secret_name": "DEFAULT_.*"}, "decision": "approve"}
+#     ]
+#   }
+#
+# Rules are checked in order and the first match wins; "default" applies when none match.
+#   - tools:       tool names or glob patterns (default: every tool)
+#   - agent_roles: agent roles or glob patterns (default: every role)
+#   - parameters:  {parameter: regex}; every regex must match the whole parameter value.
+#                  Nested parameters are addressed with dots, e.g. "data.branch".
+#   - decision:    "approve", "deny" or "escalate" (ask the human)
+#
+# Requests for a secret in SENSITIVE_SECRETS always escalate, whatever the rules say.
+# The file is loaded and its patterns compiled once per process (see load_policy).
+
+APPROVAL_POLICY_FILE = os.getenv("AI_RAILS_APPROVAL_POLICY", "")
+
+DECISIONS = ("approve", "deny", "escalate")
+
+_MISSING = object()
+
+
+def _compile_globs(patterns: list):
+    """Compiles a list of names/glob patterns into one regex, or None for 'match anything'."""
+    if not patterns or "*" in patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+def _lookup(parameters: dict, dotted_key: str):
+    value = parameters
+    for part in dotted_key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+class PolicyRule:
+    """One compiled policy rule."""
+
+    def __init__(self, spec: dict, index: int):
+        self.name = spec.get("name") or f"rule {index}"
+        self.decision = spec.get("decision")
+        if self.decision not in DECISIONS:
+            raise ValueError(f"Approval policy {self.name}: decision must be one of {', '.join(DECISIONS)}.")
+        self.reason = spec.get("reason", "")
+        self._tools = _compile_globs(spec.get("tools"))
+        self._roles = _compile_globs(spec.get("agent_roles"))
+        try:
+            self._parameters = [(key, re.compile(pattern)) for key, pattern in (spec.get("parameters") or {}).items()]
+        except re.error as e:
+            raise ValueError(f"Approval policy {self.name}: invalid parameter pattern: {e}")
+
+    def matches(self, tool_name: str, agent_role: str, parameters: dict) -> bool:
+        if self._tools and not self._tools.fullmatch(tool_name or ""):
+            return False
+        if self._roles and not self._roles.fullmatch(agent_role or ""):
+            return False
+        for key, pattern in self._parameters:
+            value = _lookup(parameters, key)
+            if value is _MISSING:
+                return False
+            text = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+            if not pattern.fullmatch(text):
+                return False
+        return True
+
+
+class ApprovalPolicy:
+    """A loaded policy: ordered, precompiled rules plus a default decision."""
+
+    def __init__(self, spec: dict, source: str = "<inline>"):
+        self.source = source
+        self.default = spec.get("default", "escalate")
+        if self.default not in DECISIONS:
+            raise ValueError(f"Approval policy default must be one of {', '.join(DECISIONS)}.")
+        self.rules = [PolicyRule(rule, index) for index, rule in enumerate(spec.get("rules", []), start=1)]
+
+    def evaluate(self, tool_name: str, agent_role: str, parameters: dict, sensitive: bool = False) -> tuple:
+        """Returns (decision, rule name, reason) for one tool request."""
+        if sensitive:
+            return "escalate", "sensitive secret", "Sensitive secrets always require human approval."
+        for rule in self.rules:
+            if rule.matches(tool_name, agent_role, parameters or {}):
+                return rule.decision, rule.name, rule.reason
+        return self.default, "default", ""
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def load_policy(policy_file: Path) -> ApprovalPolicy:
+    """
+    Loads and compiles a policy file once per process.
+    Raises OSError/ValueError (including JSON errors) if it cannot be used.
+    """
+    key = str(Path(policy_file).resolve())
+    with _policies_lock:
+        policy = _policies.get(key)
+        if policy is None:
+            with open(policy_file, "r") as f:
+                policy = ApprovalPolicy(json.load(f), source=key)
+            _policies[key] = policy
+        return policy
+
+
+class PolicyApproval:
+    """
+    Approval handler that applies an ApprovalPolicy and hands escalated requests to a
+    fallback handler: the human (InteractiveApproval) in interactive sessions, or a
+    headless handler that denies them in batch mode.
+    Every decision is logged: AUTO_DECISION for rule decisions, ESCALATED for the rest.
+    """
+
+    decided_by = "policy"
+    logs_decisions = True
+
+    def __init__(self, policy: ApprovalPolicy, fallback, log_event):
+        self.policy = policy
+        self.fallback = fallback
+        self._log_event = log_event
+        self._last = threading.local()
+
+    def approve(self, agent_role: str, tool_requests: list, sensitive: list, session_id: str) -> set:
+        approved, escalated, reasons = set(), [], []
+        for index, tool_request in enumerate(tool_requests):
+            tool_name = tool_request.get("tool_name")
+            decision, rule_name, reason = self.policy.evaluate(tool_name, agent_role, tool_request.get("parameters", {}), sensitive[index])
+            details = {"tool_name": tool_name, "rule": rule_name, "decision": decision, "policy": self.policy.source}
+            if decision == "escalate":
+                escalated.append(index)
+                self._log_event("ESCALATED", f"Approval policy escalated tool request for {tool_name} ({rule_name}).", agent_role="Orchestrator", session_id=session_id, details=details)
+                continue
+            self._log_event("AUTO_DECISION", f"Approval policy {'approved' if decision == 'approve' else 'denied'} tool request for {tool_name} ({rule_name}).", agent_role="Orchestrator", session_id=session_id, details=details)
+            if decision == "approve":
+                approved.add(index)
+            else:
+                reasons.append(f"{tool_name}: denied by policy rule '{rule_name}'" + (f" ({reason})" if reason else ""))
+
+        escalated_approved = set()
+        if escalated:
+            subset = [tool_requests[i] for i in escalated]
+            print(f"\nThe approval policy escalated {len(escalated)} of {len(tool_requests)} tool request(s) to you:")
+            for position, index in enumerate(escalated, start=1):
+                print(f"  {position}) Tool Request {index + 1}: {tool_requests[index].get('tool_name')}")
+            chosen = self.fallback.approve(agent_role, subset, [sensitive[i] for i in escalated], session_id)
+            escalated_approved = {escalated[i] for i in chosen}
+            for position, index in enumerate(escalated):
+                decision = "approved" if position in chosen else "denied"
+                self._log_event("HUMAN_DECISION" if self.fallback.decided_by == "human" else "AUTO_DECISION",
+                                f"{'Human' if self.fallback.decided_by == 'human' else 'Fallback'} {decision} escalated tool request for {tool_requests[index].get('tool_name')}.",
+                                agent_role="Orchestrator", session_id=session_id, details={"tool_name": tool_requests[index].get("tool_name")})
+        self._last.reasons = reasons
+        self._last.escalated = bool(escalated)
+        return approved | escalated_approved
+
+    def feedback(self, agent_role: str, tool_requests: list, session_id: str) -> str:
+        if getattr(self._last, "escalated", False):
+            # The fallback (e.g. the human) denied what the policy escalated; let it explain
+            reasons = getattr(self._last, "reasons", [])
+            feedback = self.fallback.feedback(agent_role, tool_requests, session_id)
+            return "; ".join(reasons + [feedback]) if reasons else feedback
+        return "; ".join(getattr(self._last, "reasons", [])) or "Denied by approval policy."
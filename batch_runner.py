@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import metrics
+import secrets_client
+import ai_rails_backend as backend
+from ai_rails_backend import log_event
+from llm_cache import LLMResponseCache, LLM_CACHE_WORKFLOWS
+from approval_policy import APPROVAL_POLICY_FILE, PolicyApproval, load_policy
+
+# --- Configuration Section: Headless Batch Mode ---
+# Runs many planning/execution sessions unattended, e.g. overnight planning for a list of
+# feature ideas. Jobs are read from a JSON file and run concurrently on a bounded thread
+# pool (the work is network-bound: LLM and MCP calls). No job ever waits on input():
+# tool requests are decided by the job's approval mode, and each job gets
+#   - its own session id and project output directory,
+#   - output/batch_runs/<batch id>/<job name>/session.log (the job's events, JSONL), and
+#   - output/batch_runs/<batch id>/<job name>/console.log (everything the job printed).
+#
+# Jobs file (a list of jobs, or {"defaults": {...}, "jobs": [...]}):
+#   {
+#     "defaults": {"workflow_type": "feature_update", "llm": "ollama", "approval": "deny"},
+#     "jobs": [
+#       {"project": "infinite-scroll", "idea_file": "ideas/infinite-scroll.md"},
+#       {"project": "my-app", "workflow_type": "execution", "plan_path": "plans/my-app.md",
+#        "agents": ["coder", "unit_tester"]},
+#       {"project": "billing-api", "workflow_type": "execution", "plan_path": "plans/billing-api.md",
+#        "agents": ["unit_tester", "documentation", "code_review"], "parallel": true}
+#     ]
+#   }
+# Relative paths are resolved against the jobs file's directory. Jobs must not share a
+# workflow type and project (they would write to the same output directory); list all the
+# agents of one project in one job instead. Execution jobs with "parallel": true run their
+# agents concurrently (see fan_out_agents in ai_rails_backend.py), each agent's console
+# output prefixed with its role.
+#
+# Usage:
+#   python batch_runner.py jobs.json [--workers 4]
+
+BATCH_WORKERS = int(os.getenv("AI_RAILS_BATCH_WORKERS", "4"))
+BATCH_RUNS_DIR = backend.OUTPUT_DIR / "batch_runs"
+
+WORKFLOW_TYPES = ["new_project", "feature_update", "execution"]
+
+# Idea file each planning workflow reads from its project output directory.
+IDEA_FILENAMES = {
+    "new_project": "initial_project_idea.md",
+    "feature_update": "feature_update_idea.md",
+}
+
+# How tool requests are decided without a human:
+#   deny                  - deny every request; the agent continues without tools (default)
+#   approve_non_sensitive - approve every request except SENSITIVE_SECRETS, which are denied
+#   policy                - decide by the job's "approval_policy" file (default:
+#                           AI_RAILS_APPROVAL_POLICY); requests it escalates are denied
+APPROVAL_MODES = ["deny", "approve_non_sensitive", "policy"]
+
+
+class HeadlessApproval:
+    """Approval handler for unattended runs (see InteractiveApproval in ai_rails_backend.py)."""
+
+    decided_by = "policy"
+
+    def __init__(self, mode: str):
+        self.mode = mode
+
+    def approve(self, agent_role: str, tool_requests: list, sensitive: list, session_id: str) -> set:
+        if self.mode == "approve_non_sensitive":
+            # Sensitive secrets need a human, and there is none in batch mode
+            return {index for index, is_sensitive in enumerate(sensitive) if not is_sensitive}
+        return set()
+
+    def feedback(self, agent_role: str, tool_requests: list, session_id: str) -> str:
+        return (f"Tool requests are denied in headless batch mode (approval mode '{self.mode}'). "
+                "Continue with the information you have and note any open questions in your output.")
+
+
+def _agent_slug(agent_role: str) -> str:
+    return agent_role.lower().replace(" agent", "").replace(" ", "_")
+
+
+def _resolve_agent(name: str):
+    """Maps an agent slug ("unit_tester") or role ("Unit Tester Agent") to its EXECUTION_AGENTS entry."""
+    for key, (agent_role, template) in backend.EXECUTION_AGENTS.items():
+        if name.strip().lower() in (_agent_slug(agent_role), agent_role.lower()):
+            return key, agent_role, template
+    raise ValueError(f"Unknown execution agent '{name}'. Known agents: {', '.join(_agent_slug(r) for r, _ in backend.EXECUTION_AGENTS.values())}")
+
+
+def load_jobs(jobs_file: Path) -> list:
+    """Reads and validates a jobs file. Raises ValueError describing the first invalid job."""
+    jobs_file = Path(jobs_file)
+    with open(jobs_file, "r") as f:
+        data = json.load(f)
+    defaults, raw_jobs = ({}, data) if isinstance(data, list) else (data.get("defaults", {}), data.get("jobs", []))
+    base_dir = jobs_file.parent.resolve()
+
+    def resolve_path(value):
+        if not value:
+            return None
+        path = Path(value).expanduser()
+        return path if path.is_absolute() else base_dir / path
+
+    jobs = []
+    seen = set()
+    for index, raw_job in enumerate(raw_jobs, start=1):
+        job = {"workflow_type": "new_project", "llm": "ollama", "approval": "deny", **defaults, **raw_job}
+        label = f"Job {index} ({job.get('project', '?')})"
+        if not job.get("project"):
+            raise ValueError(f"Job {index}: 'project' is required.")
+        if job["workflow_type"] not in WORKFLOW_TYPES:
+            raise ValueError(f"{label}: workflow_type must be one of {', '.join(WORKFLOW_TYPES)}.")
+        if job["approval"] not in APPROVAL_MODES:
+            raise ValueError(f"{label}: approval must be one of {', '.join(APPROVAL_MODES)}.")
+        if (job["workflow_type"], job["project"]) in seen:
+            raise ValueError(f"{label}: another job already writes to {job['workflow_type']}_plans/{job['project']}.")
+        seen.add((job["workflow_type"], job["project"]))
+        if job["approval"] == "policy":
+            policy_file = resolve_path(job.get("approval_policy")) or (Path(APPROVAL_POLICY_FILE) if APPROVAL_POLICY_FILE else None)
+            if not policy_file:
+                raise ValueError(f"{label}: approval 'policy' needs an 'approval_policy' file or AI_RAILS_APPROVAL_POLICY.")
+            try:
+                job["approval_policy"] = load_policy(policy_file)
+            except (OSError, ValueError) as e:
+                raise ValueError(f"{label}: invalid approval policy {policy_file}: {e}")
+
+        job["name"] = job.get("name") or f"{job['workflow_type']}-{job['project']}"
+        job["idea_file"] = resolve_path(job.get("idea_file"))
+        job["plan_path"] = resolve_path(job.get("plan_path"))
+        if job["idea_file"] and not job["idea_file"].exists():
+            raise ValueError(f"{label}: idea_file {job['idea_file']} does not exist.")
+        if job["workflow_type"] == "execution":
+            if not job["plan_path"] or not job["plan_path"].exists():
+                raise ValueError(f"{label}: execution jobs need an existing plan_path.")
+            job["agents"] = [_resolve_agent(name) for name in job.get("agents", [])]
+            if not job["agents"]:
+                raise ValueError(f"{label}: execution jobs need a non-empty 'agents' list.")
+            if any(key == "g" for key, _, _ in job["agents"]) and not job.get("n8n_request"):
+                raise ValueError(f"{label}: the n8n Flow Creator agent needs an 'n8n_request'.")
+        jobs.append(job)
+    return jobs
+
+
+# --- Per-job console output ---
+_console_file = contextvars.ContextVar("ai_rails_batch_console", default=None)
+
+
+class _ContextRoutedStdout:
+    """sys.stdout replacement that sends each job's prints to its own console.log."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def write(self, text: str) -> int:
+        target = _console_file.get() or self.fallback
+        return target.write(text)
+
+    def flush(self):
+        target = _console_file.get() or self.fallback
+        target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+@contextmanager
+def _job_console(path: Path):
+    with open(path, "a", buffering=1) as console:
+        token = _console_file.set(console)
+        try:
+            yield
+        finally:
+            _console_file.reset(token)
+
+
+# --- Running Jobs ---
+def run_job(job: dict, batch_dir: Path, index: int) -> dict:
+    """Runs one job to completion without any human interaction and returns its summary."""
+    job_dir = batch_dir / job["name"]
+    job_dir.mkdir(parents=True, exist_ok=True)
+    session_id = backend.new_session_id(f"b{index:03d}")
+    result = {"name": job["name"], "project": job["project"], "workflow_type": job["workflow_type"],
+              "session_id": session_id, "status": "completed", "session_log": str(job_dir / "session.log")}
+    started = datetime.now()
+
+    with metrics.session_context(session_id), backend.session_log_file(job_dir / "session.log"), _job_console(job_dir / "console.log"):
+        log_event("WORKFLOW_START", f"Batch job {job['name']} started for {job['project']} ({job['workflow_type']}).", session_id=session_id, details={"batch": batch_dir.name, "approval": job["approval"], "llm": job["llm"]})
+        try:
+            result.update(_run_job_agents(job, session_id))
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+            log_event("ERROR", f"Batch job {job['name']} failed: {e}", session_id=session_id)
+            print(f"Batch job failed: {e}")
+        result["duration_s"] = round((datetime.now() - started).total_seconds(), 1)
+        log_event("WORKFLOW_END", f"Batch job {job['name']} {result['status']}.", session_id=session_id, details=result)
+    return result
+
+
+def _run_job_agents(job: dict, session_id: str) -> dict:
+    workflow_type = job["workflow_type"]
+    output_dir = backend.OUTPUT_DIR / f"{workflow_type}_plans" / job["project"]
+    if job["idea_file"] and workflow_type in IDEA_FILENAMES:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(job["idea_file"], output_dir / IDEA_FILENAMES[workflow_type])
+
+    prepared = backend.prepare_workflow(job["project"], workflow_type, session_id, job["plan_path"])
+    if prepared is None:
+        return {"status": "failed", "error": "workflow could not be prepared"}
+    output_dir, initial_content = prepared
+    if not initial_content.strip():
+        return {"status": "failed", "error": f"no idea or plan content found for {job['project']}", "output_dir": str(output_dir)}
+
+    use_llm_cache = job.get("use_llm_cache", workflow_type in LLM_CACHE_WORKFLOWS)
+    llm_cache = LLMResponseCache() if use_llm_cache else None
+    if job["approval"] == "policy":
+        approval = PolicyApproval(job["approval_policy"], HeadlessApproval("deny"), log_event)
+    else:
+        approval = HeadlessApproval(job["approval"])
+
+    if workflow_type == "execution":
+        agents = [(agent_role, template, job["n8n_request"] if key == "g" else initial_content) for key, agent_role, template in job["agents"]]
+    else:
+        agent_role, template = backend.PLANNING_AGENT
+        agents = [(agent_role, template, initial_content)]
+
+    if job.get("parallel") and len(agents) > 1:
+        backend.fan_out_agents(agents, output_dir, session_id, job["llm"], llm_cache, approval)
+        agents = []
+    for agent_role, template, user_input_content in agents:
+        backend.engage_agent(
+            agent_role=agent_role,
+            agent_template_filename=template,
+            user_input_content=user_input_content,
+            project_output_path=output_dir,
+            session_id=session_id,
+            llm_choice=job["llm"],
+            llm_cache=llm_cache,
+            approval=approval
+        )
+
+    backend._log_workflow_stats(session_id, llm_cache)
+    return {"output_dir": str(output_dir)}
+
+
+def run_batch(jobs: list, workers: int = BATCH_WORKERS) -> list:
+    """Runs jobs on a pool of at most `workers` threads. Returns the job summaries in job order."""
+    batch_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    batch_dir = BATCH_RUNS_DIR / batch_id
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    log_event("BATCH_START", f"Batch {batch_id} started with {len(jobs)} job(s) on {workers} worker(s).", details={"batch_dir": str(batch_dir)})
+
+    # Resolve Claude credentials once, before jobs run concurrently
+    if any(job["llm"] == "claude" for job in jobs):
+        if backend.resolve_llm_choice("claude") != "claude":
+            for job in jobs:
+                job["llm"] = "ollama"
+
+    results = [None] * len(jobs)
+    original_stdout = sys.stdout
+    sys.stdout = _ContextRoutedStdout(original_stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ai-rails-batch") as pool:
+            futures = {pool.submit(run_job, job, batch_dir, index): index for index, job in enumerate(jobs, start=1)}
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index - 1] = future.result()
+                result = results[index - 1]
+                print(f"[{index}/{len(jobs)}] {result['name']}: {result['status']} in {result['duration_s']}s")
+    finally:
+        sys.stdout = original_stdout
+        # Secrets fetched by the jobs stay in memory only while the batch runs
+        secrets_client.clear_all()
+
+    with open(batch_dir / "summary.json", "w") as f:
+        json.dump(results, f, indent=2)
+    failed = sum(1 for result in results if result["status"] != "completed")
+    log_event("BATCH_END", f"Batch {batch_id} finished: {len(jobs) - failed} completed, {failed} failed.", details={"batch_dir": str(batch_dir)})
+    print(f"\nBatch {batch_id}: {len(jobs) - failed} completed, {failed} failed. Summary: {batch_dir / 'summary.json'}")
+    return results
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Run AI Rails planning/execution workflows headlessly from a jobs file.")
+    parser.add_argument("jobs_file", type=Path, help="JSON jobs file")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Maximum concurrent jobs")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_jobs(args.jobs_file)
+    except (OSError, json.JSONDecodeError, ValueError) as e:
+        print(f"Error: invalid jobs file {args.jobs_file}: {e}")
+        return 1
+    if not jobs:
+        print("No jobs to run.")
+        return 0
+
+    results = run_batch(jobs, args.workers)
+    return 0 if all(result["status"] == "completed" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
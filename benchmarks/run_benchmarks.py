@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the AI Rails orchestrator.
+
+Starts the stub servers from stub_servers.py, points every Ollama, Anthropic and MCP
+URL at them, and drives call_mcp, the LLM clients and full engage_agent sessions
+through scripted multi-turn conversations. For each scenario it reports p50/p95/max
+latency, throughput and peak Python memory allocated, so regressions in the
+orchestrator itself show up without GPUs or network access.
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --iterations 50 --latency-ms 20 --token-delay-ms 2
+    python benchmarks/run_benchmarks.py --scenarios session_ollama,mcp_batch --json results.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import builtins
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+from pathlib import Path
+
+from stub_servers import StubConfig, StubServer
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# One representative request per call_mcp branch.
+MCP_SCENARIOS = {
+    "mcp_codebase_summary": ("CodebaseSummaryMCP", {"query": "Summarize the project structure.", "path": "."}),
+    "mcp_secrets": ("SecretsMCP", {"secret_name": "TEST_SECRET"}),
+    "mcp_sequential_thinking": ("MCP_Sequential_Thinking", {"problem": "Break down the benchmark task."}),
+    "mcp_context7": ("Context7", {"query": "requests Session keep-alive"}),
+    "mcp_brave_search": ("BraveSearchMCP", {"query": "python http keep-alive"}),
+    "mcp_n8n": ("n8n_automation", {"workflow_name": "benchmark-flow", "data": {"ping": True}}),
+}
+
+
+# Runs of each scenario under tracemalloc, after the timed ones, for peak_alloc_kb
+TRACED_ITERATIONS = 3
+
+
+def _configure_environment(stub_url: str, work_dir: Path):
+    """Points every service URL at the stub server. Must run before the orchestrator is imported."""
+    os.environ.update({
+        "OLLAMA_BASE_URL": stub_url,
+        "ANTHROPIC_API_URL": f"{stub_url}/v1/messages",
+        "ANTHROPIC_API_KEY": "benchmark-key",
+        "CODEBASE_SUMMARY_MCP_URL": stub_url,
+        "SECRETS_MCP_URL": stub_url,
+        "AI_RAILS_SECRETS_MCP_AUTH_TOKEN": "benchmark-token",
+        "MCP_SEQUENTIAL_THINKING_URL": stub_url,
+        "CONTEXT7_URL": stub_url,
+        "BRAVE_SEARCH_MCP_URL": stub_url,
+        "N8N_WEBHOOK_BASE_URL": f"{stub_url}/webhook/",
+        "AI_RAILS_LOG_ECHO": "false",
+        "AI_RAILS_METRICS_TEXTFILE": str(work_dir / "ai-rails.prom"),
+        "AI_RAILS_OUTPUT_STORE_DIR": str(work_dir / "objects"),
+        "AI_RAILS_DOCS_INDEX_PATH": str(work_dir / "docs.bm25"),
+        "AI_RAILS_CONTEXT7_BACKEND": "remote",  # the mcp_context7 scenario measures the HTTP path
+        "AI_RAILS_HTTP_MAX_RETRIES": "0",
+    })
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_scenario(name: str, func, iterations: int, warmup: int = 1) -> dict:
+    """
+    Runs func() iterations times and returns latency, throughput and memory figures.
+    Latencies are measured untraced; peak allocation comes from a few extra runs under
+    tracemalloc, which slows Python code several-fold and serializes threads on its lock.
+    """
+    for _ in range(warmup):
+        func()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    for _ in range(min(iterations, TRACED_ITERATIONS)):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "max_ms": round(max(latencies), 2),
+        "ops_per_sec": round(iterations / elapsed, 1) if elapsed else 0.0,
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def build_scenarios(backend, call_mcp_module, output_dir: Path, stream: bool) -> dict:
+    """Returns {scenario name: zero-argument callable} for every benchmark."""
+    scenarios = {}
+
+    def mcp_call(tool_name, parameters):
+        def run():
+            # Measure the dispatch path, not the tool result or secrets caches
+            call_mcp_module.TOOL_RESULT_CACHE.clear()
+            call_mcp_module.secrets_client.clear_all()
+            result = call_mcp_module.call_mcp(tool_name, parameters)
+            assert result.get("status") != "error", result
+        return run
+
+    for name, (tool_name, parameters) in MCP_SCENARIOS.items():
+        scenarios[name] = mcp_call(tool_name, parameters)
+
+    batch_requests = [MCP_SCENARIOS[name] for name in ("mcp_codebase_summary", "mcp_context7", "mcp_brave_search", "mcp_sequential_thinking")]
+
+    def mcp_batch():
+        call_mcp_module.TOOL_RESULT_CACHE.clear()
+        results = call_mcp_module.call_mcp_batch(batch_requests)
+        assert all(r.get("status") != "error" for r in results), results
+    scenarios["mcp_batch"] = mcp_batch
+
+    def mcp_batch_sequential():
+        # The same four calls one after another: the baseline mcp_batch should beat
+        call_mcp_module.TOOL_RESULT_CACHE.clear()
+        results = [call_mcp_module.call_mcp(tool_name, parameters) for tool_name, parameters in batch_requests]
+        assert all(r.get("status") != "error" for r in results), results
+    scenarios["mcp_batch_sequential"] = mcp_batch_sequential
+
+    def secrets_batch():
+        # Four secrets in one /get_secrets round trip, as prefetched at session start
+        call_mcp_module.secrets_client.clear_all()
+        results = call_mcp_module.secrets_client.get_client().get_many(["ANTHROPIC_API_KEY", "OPENAI_API_KEY", "GITHUB_TOKEN", "TEST_SECRET"])
+        assert all(r.get("status") == "success" for r in results.values()), results
+    scenarios["mcp_secrets_batch"] = secrets_batch
+
+    messages = [{"role": "user", "content": "--- ADDITIONAL CONTEXT ---\nBenchmark task.\n--------------------------"}]
+
+    def llm_call(call):
+        def run():
+            with open(output_dir / "llm_output.md", "w") as output_file:
+                response = call(messages, system_prompt="You are a benchmark agent.", stream=stream, output_file=output_file)
+            assert not response.startswith("Error:"), response
+        return run
+
+    scenarios["llm_ollama"] = llm_call(backend.call_ollama_chat)
+    scenarios["llm_claude"] = llm_call(backend.call_claude_chat)
+
+    def session(llm_choice):
+        def run():
+            call_mcp_module.TOOL_RESULT_CACHE.clear()
+            backend.engage_agent(
+                agent_role="Planning Agent",
+                agent_template_filename="planning_agent_system_prompt.md",
+                user_input_content="Benchmark project idea.",
+                project_output_path=output_dir,
+                session_id="benchmark",
+                llm_choice=llm_choice,
+            )
+        return run
+
+    scenarios["session_ollama"] = session("ollama")
+    scenarios["session_claude"] = session("claude")
+    return scenarios
+
+
+def print_report(results: list, server: StubServer):
+    headers = ["scenario", "iterations", "p50_ms", "p95_ms", "max_ms", "ops_per_sec", "peak_alloc_kb"]
+    widths = [max(len(h), *(len(str(r[h])) for r in results)) for h in headers]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    print("  ".join("-" * w for w in widths))
+    for result in results:
+        print("  ".join(str(result[h]).ljust(w) for h, w in zip(headers, widths)))
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+    print(f"\nProcess max RSS: {max_rss_mb:.1f} MB")
+    print(f"Stub requests served: {json.dumps(server.request_counts, sort_keys=True)}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the AI Rails orchestrator.")
+    parser.add_argument("--iterations", type=int, default=20, help="Measured iterations per scenario")
+    parser.add_argument("--scenarios", default="", help="Comma-separated scenario names (default: all)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Stub time to first byte per request")
+    parser.add_argument("--token-delay-ms", type=float, default=0.0, help="Stub delay per streamed chunk")
+    parser.add_argument("--response-tokens", type=int, default=200, help="Filler tokens per LLM reply")
+    parser.add_argument("--payload-kb", type=float, default=2.0, help="MCP response payload size")
+    parser.add_argument("--tool-turns", type=int, default=2, help="Agent turns that end with tool requests")
+    parser.add_argument("--tools-per-turn", type=int, default=2, help="tool_request blocks per such turn")
+    parser.add_argument("--no-stream", action="store_true", help="Benchmark the buffered (non-streaming) LLM path")
+    parser.add_argument("--json", type=Path, help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    config = StubConfig(
+        latency_ms=args.latency_ms,
+        token_delay_ms=args.token_delay_ms,
+        response_tokens=args.response_tokens,
+        mcp_payload_bytes=int(args.payload_kb * 1024),
+        tool_turns=args.tool_turns,
+        tools_per_turn=args.tools_per_turn,
+    )
+    server = StubServer(config).start()
+    work_dir = Path(tempfile.mkdtemp(prefix="ai-rails-bench-"))
+    _configure_environment(server.url, work_dir)
+    if args.no_stream:
+        os.environ["AI_RAILS_STREAM_RESPONSES"] = "false"
+
+    sys.path.insert(0, str(REPO_ROOT))
+    import ai_rails_backend as backend
+    import call_mcp as call_mcp_module
+    import log_writer
+    # Keep benchmark events out of the real log
+    backend.LOG_FILE = work_dir / "ai-rails.log"
+
+    scenarios = build_scenarios(backend, call_mcp_module, work_dir, stream=not args.no_stream)
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()] or list(scenarios)
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        parser.error(f"Unknown scenario(s): {', '.join(unknown)}. Available: {', '.join(scenarios)}")
+
+    results = []
+    original_input = builtins.input
+    # Approve every tool request; the orchestrator's console output is discarded
+    builtins.input = lambda prompt="": "yes"
+    try:
+        for name in selected:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.append(run_scenario(name, scenarios[name], args.iterations))
+    finally:
+        builtins.input = original_input
+        server.stop()
+        # Flush the log writer before removing the work dir, or it would recreate the log
+        log_writer.close_log_writer(backend.LOG_FILE)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results, server)
+    if args.json:
+        args.json.write_text(json.dumps({"config": vars(config), "results": results}, indent=2))
+        print(f"Results written to {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Stub LLM and MCP Servers for Offline Benchmarks ---
+# A single in-process HTTP server that answers every endpoint the orchestrator talks to:
+#   - Ollama:    POST /api/chat, POST /api/generate (NDJSON when streaming), GET /api/tags
+#   - Anthropic: POST /v1/messages (server-sent events when streaming)
+#   - MCPs:      POST /query, /get_secret, /get_secrets, /process, /search and /webhook/<workflow>
+#
+# Secrets are answered with secret_value(name), except StubConfig.missing_secrets, which
+# get an error response. StubConfig.get_secrets_status other than 200 makes /get_secrets
+# fail with that status, e.g. 404 for a SecretsMCP that has no batch endpoint.
+#
+# The Anthropic endpoint also emulates prompt caching: system blocks marked with
+# cache_control are reported as cache_creation_input_tokens the first time the server sees
+# them and as cache_read_input_tokens afterwards. The most recent POST bodies are kept in
+# StubServer.recent_requests so tests can check what the orchestrator sent.
+#
+# The LLM endpoints play a scripted agent: as long as the conversation holds fewer than
+# StubConfig.tool_turns tool results, the reply ends with tool_request block(s); after
+# that it is a plain final answer. Latency, token pacing and payload sizes are set
+# through StubConfig so benchmarks can isolate the orchestrator's own overhead. A
+# streamed reply can also pause for stall_ms after stall_after_chunks chunks, like a
+# host that hangs in the middle of a generation.
+
+FILLER_WORD = "lorem "
+TOOL_OUTPUT_MARKER = "--- PREVIOUS TOOL OUTPUT ---"
+
+
+class StubConfig:
+    """Behaviour of the stub servers; all delays are in milliseconds."""
+
+    def __init__(self, latency_ms: float = 0.0, token_delay_ms: float = 0.0, response_tokens: int = 200,
+                 chunk_tokens: int = 8, mcp_payload_bytes: int = 2048, tool_turns: int = 1,
+                 tools_per_turn: int = 1, ollama_models: tuple = ("qwen2.5-coder:32b",),
+                 missing_secrets: tuple = (), get_secrets_status: int = 200, stall_after_chunks: int = 0,
+                 stall_ms: float = 0.0):
+        self.latency_ms = latency_ms                # Added before every response (time to first byte)
+        self.token_delay_ms = token_delay_ms        # Added per streamed chunk
+        self.response_tokens = response_tokens      # Filler tokens per LLM reply
+        self.chunk_tokens = chunk_tokens            # Tokens per streamed chunk
+        self.mcp_payload_bytes = mcp_payload_bytes  # Size of the "result" field in MCP replies
+        self.tool_turns = tool_turns                # Replies that end with tool requests
+        self.tools_per_turn = tools_per_turn        # tool_request blocks per such reply
+        self.ollama_models = list(ollama_models)    # Models listed by GET /api/tags
+        self.missing_secrets = set(missing_secrets)  # Secrets answered with an error
+        self.get_secrets_status = get_secrets_status  # HTTP status of POST /get_secrets
+        self.stall_after_chunks = stall_after_chunks  # Streamed chunks sent before stalling (0: never)
+        self.stall_ms = stall_ms                    # How long a stalled stream pauses
+
+
+def secret_value(secret_name: str) -> str:
+    """The value the stub SecretsMCP returns for a secret."""
+    return f"stub-secret-{secret_name}-" + "x" * 16
+
+
+def _tool_request_block(index: int) -> str:
+    request = {
+        "type": "tool_request",
+        "tool_name": "Context7",
+        "parameters": {"query": f"benchmark query {index}"},
+        "explanation": "Benchmark tool request.",
+    }
+    return f"```json\n{json.dumps(request)}\n```\n"
+
+
+def scripted_reply(config: StubConfig, conversation_text: str) -> str:
+    """Returns the scripted agent reply for a conversation (see module comment)."""
+    tool_results_seen = conversation_text.count(TOOL_OUTPUT_MARKER)
+    text = FILLER_WORD * config.response_tokens
+    if tool_results_seen < config.tool_turns:
+        text += "\n" + "".join(_tool_request_block(tool_results_seen * config.tools_per_turn + i) for i in range(config.tools_per_turn))
+    else:
+        text += "\nFinal answer: benchmark complete.\n"
+    return text
+
+
+def _chunks(config: StubConfig, text: str) -> list:
+    """Splits a reply into streamed chunks of roughly chunk_tokens tokens."""
+    words = text.split(" ")
+    step = max(1, config.chunk_tokens)
+    return [" ".join(words[i:i + step]) + (" " if i + step < len(words) else "") for i in range(0, len(words), step)]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real services
+    # Headers and body go out in separate writes; without TCP_NODELAY every response would
+    # pay a delayed-ACK stall (~40 ms) that real servers do not have.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def config(self) -> StubConfig:
+        return self.server.config
+
+    def do_GET(self):
+        self.server.record(self.path)
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": name, "model": name} for name in self.config.ollama_models]})
+        else:
+            self._send_json({"status": "error", "message": f"Unknown stub endpoint {self.path}"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.server.record(self.path, body)
+        if self.config.latency_ms:
+            time.sleep(self.config.latency_ms / 1000)
+
+        try:
+            if self.path == "/api/chat":
+                self._ollama(body, "\n".join(m.get("content", "") for m in body.get("messages", []) if m.get("role") != "system"), chat=True)
+            elif self.path == "/api/generate":
+                self._ollama(body, body.get("prompt", ""), chat=False)
+            elif self.path == "/v1/messages":
+                self._anthropic(body)
+            elif self.path == "/get_secrets":
+                if self.config.get_secrets_status != 200:
+                    self._send_json({"status": "error", "message": "Batch lookups are not available"}, status=self.config.get_secrets_status)
+                else:
+                    self._send_json({"status": "success", "secrets": {name: self._secret(name) for name in body.get("secret_names", [])}})
+            elif self.path == "/get_secret":
+                self._send_json(self._secret(body.get("secret_name", "")))
+            elif self.path in ("/query", "/process", "/search") or self.path.startswith("/webhook/"):
+                self._send_json({"status": "success", "result": "x" * self.config.mcp_payload_bytes})
+            else:
+                self._send_json({"status": "error", "message": f"Unknown stub endpoint {self.path}"}, status=404)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early (stop on tool request)
+            self.close_connection = True
+
+    # --- Responses ---
+    def _secret(self, secret_name: str) -> dict:
+        if secret_name in self.config.missing_secrets:
+            return {"secret_name": secret_name, "status": "error", "message": f"Secret {secret_name} not found"}
+        return {"secret_name": secret_name, "value": secret_value(secret_name), "status": "success"}
+
+    def _send_json(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _pace(self, index: int = 0):
+        if self.config.token_delay_ms:
+            time.sleep(self.config.token_delay_ms / 1000)
+        if self.config.stall_after_chunks and index == self.config.stall_after_chunks:
+            time.sleep(self.config.stall_ms / 1000)
+
+    def _ollama(self, body: dict, conversation_text: str, chat: bool):
+        text = scripted_reply(self.config, conversation_text)
+        tokens = len(text.split(" "))
+        stats = {
+            "done": True,
+            "prompt_eval_count": len(conversation_text) // 4,
+            "prompt_eval_duration": int(self.config.latency_ms * 1e6),
+            "eval_count": tokens,
+            "eval_duration": int(max(1, len(_chunks(self.config, text)) * self.config.token_delay_ms) * 1e6),
+        }
+
+        def piece(content: str) -> dict:
+            return {"message": {"role": "assistant", "content": content}} if chat else {"response": content}
+
+        if not body.get("stream", True):
+            self._send_json({**piece(text), **stats})
+            return
+        self._start_chunked("application/x-ndjson")
+        for index, chunk in enumerate(_chunks(self.config, text)):
+            self._pace(index)
+            self._write_chunk((json.dumps({**piece(chunk), "done": False}) + "\n").encode())
+        self._write_chunk((json.dumps({**piece(""), **stats}) + "\n").encode())
+        self._write_chunk(b"")
+
+    def _anthropic(self, body: dict):
+        conversation_text = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        text = scripted_reply(self.config, conversation_text)
+        system = body.get("system", "")
+        blocks = system if isinstance(system, list) else [{"type": "text", "text": system}]
+        cached_text = "".join(b.get("text", "") for b in blocks if b.get("cache_control"))
+        uncached_text = "".join(b.get("text", "") for b in blocks if not b.get("cache_control"))
+        usage = {"input_tokens": (len(conversation_text) + len(uncached_text)) // 4, "output_tokens": len(text.split(" "))}
+        if cached_text:
+            field = "cache_read_input_tokens" if self.server.cache_prompt(cached_text) else "cache_creation_input_tokens"
+            usage[field] = len(cached_text) // 4
+
+        if not body.get("stream"):
+            self._send_json({"id": "msg_stub", "type": "message", "content": [{"type": "text", "text": text}], "usage": usage})
+            return
+        self._start_chunked("text/event-stream")
+
+        def event(name: str, payload: dict):
+            self._write_chunk(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode())
+
+        event("message_start", {"type": "message_start", "message": {"id": "msg_stub", "usage": {k: v for k, v in usage.items() if k != "output_tokens"}}})
+        for index, chunk in enumerate(_chunks(self.config, text)):
+            self._pace(index)
+            event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}})
+        event("message_delta", {"type": "message_delta", "usage": {"output_tokens": usage["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+        self._write_chunk(b"")
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded stub server on 127.0.0.1 (random port unless given), with per-path request counts."""
+
+    daemon_threads = True
+
+    def __init__(self, config: StubConfig = None, port: int = 0):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.config = config or StubConfig()
+        self.request_counts = {}
+        self.recent_requests = deque(maxlen=50)  # (path, JSON body) of the latest POSTs
+        self._cached_prompts = set()
+        self._counts_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive or streaming connections are expected, not errors
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def record(self, path: str, body: dict = None):
+        key = "/webhook/*" if path.startswith("/webhook/") else path
+        with self._counts_lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            if body is not None:
+                self.recent_requests.append((path, body))
+
+    def cache_prompt(self, text: str) -> bool:
+        """Remembers a cache_control prompt prefix; True if it was already cached."""
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._counts_lock:
+            cached = digest in self._cached_prompts
+            self._cached_prompts.add(digest)
+        return cached
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="ai-rails-stub-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    # Run the stubs standalone, e.g. to point a manual workflow at them.
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve stub Ollama, Anthropic and MCP endpoints.")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--token-delay-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubServer(StubConfig(latency_ms=args.latency_ms, token_delay_ms=args.token_delay_ms), port=args.port)
+    print(f"Stub servers listening on {server.url}")
+    server.serve_forever()
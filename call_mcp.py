@@ -1,9 +1,21 @@
 import json
+import asyncio
 import requests
 import os
 import sys
+import time
+import sqlite3
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import http_transport
+import metrics
+import codebase_index
+import docs_index
+import secrets_client
+
 # --- Configuration Section: Centralized URL Management ---
 # This section defines the base URLs for your various MCP (Model Context Provider)
 # servers and the n8n webhook endpoint.
@@ -51,6 +63,106 @@ MCP_BASE_URLS = {
     "n8n_automation": N8N_WEBHOOK_BASE_URL # n8n is handled separately but included for completeness
 }
 
+# Tools whose requests are read-only and therefore safe to retry on transient failures
+# (connection errors, 429/502/503/504). n8n_automation triggers workflows with side
+# effects and is deliberately excluded. Retry counts and backoff are configured in
+# http_transport.py.
+IDEMPOTENT_TOOLS = {
+    "CodebaseSummaryMCP",
+    "SecretsMCP",
+    "MCP_Sequential_Thinking",
+    "Context7",
+    "BraveSearchMCP",
+}
+
+# --- Tool Result Cache ---
+# In-process, memory-only cache of successful tool results. Whether a tool may be cached,
+# and for how long, is declared by the "caching" field of its JSON definition in
+# templates/mcp_definitions/ (e.g. {"cacheable": true, "ttl_seconds": 300}). Tools without
+# that field, or with "cacheable": false (SecretsMCP, n8n_automation), are never cached.
+#
+# Definitions are supplied by ai_rails_backend.py through set_definition_lookup(), so the
+# cache follows the same hot-reloaded MCP definition registry as the agent prompts.
+_definition_lookup = None
+
+
+def set_definition_lookup(lookup):
+    """Registers a callable(tool_name) -> definition dict (or None) used for cache policies."""
+    global _definition_lookup
+    _definition_lookup = lookup
+
+
+def _normalize_value(value):
+    """Recursively sorts dict keys and strips surrounding whitespace from strings."""
+    if isinstance(value, dict):
+        return {k: _normalize_value(v) for k, v in sorted(value.items()) if v is not None}
+    if isinstance(value, list):
+        return [_normalize_value(v) for v in value]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def normalize_parameters(parameters: dict, definition: dict = None) -> str:
+    """
+    Returns a canonical string form of tool parameters for use as a cache key.
+    Defaults declared in the tool's request_schema are filled in, so {"query": "x"} and
+    {"query": "x", "path": "."} map to the same key for CodebaseSummaryMCP.
+    """
+    merged = {}
+    properties = ((definition or {}).get("request_schema") or {}).get("properties", {})
+    for name, schema in properties.items():
+        if isinstance(schema, dict) and "default" in schema:
+            merged[name] = schema["default"]
+    merged.update(parameters or {})
+    return json.dumps(_normalize_value(merged), sort_keys=True, separators=(",", ":"))
+
+
+class ToolResultCache:
+    """Thread-safe TTL cache of tool results with hit/miss counters."""
+
+    def __init__(self):
+        self._entries = {}  # (tool_name, normalized parameters) -> (expires_at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result: dict, ttl_seconds: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+TOOL_RESULT_CACHE = ToolResultCache()
+
+
+def _cache_policy(tool_name: str):
+    """Returns (definition, ttl_seconds) if the tool's definition marks it cacheable, else (definition, None)."""
+    definition = _definition_lookup(tool_name) if _definition_lookup else None
+    caching = (definition or {}).get("caching") or {}
+    if caching.get("cacheable") and caching.get("ttl_seconds", 0) > 0:
+        return definition, caching["ttl_seconds"]
+    return definition, None
+
+
 # --- Core Function: Routing and Executing Tool Calls ---
 def call_mcp(tool_name: str, parameters: dict) -> dict:
     """
@@ -70,11 +182,49 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
               This response is then typically fed back to the requesting AI agent
               as additional context for its next turn.
               Includes 'status' and 'message' keys for clear error reporting.
+
+    Results of tools declared cacheable in their MCP definition are served from
+    TOOL_RESULT_CACHE while fresh; only non-error results are cached.
     """
+    definition, ttl_seconds = _cache_policy(tool_name)
+    if ttl_seconds is None:
+        return _timed_dispatch_mcp(tool_name, parameters)
+
+    cache_key = (tool_name, normalize_parameters(parameters, definition))
+    cached_result = TOOL_RESULT_CACHE.get(cache_key)
+    if cached_result is not None:
+        print(f"\n[call_mcp]: Serving {tool_name} from the result cache (ttl {ttl_seconds}s).")
+        return cached_result
+
+    result = _timed_dispatch_mcp(tool_name, parameters)
+    if isinstance(result, dict) and result.get("status") != "error":
+        TOOL_RESULT_CACHE.put(cache_key, result, ttl_seconds)
+    return result
+
+
+def _timed_dispatch_mcp(tool_name: str, parameters: dict) -> dict:
+    """Runs _dispatch_mcp inside an mcp_call timing span labelled with the tool and outcome."""
+    with metrics.span("mcp_call", tool=tool_name) as mcp_span:
+        result = _dispatch_mcp(tool_name, parameters)
+        mcp_span.labels["status"] = "error" if isinstance(result, dict) and result.get("status") == "error" else "ok"
+    return result
+
+
+def _dispatch_mcp(tool_name: str, parameters: dict) -> dict:
+    """Makes the actual HTTP call for call_mcp (no caching)."""
     print(f"\n[call_mcp]: Attempting to call tool: {tool_name} with parameters: {json.dumps(parameters, indent=2)}")
 
     # --- Codebase Summary MCP ---
     if tool_name == "CodebaseSummaryMCP":
+        # Answered from the local codebase index when it can (see codebase_index.py)
+        if codebase_index.CODEBASE_BACKEND != "remote":
+            local_result = _query_codebase_index(parameters)
+            if local_result is not None:
+                return local_result
+            if codebase_index.CODEBASE_BACKEND == "local":
+                return {"status": "error", "message": "The local codebase index could not answer this query, and AI_RAILS_CODEBASE_BACKEND=local disables CodebaseSummaryMCP."}
+            print("[call_mcp]: The local codebase index has no answer; asking CodebaseSummaryMCP.")
+
         mcp_url = MCP_BASE_URLS.get("CodebaseSummaryMCP")
         if not mcp_url:
             return {"status": "error", "message": "CodebaseSummaryMCP URL not configured in environment variables."}
@@ -82,7 +232,7 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         # Assuming the Codebase Summary MCP has a /query endpoint for requests
         endpoint = f"{mcp_url}/query" 
         try:
-            response = requests.post(endpoint, json=parameters, timeout=60) # 60 sec timeout for potentially large queries
+            response = http_transport.post(endpoint, retry=tool_name in IDEMPOTENT_TOOLS, json=parameters, timeout=60) # 60 sec timeout for potentially large queries
             response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -106,29 +256,13 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         auth_token = os.getenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN")
         if not auth_token:
             return {"status": "error", "message": "SecretsMCP authentication token not configured in environment variables."}
-        
-        # Prepare headers with authentication
-        headers = {
-            "X-API-Key": auth_token,
-            "Content-Type": "application/json"
-        }
-        
-        # Build request payload
-        request_payload = {"secret_name": secret_name}
         if project_name:
-            request_payload["project_name"] = project_name
             print(f"[call_mcp]: Using project context: {project_name}")
-        
-        # Assuming the Secrets MCP has a /get_secret endpoint
-        endpoint = f"{mcp_url}/get_secret"
-        try:
-            response = requests.post(endpoint, json=request_payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            # For security, the actual secret value should NOT be logged directly here or elsewhere
-            # Only log that a request was made and its status.
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            return {"status": "error", "message": f"SecretsMCP call failed: {e}", "details": str(e)}
+
+        # Served from the in-memory secrets cache when prefetched or recently fetched (see secrets_client.py).
+        # For security, the actual secret value should NOT be logged directly here or elsewhere
+        # Only log that a request was made and its status.
+        return secrets_client.get_client(mcp_url).get(secret_name, project_name)
 
     # --- MCP-Sequential-Thinking ---
     elif tool_name == "MCP_Sequential_Thinking":
@@ -139,7 +273,7 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         # Assuming a common endpoint for this type of MCP, e.g., /think or /process
         endpoint = f"{mcp_url}/process" 
         try:
-            response = requests.post(endpoint, json=parameters, timeout=90)
+            response = http_transport.post(endpoint, retry=tool_name in IDEMPOTENT_TOOLS, json=parameters, timeout=90)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -147,18 +281,33 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
 
     # --- Context7 MCP ---
     elif tool_name == "Context7":
+        # Answered from the local docs index when our own docs cover the query (see docs_index.py)
+        local_result = None
+        if docs_index.CONTEXT7_BACKEND != "remote":
+            local_result = _query_docs_index(parameters)
+            if local_result is not None and docs_index.CONTEXT7_BACKEND in ("auto", "local"):
+                return local_result
+            if docs_index.CONTEXT7_BACKEND == "local":
+                return {"status": "error", "message": "The local docs index has no match for this query, and AI_RAILS_CONTEXT7_BACKEND=local disables Context7."}
+
         mcp_url = MCP_BASE_URLS.get("Context7")
         if not mcp_url:
-            return {"status": "error", "message": "Context7 URL not configured in environment variables."}
+            return local_result or {"status": "error", "message": "Context7 URL not configured in environment variables."}
         
         # Assuming a /query or /context endpoint for retrieval
         endpoint = f"{mcp_url}/query" 
         try:
-            response = requests.post(endpoint, json=parameters, timeout=60)
+            response = http_transport.post(endpoint, retry=tool_name in IDEMPOTENT_TOOLS, json=parameters, timeout=60)
             response.raise_for_status()
-            return response.json()
+            remote_result = response.json()
         except requests.exceptions.RequestException as e:
+            if local_result is not None:
+                print(f"[call_mcp]: Context7 call failed ({e}); returning the local docs index results only.")
+                return local_result
             return {"status": "error", "message": f"Context7 call failed: {e}", "details": str(e)}
+        if local_result is not None and isinstance(remote_result, dict) and remote_result.get("status") != "error":
+            return docs_index.merge_results(local_result["results"], remote_result, parameters.get("num_results"))
+        return remote_result
 
     # --- Brave Search MCP (or similar web search) ---
     elif tool_name == "BraveSearchMCP":
@@ -169,7 +318,7 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         # Assuming a /search endpoint
         endpoint = f"{mcp_url}/search" 
         try:
-            response = requests.post(endpoint, json=parameters, timeout=120) # Longer timeout for web searches
+            response = http_transport.post(endpoint, retry=tool_name in IDEMPOTENT_TOOLS, json=parameters, timeout=120) # Longer timeout for web searches
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -195,7 +344,7 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         
         try:
             print(f"[call_mcp]: Triggering n8n workflow at: {n8n_full_webhook_url}")
-            response = requests.post(n8n_full_webhook_url, json=data_payload, timeout=90)
+            response = http_transport.post(n8n_full_webhook_url, retry=tool_name in IDEMPOTENT_TOOLS, json=data_payload, timeout=90)
             response.raise_for_status()
             return {"status": "success", "message": f"n8n workflow '{workflow_name}' triggered successfully.", "n8n_response": response.json()}
         except requests.exceptions.RequestException as e:
@@ -207,6 +356,102 @@ def call_mcp(tool_name: str, parameters: dict) -> dict:
         # This prevents agents from attempting to call non-existent services.
         return {"status": "error", "message": f"Unknown tool requested by agent: '{tool_name}'"}
 
+def _query_codebase_index(parameters: dict):
+    """Answers a CodebaseSummaryMCP request from the local index; None if it has no answer or fails."""
+    with metrics.span("codebase_index_query") as index_span:
+        try:
+            result = codebase_index.answer(codebase_index.get_index(), parameters)
+        except (OSError, sqlite3.Error) as e:
+            print(f"[call_mcp]: Local codebase index unavailable: {e}")
+            result = None
+        index_span.labels["answered"] = "yes" if result else "no"
+    if result:
+        print(f"[call_mcp]: Answered from the local codebase index ({result['answer_type']}).")
+    return result
+
+
+def _query_docs_index(parameters: dict):
+    """Answers a Context7 request from the local docs index; None if nothing matches well enough or it fails."""
+    with metrics.span("docs_index_query") as index_span:
+        try:
+            if docs_index.CONTEXT7_BACKEND == "local":
+                # Nothing better to fall back to, so any chunk covering the query will do
+                result = docs_index.answer(docs_index.get_index(), parameters, min_matched_terms=1, min_score=0.0)
+            else:
+                result = docs_index.answer(docs_index.get_index(), parameters)
+        except (OSError, ValueError) as e:
+            print(f"[call_mcp]: Local docs index unavailable: {e}")
+            result = None
+        index_span.labels["answered"] = "yes" if result else "no"
+    if result:
+        print(f"[call_mcp]: {len(result['results'])} result(s) from the local docs index (best: {result['results'][0]['source']}).")
+    return result
+
+
+# --- Async and Batched Dispatch ---
+# Concurrent tool calls run on one persistent thread pool (threads are started once, not per
+# batch), each in a copy of the caller's context so metrics and session state follow them.
+MCP_DISPATCH_WORKERS = int(os.getenv("AI_RAILS_MCP_DISPATCH_WORKERS", "8"))
+
+_dispatch_pool = None
+_dispatch_pool_lock = threading.Lock()
+
+
+def _get_dispatch_pool() -> ThreadPoolExecutor:
+    """Returns the shared worker pool for concurrent tool calls, starting it on first use."""
+    global _dispatch_pool
+    with _dispatch_pool_lock:
+        if _dispatch_pool is None:
+            _dispatch_pool = ThreadPoolExecutor(max_workers=MCP_DISPATCH_WORKERS, thread_name_prefix="ai-rails-mcp")
+        return _dispatch_pool
+
+
+def _safe_call_mcp(tool_name: str, parameters: dict) -> dict:
+    """call_mcp that turns an exception into an error result, so one failing tool does not sink a batch."""
+    try:
+        return call_mcp(tool_name, parameters)
+    except Exception as e:
+        return {"status": "error", "message": f"{tool_name} call failed: {e}", "details": str(e)}
+
+
+async def call_mcp_async(tool_name: str, parameters: dict) -> dict:
+    """
+    Async wrapper around call_mcp.
+    The blocking HTTP call runs on the shared dispatch pool, so several tool calls can be
+    awaited concurrently while still sharing the pooled keep-alive sessions from http_transport.
+    """
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_dispatch_pool(), context.run, _safe_call_mcp, tool_name, parameters)
+
+
+async def call_mcp_batch_async(tool_requests: list) -> list:
+    """
+    Runs several tool requests concurrently.
+
+    Args:
+        tool_requests (list): (tool_name, parameters) tuples.
+
+    Returns:
+        list: The call_mcp results, in the same order as tool_requests.
+    """
+    return await asyncio.gather(*(call_mcp_async(tool_name, parameters) for tool_name, parameters in tool_requests))
+
+
+def call_mcp_batch(tool_requests: list) -> list:
+    """
+    Synchronous version of call_mcp_batch_async: runs the requests concurrently on the
+    dispatch pool and blocks until all are done. It does not use an event loop, so it also
+    works when called from inside one (async code should await call_mcp_batch_async instead,
+    which does not block the loop).
+    """
+    if len(tool_requests) == 1:
+        tool_name, parameters = tool_requests[0]
+        return [_safe_call_mcp(tool_name, parameters)]
+    pool = _get_dispatch_pool()
+    futures = [pool.submit(contextvars.copy_context().run, _safe_call_mcp, tool_name, parameters) for tool_name, parameters in tool_requests]
+    return [future.result() for future in futures]
+
 # --- Example Usage (for direct script testing - not used in normal AI Rails flow) ---
 if __name__ == "__main__":
     # This block allows you to test the call_mcp function directly from your terminal.
@@ -0,0 +1,430 @@
+import os
+import re
+import sys
+import ast
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+# --- Configuration Section: Local Codebase Index ---
+# A persistent, incrementally updated index of the repository agents work on, used by
+# call_mcp to answer CodebaseSummaryMCP requests locally instead of over the network:
+#   - the file tree (path, size, mtime)
+#   - Python symbols (classes, functions, methods) extracted with ast, with their line
+#     ranges, signatures and the first line of their docstrings
+#   - a trigram index over text files for substring search
+#
+# The index lives in SQLite, one database per repository under CODEBASE_INDEX_DIR. Before
+# answering, files whose mtime or size changed since they were indexed are re-read, new
+# files are added and deleted ones dropped; this scan runs at most every
+# CODEBASE_INDEX_REFRESH_S seconds.
+#
+# Questions the index can answer (anything else goes to the remote service):
+#   - structure:  "What is the structure of the /src directory?", "list files in src"
+#   - contents:   "Show me the contents of src/main.py" (or a file given as "path")
+#   - symbols:    "Find the function parse_args", "Where is LLMResponseCache defined?",
+#                 "Find all functions related to authentication"
+#   - substrings: "Search for 'TODO(auth)'", "Find usages of `call_mcp_batch`"
+#
+# CODEBASE_BACKEND selects who answers:
+#   - auto:   the local index, falling back to CodebaseSummaryMCP when it has no answer
+#   - local:  the local index only
+#   - remote: CodebaseSummaryMCP only (the default when CODEBASE_ROOT is not set)
+
+CODEBASE_ROOT = os.getenv("AI_RAILS_CODEBASE_ROOT", "")
+CODEBASE_BACKEND = os.getenv("AI_RAILS_CODEBASE_BACKEND", "auto" if CODEBASE_ROOT else "remote")
+CODEBASE_INDEX_DIR = Path(os.getenv("AI_RAILS_CODEBASE_INDEX_DIR", str(Path(__file__).parent.resolve() / "output" / ".codebase_index")))
+CODEBASE_INDEX_REFRESH_S = float(os.getenv("AI_RAILS_CODEBASE_INDEX_REFRESH_S", "5"))
+
+BACKENDS = ["auto", "local", "remote"]
+
+IGNORED_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".mypy_cache",
+                ".pytest_cache", ".tox", "dist", "build", ".idea", ".vscode"}
+IGNORED_DIRS |= {d.strip() for d in os.getenv("AI_RAILS_CODEBASE_INDEX_IGNORE", "").split(",") if d.strip()}
+
+MAX_TEXT_BYTES = 512 * 1024   # Larger files are listed in the tree but not searched
+MAX_CONTENT_CHARS = 100_000   # Cap on file contents returned to an agent
+MAX_RESULTS = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    mtime_ns INTEGER,
+    size INTEGER,
+    searchable INTEGER
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    file_id INTEGER,
+    name TEXT,
+    qualname TEXT,
+    kind TEXT,
+    lineno INTEGER,
+    end_lineno INTEGER,
+    signature TEXT,
+    doc TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_symbols_name ON symbols (name);
+CREATE INDEX IF NOT EXISTS idx_symbols_file ON symbols (file_id);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT,
+    file_id INTEGER,
+    PRIMARY KEY (trigram, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_trigrams_file ON trigrams (file_id);
+"""
+
+
+def normalize_path(path: str) -> str:
+    """A request path relative to the root: "./src/", "/src" and "src" are all "src"; the root is "."."""
+    path = Path(path.strip()).as_posix()
+    while path.startswith("./"):
+        path = path[2:]
+    return path.strip("/") or "."
+
+
+def trigrams(text: str) -> set:
+    """Lower-cased character trigrams of text."""
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def extract_symbols(source: str) -> list:
+    """Returns (name, qualname, kind, lineno, end_lineno, signature, doc) for every class and function."""
+    symbols = []
+
+    def visit(node, prefix: str, in_class: bool):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                qualname = f"{prefix}{child.name}"
+                if isinstance(child, ast.ClassDef):
+                    kind = "class"
+                    bases = ", ".join(ast.unparse(b) for b in child.bases)
+                    signature = f"class {child.name}({bases})" if bases else f"class {child.name}"
+                else:
+                    kind = "method" if in_class else "function"
+                    prefix_kw = "async def" if isinstance(child, ast.AsyncFunctionDef) else "def"
+                    returns = f" -> {ast.unparse(child.returns)}" if child.returns else ""
+                    signature = f"{prefix_kw} {child.name}({ast.unparse(child.args)}){returns}"
+                doc = (ast.get_docstring(child) or "").strip().splitlines()
+                symbols.append((child.name, qualname, kind, child.lineno, getattr(child, "end_lineno", child.lineno), signature, doc[0] if doc else ""))
+                visit(child, f"{qualname}.", isinstance(child, ast.ClassDef))
+            else:
+                visit(child, prefix, in_class)
+
+    visit(ast.parse(source), "", False)
+    return symbols
+
+
+class CodebaseIndex:
+    """SQLite-backed index of one repository. Safe to share between threads (one lock)."""
+
+    def __init__(self, root: Path, db_path: Path = None, refresh_interval: float = CODEBASE_INDEX_REFRESH_S):
+        self.root = Path(root).resolve()
+        if db_path is None:
+            root_hash = hashlib.sha256(str(self.root).encode("utf-8")).hexdigest()[:12]
+            db_path = CODEBASE_INDEX_DIR / f"{self.root.name}-{root_hash}.sqlite"
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.refresh_interval = refresh_interval
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._last_refresh = 0.0
+        self._files = {path: (file_id, mtime_ns, size) for file_id, path, mtime_ns, size in
+                       self._conn.execute("SELECT id, path, mtime_ns, size FROM files")}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Incremental Updates ---
+    def _walk(self):
+        """Yields (relative path, stat) of every file under root outside IGNORED_DIRS."""
+        index_dir = str(self.db_path.parent)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # The index's own directory is skipped in case it lies inside the repository
+            dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS and os.path.join(dirpath, d) != index_dir)
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    file_stat = os.stat(full_path)
+                except OSError:
+                    continue
+                yield Path(os.path.relpath(full_path, self.root)).as_posix(), file_stat
+
+    def refresh(self, force: bool = False) -> dict:
+        """
+        Re-indexes changed files, adds new ones and drops deleted ones. Skipped if the last
+        refresh was less than refresh_interval seconds ago (unless force).
+        Returns {"added", "updated", "removed", "seconds"}.
+        """
+        with self._lock:
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return {"added": 0, "updated": 0, "removed": 0, "seconds": 0.0}
+            started = time.perf_counter()
+            added = updated = 0
+            seen = set()
+            for path, file_stat in self._walk():
+                seen.add(path)
+                known = self._files.get(path)
+                if known and known[1] == file_stat.st_mtime_ns and known[2] == file_stat.st_size:
+                    continue
+                self._index_file(path, file_stat, known[0] if known else None)
+                if known:
+                    updated += 1
+                else:
+                    added += 1
+            removed = [path for path in self._files if path not in seen]
+            for path in removed:
+                self._delete_file(self._files.pop(path)[0])
+            self._conn.commit()
+            self._last_refresh = time.time()
+            return {"added": added, "updated": updated, "removed": len(removed), "seconds": round(time.perf_counter() - started, 3)}
+
+    def _index_file(self, path: str, file_stat, file_id: int = None):
+        """(Re-)indexes one file (lock held)."""
+        text = None
+        if file_stat.st_size <= MAX_TEXT_BYTES:
+            try:
+                with open(self.root / path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except (OSError, UnicodeDecodeError):
+                text = None
+
+        if file_id is None:
+            cursor = self._conn.execute("INSERT INTO files (path, mtime_ns, size, searchable) VALUES (?, ?, ?, ?)",
+                                        (path, file_stat.st_mtime_ns, file_stat.st_size, int(text is not None)))
+            file_id = cursor.lastrowid
+        else:
+            self._conn.execute("UPDATE files SET mtime_ns = ?, size = ?, searchable = ? WHERE id = ?",
+                               (file_stat.st_mtime_ns, file_stat.st_size, int(text is not None), file_id))
+            self._conn.execute("DELETE FROM symbols WHERE file_id = ?", (file_id,))
+            self._conn.execute("DELETE FROM trigrams WHERE file_id = ?", (file_id,))
+        self._files[path] = (file_id, file_stat.st_mtime_ns, file_stat.st_size)
+
+        if text is None:
+            return
+        self._conn.executemany("INSERT OR IGNORE INTO trigrams (trigram, file_id) VALUES (?, ?)",
+                               ((trigram, file_id) for trigram in trigrams(text)))
+        if path.endswith(".py"):
+            try:
+                symbols = extract_symbols(text)
+            except (SyntaxError, ValueError):
+                symbols = []
+            self._conn.executemany("INSERT INTO symbols (file_id, name, qualname, kind, lineno, end_lineno, signature, doc) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", ((file_id,) + symbol for symbol in symbols))
+
+    def _delete_file(self, file_id: int):
+        self._conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        self._conn.execute("DELETE FROM symbols WHERE file_id = ?", (file_id,))
+        self._conn.execute("DELETE FROM trigrams WHERE file_id = ?", (file_id,))
+
+    # --- Queries ---
+    def _under(self, path: str, base: str) -> bool:
+        return base in ("", ".") or path == base or path.startswith(base.rstrip("/") + "/")
+
+    def tree(self, base: str = ".", max_entries: int = 300) -> tuple:
+        """Returns (the first max_entries indexed paths under base, sorted; how many there are)."""
+        with self._lock:
+            paths = sorted(p for p in self._files if self._under(p, base))
+        return paths[:max_entries], len(paths)
+
+    def find_symbols(self, name: str, base: str = ".", fuzzy: bool = False) -> list:
+        """Symbols named `name` (or Class.method), or whose name contains it if fuzzy."""
+        if fuzzy:
+            sql, args = "SELECT f.path, s.* FROM symbols s JOIN files f ON f.id = s.file_id WHERE s.name LIKE ? ORDER BY f.path, s.lineno", (f"%{name}%",)
+        elif "." in name:
+            sql, args = "SELECT f.path, s.* FROM symbols s JOIN files f ON f.id = s.file_id WHERE s.qualname = ? ORDER BY f.path, s.lineno", (name,)
+        else:
+            sql, args = "SELECT f.path, s.* FROM symbols s JOIN files f ON f.id = s.file_id WHERE s.name = ? ORDER BY f.path, s.lineno", (name,)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        columns = ["path", "file_id", "name", "qualname", "kind", "lineno", "end_lineno", "signature", "doc"]
+        return [dict(zip(columns, row)) for row in rows if self._under(row[0], base)]
+
+    def search(self, text: str, base: str = ".", max_results: int = MAX_RESULTS) -> list:
+        """
+        Case-insensitive substring search: candidate files come from the trigram index, then
+        their lines are checked. Returns (path, line number, line) tuples.
+        """
+        needle = text.lower()
+        grams = sorted(trigrams(needle))
+        with self._lock:
+            if grams:
+                placeholders = ",".join("?" * len(grams))
+                rows = self._conn.execute(
+                    f"SELECT f.path FROM trigrams t JOIN files f ON f.id = t.file_id WHERE t.trigram IN ({placeholders}) "
+                    f"GROUP BY t.file_id HAVING COUNT(*) = ? ORDER BY f.path", (*grams, len(grams))).fetchall()
+            else:
+                rows = self._conn.execute("SELECT path FROM files WHERE searchable = 1 ORDER BY path").fetchall()
+        matches = []
+        for (path,) in rows:
+            if not self._under(path, base):
+                continue
+            try:
+                with open(self.root / path, "r", encoding="utf-8") as f:
+                    for lineno, line in enumerate(f, start=1):
+                        if needle in line.lower():
+                            matches.append((path, lineno, line.rstrip("\n")))
+                            if len(matches) >= max_results:
+                                return matches
+            except (OSError, UnicodeDecodeError):
+                continue
+        return matches
+
+    def read(self, path: str) -> str:
+        """Contents of an indexed file, or None if it is not in the index."""
+        path = normalize_path(path)
+        with self._lock:
+            if path not in self._files:
+                return None
+        with open(self.root / path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read(MAX_CONTENT_CHARS + 1)
+
+    def source_of(self, symbol: dict, max_lines: int = 60) -> str:
+        with open(self.root / symbol["path"], "r", encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+        end = min(symbol["end_lineno"], symbol["lineno"] + max_lines - 1)
+        snippet = "\n".join(lines[symbol["lineno"] - 1:end])
+        return snippet + ("\n    ..." if end < symbol["end_lineno"] else "")
+
+    def stats(self) -> dict:
+        with self._lock:
+            files = len(self._files)
+            symbols = self._conn.execute("SELECT COUNT(*) FROM symbols").fetchone()[0]
+        return {"root": str(self.root), "files": files, "symbols": symbols, "db": str(self.db_path)}
+
+
+# --- Answering CodebaseSummaryMCP Requests ---
+_QUOTED = re.compile(r"[`'\"]([^`'\"]{3,})[`'\"]")
+_IDENTIFIER = r"[`'\"]?([A-Za-z_][\w.]*)[`'\"]?"
+_SYMBOL_PATTERNS = [
+    re.compile(r"\b(?:function|class|method|def|symbol)s?\s+(?:named\s+|called\s+)?" + _IDENTIFIER + r"(?:\s*\(\))?\s*(?:\?|$|\s+(?:is\s+)?defined)", re.I),
+    re.compile(r"\bwhere\s+(?:is|are)\s+" + _IDENTIFIER + r"(?:\(\))?\s+defined", re.I),
+    re.compile(r"\bdefinition\s+of\s+" + _IDENTIFIER, re.I),
+]
+_RELATED_PATTERN = re.compile(r"\b(?:functions?|class(?:es)?|methods?|symbols?|code)\s+(?:related\s+to|for|about|handling)\s+(.+?)[?.]?$", re.I)
+_SEARCH_PATTERN = re.compile(r"\b(?:search|grep|occurrences?|usages?|references?|mentions?|uses)\b", re.I)
+_CONTENTS_PATTERN = re.compile(r"\b(?:contents?\s+of|show\s+me|open|read|cat|print)\s+(?:the\s+)?(?:file\s+)?[`'\"]?([\w./-]+\.\w+)[`'\"]?", re.I)
+_STRUCTURE_PATTERN = re.compile(r"\b(?:structure|tree|layout|list(?:\s+the)?\s+files|files\s+in|director(?:y|ies)|folders?|overview)\b", re.I)
+_PATH_IN_QUERY = re.compile(r"(?:^|\s)[`'\"]?(\.?/?[\w.-]+(?:/[\w.-]+)*/?)[`'\"]?\s+(?:directory|folder|dir)\b|\b(?:in|of|under)\s+(?:the\s+)?[`'\"]?(\.?/?[\w.-]+(?:/[\w.-]+)*/?)[`'\"]?", re.I)
+_STOPWORDS = {"the", "and", "for", "with", "that", "this", "user", "code", "all", "any", "related", "handling"}
+
+
+def _base_path(index: CodebaseIndex, parameters: dict, query: str) -> str:
+    base = normalize_path(parameters.get("path") or ".")
+    if base == ".":
+        for match in _PATH_IN_QUERY.finditer(query):
+            candidate = normalize_path(match.group(1) or match.group(2) or ".")
+            if candidate != "." and any(index._under(p, candidate) for p in index._files):
+                return candidate
+    return base
+
+
+def _format_symbol(index: CodebaseIndex, symbol: dict, with_source: bool) -> str:
+    header = f"### `{symbol['qualname']}` ({symbol['kind']}) - {symbol['path']}:{symbol['lineno']}-{symbol['end_lineno']}"
+    parts = [header, f"`{symbol['signature']}`"]
+    if symbol["doc"]:
+        parts.append(symbol["doc"])
+    if with_source:
+        try:
+            parts.append(f"```python\n{index.source_of(symbol)}\n```")
+        except OSError:
+            pass
+    return "\n".join(parts)
+
+
+def answer(index: CodebaseIndex, parameters: dict):
+    """
+    Answers a CodebaseSummaryMCP request from the index, in the service's response shape
+    ({"status": "success", "result": <markdown>}). Returns None if the question is not one
+    the index understands, or it found nothing (the remote service may know more).
+    """
+    query = (parameters.get("query") or "").strip()
+    index.refresh()
+    base = _base_path(index, parameters, query)
+
+    # File contents: a file given as "path", or named in the query
+    contents_match = _CONTENTS_PATTERN.search(query)
+    for candidate in ([base] if base != "." else []) + ([contents_match.group(1)] if contents_match else []):
+        content = index.read(candidate)
+        if content is not None:
+            truncated = len(content) > MAX_CONTENT_CHARS
+            return _result(f"### {candidate}\n```\n{content[:MAX_CONTENT_CHARS]}\n```" + ("\n(truncated)" if truncated else ""), "contents")
+
+    # Symbol definitions
+    for pattern in _SYMBOL_PATTERNS:
+        match = pattern.search(query)
+        if match:
+            symbols = index.find_symbols(match.group(1), base)
+            if symbols:
+                return _result("\n\n".join(_format_symbol(index, s, len(symbols) <= 5) for s in symbols[:MAX_RESULTS]), "symbols")
+    related = _RELATED_PATTERN.search(query)
+    if related:
+        words = [w for w in re.findall(r"[A-Za-z]{3,}", related.group(1).lower()) if w not in _STOPWORDS]
+        symbols = {}
+        for word in words:
+            for symbol in index.find_symbols(word[:6] if len(word) > 6 else word, base, fuzzy=True):
+                symbols[(symbol["path"], symbol["lineno"])] = symbol
+        if symbols:
+            ordered = sorted(symbols.values(), key=lambda s: (s["path"], s["lineno"]))[:MAX_RESULTS]
+            return _result("\n\n".join(_format_symbol(index, s, False) for s in ordered), "symbols")
+
+    # Substring search
+    quoted = _QUOTED.search(query)
+    if quoted and (_SEARCH_PATTERN.search(query) or query.lower().startswith("find")):
+        matches = index.search(quoted.group(1), base)
+        if matches:
+            lines = [f"{path}:{lineno}: {line.strip()}" for path, lineno, line in matches]
+            return _result(f"Matches for `{quoted.group(1)}`" + (f" (first {MAX_RESULTS})" if len(matches) >= MAX_RESULTS else "") + ":\n" + "\n".join(lines), "search")
+
+    # Structure
+    if _STRUCTURE_PATTERN.search(query) or not query:
+        paths, total = index.tree(base)
+        if paths:
+            listing = "\n".join(paths) + (f"\n... and {total - len(paths)} more files" if total > len(paths) else "")
+            return _result(f"### Files under {base} ({total})\n{listing}", "structure")
+    return None
+
+
+def _result(markdown: str, kind: str) -> dict:
+    return {"status": "success", "result": markdown, "source": "local_index", "answer_type": kind}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(root: str = None) -> CodebaseIndex:
+    """Returns the process-wide index of root (default CODEBASE_ROOT), opening it on first use."""
+    root = Path(root or CODEBASE_ROOT).expanduser().resolve()
+    with _indexes_lock:
+        if root not in _indexes:
+            _indexes[root] = CodebaseIndex(root)
+        return _indexes[root]
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Build the local codebase index or query it as CodebaseSummaryMCP would.")
+    parser.add_argument("root", nargs="?", default=CODEBASE_ROOT or ".", help="Repository to index (default: AI_RAILS_CODEBASE_ROOT)")
+    parser.add_argument("--query", help="Answer a CodebaseSummaryMCP query from the index")
+    parser.add_argument("--path", default=".", help="The request's 'path' parameter")
+    args = parser.parse_args(argv)
+
+    index = get_index(args.root)
+    result = index.refresh(force=True)
+    print(f"Index of {index.root}: {result['added']} added, {result['updated']} updated, {result['removed']} removed in {result['seconds']}s.")
+    print(json.dumps(index.stats()))
+    if args.query:
+        response = answer(index, {"query": args.query, "path": args.path})
+        print(response["result"] if response else "The local index has no answer; CodebaseSummaryMCP would be asked.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
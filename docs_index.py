@@ -0,0 +1,392 @@
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import time
+import heapq
+import struct
+import argparse
+import threading
+from array import array
+from pathlib import Path
+
+# --- Configuration Section: Local Docs Index ---
+# A BM25 index over our own documentation (DOCS_INDEX_ROOTS, by default docs/ and
+# templates/), used by call_mcp to answer Context7 queries locally when the answer is in
+# those files, instead of a round trip to the remote service.
+#
+# Files are split into chunks (markdown sections, further split by paragraph when long),
+# and each chunk is a BM25 "document". The index is one file (DOCS_INDEX_PATH):
+#   magic (8 bytes) | header length (uint32, little-endian) | header (JSON) |
+#   postings (uint32 pairs) | chunk texts (UTF-8)
+# The header holds the lexicon (term -> postings offset, count), the chunk table (source,
+# text offset and length, token count) and the indexed files' mtimes and sizes. Postings
+# are (chunk id, term frequency) pairs sorted by chunk id. The postings and texts are read
+# through mmap, so a query touches only the postings of its own terms.
+#
+# The index is rebuilt when a file under the roots changes (checked at most every
+# DOCS_INDEX_REFRESH_S seconds). Only changed files are re-read and tokenized; chunks of
+# unchanged files are carried over from the old index. The new file replaces the old one
+# atomically.
+#
+# CONTEXT7_BACKEND selects who answers Context7 queries:
+#   - auto:   the local index if its best match covers at least DOCS_MIN_COVERAGE of the
+#             query (terms weighted by IDF, so a rare term our docs lack counts heavily),
+#             contains at least DOCS_MIN_MATCHED_TERMS distinct query terms and scores at
+#             least DOCS_MIN_SCORE, otherwise the remote service. Coverage alone is 1.0 for
+#             any one-word query whose word appears somewhere, so short generic queries
+#             ("python") go to the remote service
+#   - merge:  both, with local and remote results interleaved (local first)
+#   - local:  the local index only
+#   - remote: the remote service only
+
+PROJECT_ROOT = Path(__file__).parent.resolve()
+CONTEXT7_BACKEND = os.getenv("AI_RAILS_CONTEXT7_BACKEND", "auto")
+DOCS_INDEX_ROOTS = [r.strip() for r in os.getenv("AI_RAILS_DOCS_INDEX_ROOTS", "docs,templates").split(",") if r.strip()]
+DOCS_INDEX_EXTENSIONS = {e.strip() for e in os.getenv("AI_RAILS_DOCS_INDEX_EXTENSIONS", ".md,.rst,.txt,.json").split(",") if e.strip()}
+DOCS_INDEX_PATH = Path(os.getenv("AI_RAILS_DOCS_INDEX_PATH", str(PROJECT_ROOT / "output" / ".docs_index" / "docs.bm25")))
+DOCS_INDEX_REFRESH_S = float(os.getenv("AI_RAILS_DOCS_INDEX_REFRESH_S", "10"))
+DOCS_MIN_COVERAGE = float(os.getenv("AI_RAILS_DOCS_MIN_COVERAGE", "0.75"))
+DOCS_MIN_MATCHED_TERMS = int(os.getenv("AI_RAILS_DOCS_MIN_MATCHED_TERMS", "2"))
+DOCS_MIN_SCORE = float(os.getenv("AI_RAILS_DOCS_MIN_SCORE", "5.0"))
+
+BACKENDS = ["auto", "merge", "local", "remote"]
+
+MAGIC = b"AIRBM25\x01"
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_CHUNK_CHARS = 1500
+DEFAULT_NUM_RESULTS = 5
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_HEADING_PATTERN = re.compile(r"^#{1,6}\s+(.*)$")
+_STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in",
+              "is", "it", "of", "on", "or", "should", "that", "the", "this", "to", "what", "when", "where", "which",
+              "who", "why", "will", "with", "you", "your"}
+
+
+def tokenize(text: str) -> list:
+    """Lower-cased alphanumeric tokens without stopwords; a plural "s" is dropped."""
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def _split_long(text: str) -> list:
+    """Splits text into pieces of at most MAX_CHUNK_CHARS, at paragraph and then line boundaries."""
+    pieces, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        units = [paragraph] if len(paragraph) <= MAX_CHUNK_CHARS else paragraph.splitlines()
+        for unit in units:
+            if current and len(current) + len(unit) + 2 > MAX_CHUNK_CHARS:
+                pieces.append(current)
+                current = ""
+            current = f"{current}\n\n{unit}" if current else unit
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+
+def chunk_document(relative_path: str, text: str) -> list:
+    """Returns (source, text) chunks: one per markdown section, split further when long."""
+    sections, heading, lines = [], "", []
+    for line in text.splitlines():
+        match = _HEADING_PATTERN.match(line) if relative_path.endswith(".md") else None
+        if match and lines:
+            sections.append((heading, "\n".join(lines)))
+            lines = []
+        if match:
+            heading = match.group(1).strip()
+        lines.append(line)
+    if lines:
+        sections.append((heading, "\n".join(lines)))
+
+    chunks = []
+    for heading, section in sections:
+        anchor = re.sub(r"[^a-z0-9]+", "-", heading.lower()).strip("-")
+        source = f"{relative_path}#{anchor}" if anchor else relative_path
+        for piece in _split_long(section):
+            if piece.strip():
+                chunks.append((source, piece.strip()))
+    return chunks
+
+
+class DocsIndex:
+    """The packed BM25 index file of a set of doc roots. Safe to share between threads (one lock)."""
+
+    def __init__(self, roots: list = None, index_path: Path = None, base_dir: Path = PROJECT_ROOT,
+                 refresh_interval: float = DOCS_INDEX_REFRESH_S):
+        self.base_dir = Path(base_dir)
+        self.roots = [self.base_dir / root for root in (roots or DOCS_INDEX_ROOTS)]
+        self.index_path = Path(index_path or DOCS_INDEX_PATH)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._last_refresh = 0.0
+        self._file = None
+        self._mmap = None
+        self._header = {"lexicon": {}, "chunks": [], "files": {}, "avgdl": 0.0}
+        self._postings_offset = 0
+        self._texts_offset = 0
+        self._open()
+
+    # --- Reading the Index File ---
+    def _open(self):
+        """Maps the index file, if there is a valid one (lock held or during __init__)."""
+        self._close()
+        try:
+            f = open(self.index_path, "rb")
+        except FileNotFoundError:
+            return
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("not a docs index file")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+            if header.get("byteorder") != sys.byteorder:
+                raise ValueError("index written on a machine with another byte order")
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, struct.error, OSError):
+            f.close()
+            return  # Rebuilt on the next refresh
+        self._file, self._mmap, self._header = f, mapped, header
+        self._postings_offset = len(MAGIC) + 4 + header_length
+        self._texts_offset = self._postings_offset + header["postings_bytes"]
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._file = self._mmap = None
+        self._header = {"lexicon": {}, "chunks": [], "files": {}, "avgdl": 0.0}
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _postings(self, term: str) -> memoryview:
+        """
+        The (chunk id, tf, chunk id, tf, ...) uint32 array of a term, straight from the mapped file.
+        Use it in a with block: the map cannot be closed while a view of it is alive.
+        """
+        entry = self._header["lexicon"].get(term)
+        if entry is None or self._mmap is None:
+            return memoryview(b"").cast("I")
+        offset, count = entry
+        start = self._postings_offset + offset
+        return memoryview(self._mmap)[start:start + count * 8].cast("I")
+
+    def _chunk_text(self, chunk_id: int) -> str:
+        _, offset, length, _ = self._header["chunks"][chunk_id]
+        start = self._texts_offset + offset
+        return self._mmap[start:start + length].decode("utf-8")
+
+    # --- Incremental Rebuilds ---
+    def _scan(self) -> dict:
+        """relative path -> [mtime_ns, size] of every indexable file under the roots."""
+        files = {}
+        for root in self.roots:
+            if not root.is_dir():
+                continue
+            for path in sorted(root.rglob("*")):
+                if path.suffix in DOCS_INDEX_EXTENSIONS and path.is_file():
+                    file_stat = path.stat()
+                    files[path.relative_to(self.base_dir).as_posix()] = [file_stat.st_mtime_ns, file_stat.st_size]
+        return files
+
+    def refresh(self, force: bool = False) -> dict:
+        """
+        Rebuilds the index file if any file under the roots was added, changed or removed.
+        Skipped if the last check was less than refresh_interval seconds ago (unless force).
+        Returns {"rebuilt", "reindexed", "reused", "seconds"}.
+        """
+        with self._lock:
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return {"rebuilt": False, "reindexed": 0, "reused": 0, "seconds": 0.0}
+            started = time.perf_counter()
+            self._last_refresh = time.time()
+            files = self._scan()
+            old_files = self._header["files"]
+            if self._mmap is not None and files == old_files:
+                return {"rebuilt": False, "reindexed": 0, "reused": len(files), "seconds": round(time.perf_counter() - started, 3)}
+
+            unchanged = {path for path, stats in files.items() if old_files.get(path) == stats}
+            # Chunks of unchanged files keep their text and term frequencies from the old index
+            chunks = []  # (source, file, text, {term: tf})
+            kept_ids = {i for i, chunk in enumerate(self._header["chunks"]) if chunk[0].split("#")[0] in unchanged}
+            kept_tf = {i: {} for i in kept_ids}
+            for term in self._header["lexicon"]:
+                with self._postings(term) as pairs:
+                    for j in range(0, len(pairs), 2):
+                        if pairs[j] in kept_tf:
+                            kept_tf[pairs[j]][term] = pairs[j + 1]
+            for chunk_id in sorted(kept_ids):
+                source = self._header["chunks"][chunk_id][0]
+                chunks.append((source, self._chunk_text(chunk_id), kept_tf[chunk_id]))
+
+            reindexed = 0
+            for path in sorted(set(files) - unchanged):
+                try:
+                    with open(self.base_dir / path, "r", encoding="utf-8") as f:
+                        text = f.read()
+                except (OSError, UnicodeDecodeError):
+                    continue
+                reindexed += 1
+                for source, chunk_text in chunk_document(path, text):
+                    tf = {}
+                    for token in tokenize(chunk_text):
+                        tf[token] = tf.get(token, 0) + 1
+                    chunks.append((source, chunk_text, tf))
+
+            self._write(chunks, files)
+            self._open()
+            return {"rebuilt": True, "reindexed": reindexed, "reused": len(unchanged), "seconds": round(time.perf_counter() - started, 3)}
+
+    def _write(self, chunks: list, files: dict):
+        """Packs chunks into a new index file and atomically replaces the old one (lock held)."""
+        postings = {}
+        chunk_table, texts, text_offset, total_tokens = [], [], 0, 0
+        for chunk_id, (source, text, tf) in enumerate(chunks):
+            encoded = text.encode("utf-8")
+            dl = sum(tf.values())
+            chunk_table.append([source, text_offset, len(encoded), dl])
+            texts.append(encoded)
+            text_offset += len(encoded)
+            total_tokens += dl
+            for term, count in tf.items():
+                postings.setdefault(term, []).extend((chunk_id, count))
+
+        lexicon, postings_data, offset = {}, array("I"), 0
+        for term in sorted(postings):
+            pairs = postings[term]
+            lexicon[term] = [offset, len(pairs) // 2]
+            postings_data.extend(pairs)
+            offset += len(pairs) * 4
+        header = {"byteorder": sys.byteorder, "lexicon": lexicon, "chunks": chunk_table, "files": files,
+                  "avgdl": total_tokens / len(chunks) if chunks else 0.0, "postings_bytes": offset}
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            postings_data.tofile(f)
+            for encoded in texts:
+                f.write(encoded)
+        self._close()
+        os.replace(tmp_path, self.index_path)
+
+    # --- Queries ---
+    def search(self, query: str, num_results: int = DEFAULT_NUM_RESULTS, source_filter: list = None) -> list:
+        """
+        BM25-ranked chunks for a query: [{"content", "source", "score", "coverage", "matched_terms"}],
+        best first. coverage is the IDF-weighted share of the query's terms found in the chunk,
+        matched_terms the number of distinct query terms it contains.
+        source_filter keeps chunks whose source contains one of the given strings.
+        """
+        self.refresh()
+        with self._lock:
+            chunks = self._header["chunks"]
+            n = len(chunks)
+            terms = list(dict.fromkeys(tokenize(query)))
+            if not n or not terms:
+                return []
+            avgdl = self._header["avgdl"] or 1.0
+            scores, matched, matched_terms = {}, {}, {}
+            idf = {}
+            for term in terms:
+                with self._postings(term) as pairs:
+                    df = len(pairs) // 2
+                    idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    for j in range(0, len(pairs), 2):
+                        chunk_id, tf = pairs[j], pairs[j + 1]
+                        dl = chunks[chunk_id][3]
+                        scores[chunk_id] = scores.get(chunk_id, 0.0) + idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+                        matched[chunk_id] = matched.get(chunk_id, 0.0) + idf[term]
+                        matched_terms[chunk_id] = matched_terms.get(chunk_id, 0) + 1
+            if source_filter:
+                scores = {c: s for c, s in scores.items() if any(f in chunks[c][0] for f in source_filter)}
+            total_idf = sum(idf.values())
+            best = heapq.nlargest(num_results, scores.items(), key=lambda item: item[1])
+            return [{"content": self._chunk_text(chunk_id), "source": chunks[chunk_id][0], "score": round(score, 4),
+                     "coverage": round(matched[chunk_id] / total_idf, 3), "matched_terms": matched_terms[chunk_id]}
+                    for chunk_id, score in best]
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self.index_path.stat().st_size if self.index_path.exists() else 0
+            return {"files": len(self._header["files"]), "chunks": len(self._header["chunks"]),
+                    "terms": len(self._header["lexicon"]), "bytes": size, "path": str(self.index_path)}
+
+
+# --- Answering Context7 Requests ---
+def answer(index: DocsIndex, parameters: dict, min_coverage: float = DOCS_MIN_COVERAGE,
+           min_matched_terms: int = DOCS_MIN_MATCHED_TERMS, min_score: float = DOCS_MIN_SCORE):
+    """
+    Answers a Context7 request from the index in the service's response shape
+    ({"status": "success", "results": [...]}). Returns None if nothing matches well enough:
+    the best chunk must reach min_coverage, contain min_matched_terms distinct query terms
+    and score at least min_score.
+    """
+    num_results = parameters.get("num_results") or DEFAULT_NUM_RESULTS
+    results = index.search(parameters.get("query", ""), int(num_results), parameters.get("source_filter"))
+    if not results:
+        return None
+    best = results[0]
+    if best["coverage"] < min_coverage or best["matched_terms"] < min_matched_terms or best["score"] < min_score:
+        return None
+    return {"status": "success", "results": results, "source": "local_docs_index"}
+
+
+def merge_results(local_results: list, remote_response: dict, num_results: int = None) -> dict:
+    """Interleaves local results with a remote Context7 response's results, local first."""
+    remote_results = remote_response.get("results") if isinstance(remote_response.get("results"), list) else []
+    merged, seen = [], set()
+    for i in range(max(len(local_results), len(remote_results))):
+        for result in (local_results[i:i + 1] + remote_results[i:i + 1]):
+            key = (result.get("content") or "").strip()
+            if key not in seen:
+                seen.add(key)
+                merged.append(result)
+    merged = merged[:num_results] if num_results else merged
+    return {**remote_response, "status": "success", "results": merged, "source": "local_docs_index+remote"}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> DocsIndex:
+    """Returns the process-wide docs index, opening it on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = DocsIndex()
+        return _index
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Build the local docs index or query it as Context7 would.")
+    parser.add_argument("query", nargs="?", help="Query to run against the index")
+    parser.add_argument("--num-results", type=int, default=DEFAULT_NUM_RESULTS)
+    args = parser.parse_args(argv)
+
+    index = get_index()
+    result = index.refresh(force=True)
+    print(f"Docs index: {'rebuilt' if result['rebuilt'] else 'up to date'} ({result['reindexed']} files read, {result['reused']} reused) in {result['seconds']}s.")
+    print(json.dumps(index.stats()))
+    for hit in (index.search(args.query, args.num_results) if args.query else []):
+        print(f"\n--- {hit['source']} (score {hit['score']}, coverage {hit['coverage']}, {hit['matched_terms']} term(s)) ---\n{hit['content'][:500]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Configuration Section: Shared HTTP Transport ---
+# All outbound HTTP calls (Ollama, Anthropic, MCPs, n8n) go through this module so
+# that each base URL (scheme + host + port) gets one long-lived requests.Session
+# with a keep-alive connection pool, instead of a fresh TCP/TLS handshake per call.
+#
+# Retries are opt-in per call (retry=True) and should only be used for idempotent
+# requests. Only connection-level failures and the status codes below are retried;
+# read timeouts are not, since the LLM calls already wait up to 5 minutes.
+
+# Maximum number of pooled keep-alive connections per base URL.
+HTTP_POOL_MAXSIZE = int(os.getenv("AI_RAILS_HTTP_POOL_MAXSIZE", "10"))
+
+# Number of retries (after the first attempt) for calls made with retry=True.
+HTTP_MAX_RETRIES = int(os.getenv("AI_RAILS_HTTP_MAX_RETRIES", "3"))
+
+# Exponential backoff with full jitter: sleep uniform(0, min(MAX, BASE * 2**attempt)) seconds.
+HTTP_BACKOFF_BASE = float(os.getenv("AI_RAILS_HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("AI_RAILS_HTTP_BACKOFF_MAX", "8.0"))
+
+# HTTP status codes that indicate a transient failure worth retrying.
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+_sessions = {}       # base URL -> requests.Session
+_request_stats = {}  # base URL -> {"requests": int, "retries": int, "failures": int}
+_lock = threading.Lock()
+
+
+def _base_url(url: str) -> str:
+    """Returns the scheme://host:port part of a URL, used as the session key."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the shared keep-alive session for the base URL of `url`, creating it on first use."""
+    base_url = _base_url(url)
+    with _lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[base_url] = session
+            _request_stats[base_url] = {"requests": 0, "retries": 0, "failures": 0}
+        return session
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff delay for the given (0-based) retry attempt."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _record(base_url: str, key: str):
+    with _lock:
+        _request_stats[base_url][key] += 1
+
+
+def post(url: str, retry: bool = False, max_retries: int = None, **kwargs) -> requests.Response:
+    """
+    Sends a POST through the pooled session for the URL's base.
+    Accepts the same keyword arguments as requests.post (json, headers, timeout, stream, ...).
+
+    With retry=True, connection errors and RETRYABLE_STATUS_CODES are retried up to
+    max_retries times (default HTTP_MAX_RETRIES) with jittered exponential backoff.
+    The last response is returned as-is, so callers still use raise_for_status().
+    """
+    session = get_session(url)
+    base_url = _base_url(url)
+    retries_left = (HTTP_MAX_RETRIES if max_retries is None else max_retries) if retry else 0
+    attempt = 0
+    while True:
+        _record(base_url, "requests")
+        try:
+            response = session.post(url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            if attempt >= retries_left:
+                _record(base_url, "failures")
+                raise
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= retries_left:
+                return response
+            response.close()
+        _record(base_url, "retries")
+        time.sleep(_backoff_delay(attempt))
+        attempt += 1
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Sends a GET (e.g. a health check) through the pooled session for the URL's base, without retries."""
+    session = get_session(url)
+    base_url = _base_url(url)
+    _record(base_url, "requests")
+    try:
+        return session.get(url, **kwargs)
+    except requests.exceptions.RequestException:
+        _record(base_url, "failures")
+        raise
+
+
+def get_transport_stats() -> dict:
+    """
+    Returns per-base-URL transport statistics:
+    requests sent, connections opened, connections reused, retries and final failures.
+    """
+    stats = {}
+    with _lock:
+        for base_url, session in _sessions.items():
+            connections_opened = 0
+            pool_requests = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    connections_opened += pool.num_connections
+                    pool_requests += pool.num_requests
+            entry = dict(_request_stats[base_url])
+            entry["connections_opened"] = connections_opened
+            entry["connections_reused"] = max(0, pool_requests - connections_opened)
+            stats[base_url] = entry
+    return stats
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+# --- Configuration Section: LLM Response Cache ---
+# An opt-in, content-addressed on-disk cache for LLM generations.
+# Entries are keyed on a SHA-256 of the backend, model, full prompt (system prompt and
+# messages) and generation parameters, so any change to a template, an MCP definition
+# or the conversation produces a new key. Re-running planning on the same
+# initial_project_idea.md, or replaying a session, is then served from disk.
+#
+# The cache is bounded by LLM_CACHE_MAX_BYTES; when it is exceeded the least recently
+# used entries (by file mtime, which is bumped on every hit) are evicted.
+
+LLM_CACHE_DIR = Path(os.getenv("AI_RAILS_LLM_CACHE_DIR", str(Path(__file__).parent.resolve() / "output" / ".llm_cache")))
+LLM_CACHE_MAX_BYTES = int(os.getenv("AI_RAILS_LLM_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# Workflow types ("new_project", "feature_update", "execution") for which the cache is on.
+# Empty (the default) disables it everywhere.
+LLM_CACHE_WORKFLOWS = [w.strip() for w in os.getenv("AI_RAILS_LLM_CACHE_WORKFLOWS", "").split(",") if w.strip()]
+
+
+def make_cache_key(backend: str, model: str, system_prompt: str, messages: list, params: dict = None) -> str:
+    """Returns the content address for a generation request."""
+    payload = {
+        "backend": backend,
+        "model": model,
+        "system": system_prompt,
+        "messages": messages,
+        "params": params or {},
+    }
+    serialized = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Size-capped, LRU-evicted store of LLM responses under cache_dir/<key[:2]>/<key>.json.
+    Safe to share between threads of one process.
+    """
+
+    def __init__(self, cache_dir: Path = LLM_CACHE_DIR, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = None  # path -> (mtime, size), loaded lazily
+        self._total_bytes = 0
+
+    def _path_for(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _load_index(self):
+        """Scans the cache directory once to learn entry sizes and recency (lock held)."""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._total_bytes = 0
+        if self.cache_dir.exists():
+            for path in self.cache_dir.glob("*/*.json"):
+                stat = path.stat()
+                self._entries[path] = (stat.st_mtime, stat.st_size)
+                self._total_bytes += stat.st_size
+
+    def get(self, key: str):
+        """Returns the cached response text, or None on a miss."""
+        path = self._path_for(key)
+        with self._lock:
+            try:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Bump recency for LRU eviction
+            now = time.time()
+            os.utime(path, (now, now))
+            if self._entries is not None and path in self._entries:
+                self._entries[path] = (now, self._entries[path][1])
+            return entry.get("response")
+
+    def put(self, key: str, response: str, metadata: dict = None):
+        """Stores a response and evicts least recently used entries above max_bytes."""
+        path = self._path_for(key)
+        entry = {"response": response, "created": time.time(), "metadata": metadata or {}}
+        with self._lock:
+            self._load_index()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+
+            stat = path.stat()
+            previous = self._entries.get(path)
+            if previous:
+                self._total_bytes -= previous[1]
+            self._entries[path] = (stat.st_mtime, stat.st_size)
+            self._total_bytes += stat.st_size
+            self._evict()
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes (lock held)."""
+        if self._total_bytes <= self.max_bytes:
+            return
+        for path, (mtime, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            del self._entries[path]
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries) if self._entries is not None else None,
+                "bytes": self._total_bytes if self._entries is not None else None,
+            }
@@ -0,0 +1,277 @@
+import os
+import re
+import sys
+import json
+import gzip
+import sqlite3
+import argparse
+import time
+from datetime import datetime
+from pathlib import Path
+
+# --- Configuration Section: Log Index ---
+# Incremental SQLite index over the JSONL log written by ai_rails_backend.log_event.
+# The indexer remembers the byte offset (and inode) it reached in ai-rails.log, so each
+# run only parses lines appended since the last one. If the log was rotated in between
+# (see log_writer.py), the remainder of the newest rotated backup is ingested first.
+#
+# Usage:
+#   python log_index.py index
+#   python log_index.py sessions [--limit 20]
+#   python log_index.py session <session_id>
+#   python log_index.py tools [--session <id>]
+#   python log_index.py latency [--session <id>]
+#   python log_index.py errors [--session <id>] [--limit 50]
+
+PROJECT_ROOT = Path(__file__).parent.resolve()
+LOG_FILE = PROJECT_ROOT / "log" / "ai-rails.log"
+LOG_INDEX_DB = Path(os.getenv("AI_RAILS_LOG_INDEX_DB", str(PROJECT_ROOT / "log" / "ai-rails-index.sqlite")))
+
+# Event types reported by the 'errors' query, in addition to tool results with status "error".
+ERROR_EVENT_TYPES = ["ERROR", "LLM_ERROR", "AGENT_OUTPUT_INVALID_JSON", "AGENT_NO_RESPONSE"]
+
+# Approval decisions reported by the 'tools' query: by the human, by the approval policy or
+# a headless handler, and requests the policy escalated (see approval_policy.py).
+DECISION_EVENT_TYPES = ["HUMAN_DECISION", "AUTO_DECISION", "ESCALATED"]
+
+INSERT_BATCH_SIZE = 5000
+
+_TOOL_RESULT_PATTERN = re.compile(r"^Tool (\S+) executed\. Status: (\S+)")
+
+_INSERT_EVENT_SQL = ("INSERT INTO events (timestamp, session_id, agent_role, llm_model, event_type, tool_name, message, details) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT,
+    session_id TEXT,
+    agent_role TEXT,
+    llm_model TEXT,
+    event_type TEXT,
+    tool_name TEXT,
+    message TEXT,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_session ON events (session_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_events_role ON events (agent_role, timestamp);
+CREATE INDEX IF NOT EXISTS idx_events_type ON events (event_type, timestamp);
+CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events (timestamp);
+CREATE TABLE IF NOT EXISTS ingest_state (
+    log_path TEXT PRIMARY KEY,
+    inode INTEGER,
+    offset INTEGER,
+    indexed_at REAL
+);
+"""
+
+
+def connect(db_path: Path = LOG_INDEX_DB) -> sqlite3.Connection:
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _event_row(line: str):
+    """Parses one log line into an events row, or None if it is not valid JSON."""
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    details = entry.get("details") or {}
+    message = entry.get("message", "")
+    tool_name = details.get("tool_name") if isinstance(details, dict) else None
+    if not tool_name:
+        match = _TOOL_RESULT_PATTERN.match(message)
+        if match:
+            tool_name = match.group(1)
+    return (
+        entry.get("timestamp"),
+        entry.get("session_id"),
+        entry.get("agent_role"),
+        entry.get("llm_model_used"),
+        entry.get("event_type"),
+        tool_name,
+        message,
+        json.dumps(details),
+    )
+
+
+def _ingest_stream(conn: sqlite3.Connection, stream, offset: int) -> tuple:
+    """
+    Ingests complete lines from a binary stream starting at offset.
+    Returns (new_offset, rows_ingested); a trailing partial line is left for the next run.
+    """
+    stream.seek(offset)
+    rows = []
+    ingested = 0
+    for raw_line in stream:
+        if not raw_line.endswith(b"\n"):
+            break
+        offset += len(raw_line)
+        row = _event_row(raw_line.decode("utf-8", errors="replace"))
+        if row:
+            rows.append(row)
+        if len(rows) >= INSERT_BATCH_SIZE:
+            conn.executemany(_INSERT_EVENT_SQL, rows)
+            ingested += len(rows)
+            rows = []
+    if rows:
+        conn.executemany(_INSERT_EVENT_SQL, rows)
+        ingested += len(rows)
+    return offset, ingested
+
+
+def _rotated_backup_since(log_file: Path, indexed_at: float):
+    """
+    Returns the backup the previously indexed file was rotated into: the oldest backup
+    written after the last index run (later ones were never seen at all).
+    """
+    backups = sorted(log_file.parent.glob(f"{log_file.name}.*"))
+    for backup in backups:
+        if indexed_at is None or backup.stat().st_mtime >= indexed_at:
+            return backup
+    return None
+
+
+def index_log(conn: sqlite3.Connection, log_file: Path = LOG_FILE) -> int:
+    """Ingests lines appended to log_file since the last run. Returns the number of new events."""
+    if not log_file.exists():
+        return 0
+    state = conn.execute("SELECT inode, offset, indexed_at FROM ingest_state WHERE log_path = ?", (str(log_file),)).fetchone()
+    inode, offset, indexed_at = state if state else (None, 0, None)
+    stat = log_file.stat()
+    ingested = 0
+
+    with conn:
+        if inode is not None and (stat.st_ino != inode or stat.st_size < offset):
+            # The log was rotated since the last run: finish the rotated file, then start over.
+            # Backups rotated out in between that were never indexed are not back-filled.
+            backup = _rotated_backup_since(log_file, indexed_at)
+            if backup is not None and offset:
+                opener = gzip.open if backup.suffix == ".gz" else open
+                with opener(backup, "rb") as stream:
+                    _, count = _ingest_stream(conn, stream, offset)
+                    ingested += count
+            offset = 0
+
+        with open(log_file, "rb") as stream:
+            offset, count = _ingest_stream(conn, stream, offset)
+            ingested += count
+
+        conn.execute("INSERT OR REPLACE INTO ingest_state (log_path, inode, offset, indexed_at) VALUES (?, ?, ?, ?)",
+                     (str(log_file), stat.st_ino, offset, time.time()))
+    return ingested
+
+
+# --- Queries ---
+def query_sessions(conn: sqlite3.Connection, limit: int = 20) -> list:
+    return conn.execute(
+        """SELECT session_id, MIN(timestamp), MAX(timestamp), COUNT(*),
+                  SUM(CASE WHEN event_type IN ({}) THEN 1 ELSE 0 END)
+           FROM events WHERE session_id != 'default'
+           GROUP BY session_id ORDER BY MAX(timestamp) DESC LIMIT ?""".format(",".join("?" * len(ERROR_EVENT_TYPES))),
+        (*ERROR_EVENT_TYPES, limit),
+    ).fetchall()
+
+
+def query_session(conn: sqlite3.Connection, session_id: str) -> list:
+    return conn.execute(
+        "SELECT timestamp, agent_role, event_type, message FROM events WHERE session_id = ? ORDER BY timestamp, id",
+        (session_id,),
+    ).fetchall()
+
+
+def query_tools(conn: sqlite3.Connection, session_id: str = None) -> list:
+    event_types = ["MCP_REQUEST_FORMULATED", *DECISION_EVENT_TYPES, "TOOL_EXECUTION_RESULT"]
+    sql = """SELECT timestamp, session_id, agent_role, event_type, tool_name, message FROM events
+             WHERE event_type IN ({})""".format(",".join("?" * len(event_types)))
+    params = event_types
+    if session_id:
+        sql += " AND session_id = ?"
+        params.append(session_id)
+    return conn.execute(sql + " ORDER BY timestamp, id", params).fetchall()
+
+
+def query_latency(conn: sqlite3.Connection, session_id: str = None) -> list:
+    """
+    Returns (llm_model, calls, avg_ms, max_ms) per model.
+    Uses details.duration_ms when the response event carries it; otherwise pairs each
+    LLM_CALL with the next LLM_RESPONSE/LLM_ERROR for the same model.
+    """
+    sql = "SELECT id, timestamp, llm_model, event_type, details FROM events WHERE event_type IN ('LLM_CALL', 'LLM_RESPONSE', 'LLM_ERROR')"
+    params = ()
+    if session_id:
+        sql += " AND session_id = ?"
+        params = (session_id,)
+    pending = {}
+    durations = {}
+    for _, timestamp, model, event_type, details in conn.execute(sql + " ORDER BY id", params):
+        if event_type == "LLM_CALL":
+            pending[model] = timestamp
+            continue
+        duration_ms = json.loads(details or "{}").get("duration_ms")
+        started = pending.pop(model, None)
+        if duration_ms is None and started:
+            duration_ms = (datetime.fromisoformat(timestamp) - datetime.fromisoformat(started)).total_seconds() * 1000
+        if duration_ms is not None:
+            durations.setdefault(model, []).append(duration_ms)
+    return [(model, len(values), sum(values) / len(values), max(values)) for model, values in sorted(durations.items())]
+
+
+def query_errors(conn: sqlite3.Connection, session_id: str = None, limit: int = 50) -> list:
+    sql = """SELECT timestamp, session_id, agent_role, event_type, message FROM events
+             WHERE (event_type IN ({}) OR (event_type = 'TOOL_EXECUTION_RESULT' AND message LIKE '%Status: error'))""".format(",".join("?" * len(ERROR_EVENT_TYPES)))
+    params = list(ERROR_EVENT_TYPES)
+    if session_id:
+        sql += " AND session_id = ?"
+        params.append(session_id)
+    return conn.execute(sql + " ORDER BY timestamp DESC, id DESC LIMIT ?", (*params, limit)).fetchall()
+
+
+def _print_rows(headers: list, rows: list):
+    rows = [["" if v is None else (f"{v:.1f}" if isinstance(v, float) else str(v)) for v in row] for row in rows]
+    widths = [min(60, max([len(h)] + [len(r[i]) for r in rows])) for i, h in enumerate(headers)]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    print("  ".join("-" * w for w in widths))
+    for row in rows:
+        print("  ".join(v[:w].ljust(w) for v, w in zip(row, widths)))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Index and query the AI Rails event log.")
+    parser.add_argument("--log", type=Path, default=LOG_FILE, help="Path to ai-rails.log")
+    parser.add_argument("--db", type=Path, default=LOG_INDEX_DB, help="Path to the SQLite index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("index", help="Ingest new log lines")
+    sessions_parser = subparsers.add_parser("sessions", help="List recent sessions")
+    sessions_parser.add_argument("--limit", type=int, default=20)
+    session_parser = subparsers.add_parser("session", help="Show the event timeline of one session")
+    session_parser.add_argument("session_id")
+    for name, help_text in [("tools", "List tool requests, decisions and results"), ("latency", "Summarize LLM call latencies per model"), ("errors", "List recent errors")]:
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--session", dest="session_id")
+        if name == "errors":
+            sub.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    conn = connect(args.db)
+    ingested = index_log(conn, args.log)
+    if args.command == "index":
+        print(f"Indexed {ingested} new events into {args.db}.")
+    elif args.command == "sessions":
+        _print_rows(["session_id", "started", "last_event", "events", "errors"], query_sessions(conn, args.limit))
+    elif args.command == "session":
+        _print_rows(["timestamp", "agent_role", "event_type", "message"], query_session(conn, args.session_id))
+    elif args.command == "tools":
+        _print_rows(["timestamp", "session_id", "agent_role", "event_type", "tool", "message"], query_tools(conn, args.session_id))
+    elif args.command == "latency":
+        _print_rows(["llm_model", "calls", "avg_ms", "max_ms"], query_latency(conn, args.session_id))
+    elif args.command == "errors":
+        _print_rows(["timestamp", "session_id", "agent_role", "event_type", "message"], query_errors(conn, args.session_id, args.limit))
+    conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import os
+import atexit
+import gzip
+import queue
+import shutil
+import signal
+import threading
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no inter-process locking
+    fcntl = None
+
+# --- Configuration Section: Background Log Writer ---
+# log_event() used to open ai-rails.log, append one line and close it on every event,
+# synchronously on the orchestrator thread. This module replaces that with a single
+# writer thread per process: callers serialize their entry and enqueue it, and the
+# writer keeps the file open and writes whatever has queued up as one batch.
+# Because only the writer thread touches the file, lines from concurrent sessions
+# (threads) can never interleave.
+#
+# Several processes may share one log (run_workflow.sh sessions, batch_runner,
+# workflow_dag, log_index). Each line is appended with a single O_APPEND write, so lines
+# from different processes never split each other. Writers hold a shared flock() on
+# .<log name>.lock while appending a batch, and reopen the file first if its inode has
+# changed; rotation renames the file under the exclusive lock. So no process keeps
+# appending to a log another one has rotated away.
+#
+# The log is rotated by size or by date; rotated files are gzip-compressed and only the
+# newest LOG_BACKUP_COUNT are kept. Pending lines are flushed on interpreter exit
+# (including uncaught exceptions and SIGTERM).
+
+# "size" rotates when the file exceeds LOG_MAX_BYTES, "daily" when the date changes.
+LOG_ROTATE_WHEN = os.getenv("AI_RAILS_LOG_ROTATE", "size").lower()
+LOG_MAX_BYTES = int(float(os.getenv("AI_RAILS_LOG_MAX_MB", "50")) * 1024 * 1024)
+LOG_BACKUP_COUNT = int(os.getenv("AI_RAILS_LOG_BACKUPS", "10"))
+LOG_COMPRESS = os.getenv("AI_RAILS_LOG_COMPRESS", "true").lower() == "true"
+
+# Maximum seconds a queued line waits before it is flushed to disk.
+LOG_FLUSH_INTERVAL = float(os.getenv("AI_RAILS_LOG_FLUSH_INTERVAL", "0.5"))
+
+# Maximum lines written per batch before flushing.
+LOG_BATCH_SIZE = int(os.getenv("AI_RAILS_LOG_BATCH_SIZE", "500"))
+
+_STOP = object()
+
+
+class BackgroundLogWriter:
+    """Single-writer, queue-backed appender for a JSONL log file with rotation."""
+
+    def __init__(self, log_file: Path, rotate_when: str = LOG_ROTATE_WHEN, max_bytes: int = LOG_MAX_BYTES,
+                 backup_count: int = LOG_BACKUP_COUNT, compress: bool = LOG_COMPRESS,
+                 flush_interval: float = LOG_FLUSH_INTERVAL, batch_size: int = LOG_BATCH_SIZE):
+        self.log_file = Path(log_file)
+        self.lock_file = self.log_file.with_name(f".{self.log_file.name}.lock")
+        self.rotate_when = rotate_when
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._fd = None
+        self._opened_on = None
+        self._closed = False
+        self._state_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="ai-rails-log-writer", daemon=True)
+        self._thread.start()
+
+    # --- Public API ---
+    def write(self, line: str):
+        """Queues one already-serialized log line (without trailing newline)."""
+        with self._state_lock:
+            if not self._closed:
+                self._queue.put(line)
+                return
+        # After close() (e.g. during interpreter shutdown) fall back to a direct append
+        try:
+            with _FileLock(self.lock_file, exclusive=False):
+                fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, (line + "\n").encode("utf-8"))
+                finally:
+                    os.close(fd)
+        except OSError as e:
+            print(f"Error writing to log file {self.log_file}: {e}")
+
+    def flush(self):
+        """Blocks until every line queued so far has been written and flushed."""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        """Flushes pending lines and stops the writer thread."""
+        with self._state_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    # --- Writer thread ---
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = [entry for entry in batch if entry is not _STOP]
+            try:
+                if lines:
+                    self._write_batch(lines)
+            except OSError as e:
+                print(f"Error writing to log file {self.log_file}: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if len(lines) < len(batch):
+                self._close_fd()
+                return
+
+    def _write_batch(self, lines: list):
+        """
+        Appends lines, each with one O_APPEND write, under a shared lock on the lock file so
+        no other process rotates the log mid-batch. A line that fails is retried once on a
+        reopened file; if it fails again only that line is dropped.
+        """
+        if self._should_rotate():
+            self._rotate()
+        with _FileLock(self.lock_file, exclusive=False):
+            self._reopen_if_moved()
+            for line in lines:
+                data = (line + "\n").encode("utf-8")
+                try:
+                    os.write(self._fd, data)
+                except OSError:
+                    self._close_fd()
+                    try:
+                        self._open()
+                        os.write(self._fd, data)
+                    except OSError as e:
+                        print(f"Error writing to log file {self.log_file}: {e}")
+
+    def _open(self):
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        stat = os.fstat(self._fd)
+        # A file last written on an earlier day is rotated by the first write of the day
+        self._opened_on = datetime.fromtimestamp(stat.st_mtime).date() if stat.st_size else datetime.now().date()
+
+    def _close_fd(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def _reopen_if_moved(self):
+        """Reopens the log if it is not open or another process has rotated it away (lock held)."""
+        if self._fd is not None:
+            try:
+                path_stat = os.stat(self.log_file)
+                fd_stat = os.fstat(self._fd)
+                if (path_stat.st_dev, path_stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino):
+                    return
+            except FileNotFoundError:
+                pass
+            self._close_fd()
+        self._open()
+
+    def _should_rotate(self) -> bool:
+        if self._fd is None:
+            return False
+        if self.rotate_when == "daily":
+            return datetime.now().date() != self._opened_on
+        return self.max_bytes > 0 and os.fstat(self._fd).st_size >= self.max_bytes
+
+    def _rotate(self):
+        """
+        Renames the current log aside under the exclusive lock (unless another process just
+        did), then compresses it and prunes old backups. Writers append only while holding the
+        shared lock and after checking the path's inode, so none writes to the renamed file
+        once the rename is done.
+        """
+        rotated = None
+        with _FileLock(self.lock_file, exclusive=True):
+            self._reopen_if_moved()
+            if self._should_rotate():
+                suffix = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+                rotated = self.log_file.with_name(f"{self.log_file.name}.{suffix}")
+                os.replace(self.log_file, rotated)
+                self._close_fd()
+                self._open()
+        if rotated is None:
+            return
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            rotated.unlink()
+        with _FileLock(self.lock_file, exclusive=True):
+            self._prune_backups()
+
+    def _prune_backups(self):
+        backups = sorted(self.log_file.parent.glob(f"{self.log_file.name}.*"))
+        for old_backup in backups[:-self.backup_count] if self.backup_count > 0 else backups:
+            try:
+                old_backup.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class _FileLock:
+    """flock() on a lock file next to the log, shared by every process writing it (no-op without fcntl)."""
+
+    def __init__(self, path: Path, exclusive: bool):
+        self.path = path
+        self.exclusive = exclusive
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(log_file: Path) -> BackgroundLogWriter:
+    """Returns the process-wide writer for log_file, starting it on first use."""
+    key = str(Path(log_file).resolve())
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = BackgroundLogWriter(log_file)
+            _writers[key] = writer
+        return writer
+
+
+def close_log_writer(log_file: Path):
+    """Flushes and closes the writer for log_file, if one was started."""
+    key = str(Path(log_file).resolve())
+    with _writers_lock:
+        writer = _writers.pop(key, None)
+    if writer is not None:
+        writer.close()
+
+
+def close_all_writers():
+    """Flushes and closes every writer (registered with atexit)."""
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_all_writers)
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _install_sigterm_flush():
+    """Turns SIGTERM into a normal exit so atexit flushes the log, unless a handler is already set."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+_install_sigterm_flush()
@@ -0,0 +1,224 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+
+# --- Configuration Section: Timing Spans and Metrics ---
+# In-process instrumentation for the orchestrator's hot paths: prompt compilation, LLM
+# calls, MCP calls and the time spent waiting for a human decision. Each span is
+# recorded twice:
+#   - in a process-wide histogram, exported in Prometheus text format to
+#     METRICS_TEXTFILE (point node_exporter's textfile collector at its directory), and
+#   - in a per-session aggregate, logged as SESSION_METRICS at the end of a workflow so a
+#     slow session can be attributed to the model, a tool host or the human. The aggregate
+#     is dropped once logged, so long batch and DAG runs do not accumulate sessions.
+#
+# The current session is carried in a context variable (see session_context), so code
+# deep in the call stack does not need a session_id argument. asyncio.to_thread copies
+# the context, so concurrent tool calls are attributed to the right session too.
+
+METRICS_ENABLED = os.getenv("AI_RAILS_METRICS_ENABLED", "true").lower() == "true"
+METRICS_TEXTFILE = Path(os.getenv("AI_RAILS_METRICS_TEXTFILE", str(Path(__file__).parent.resolve() / "log" / "ai-rails.prom")))
+
+# Histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRIC_PREFIX = "ai_rails"
+
+# Help text for the Prometheus export; unknown names get a generic description.
+METRIC_HELP = {
+    "prompt_build": "Time spent compiling an agent system prompt.",
+    "llm_call": "Wall-clock time of an LLM call, including streaming.",
+    "llm_prompt_eval": "Prompt evaluation (prefill) time reported by Ollama.",
+    "llm_eval": "Token generation time reported by Ollama.",
+    "llm_eval_tokens": "Tokens generated, as reported by the LLM backend.",
+    "llm_prompt_tokens": "Prompt tokens evaluated, as reported by the LLM backend.",
+    "mcp_call": "Wall-clock time of an MCP/n8n HTTP call.",
+    "approval_wait": "Time spent waiting for a human decision.",
+    "llm_failover": "LLM calls retried on the next route target after a failure.",
+    "llm_hedge": "Slow Ollama calls also sent to a second target.",
+}
+
+_current_session = contextvars.ContextVar("ai_rails_session_id", default="default")
+
+
+@contextmanager
+def session_context(session_id: str):
+    """Attributes every span and counter recorded inside the block to session_id."""
+    token = _current_session.set(session_id)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+
+def current_session() -> str:
+    return _current_session.get()
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(label_key: tuple, extra: tuple = ()) -> str:
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry:
+    """Thread-safe store of latency histograms and counters, globally and per session."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._textfile_lock = threading.Lock()  # Serialises write_textfile across sessions
+        self._histograms = {}  # (name, label_key) -> {"buckets": [..], "sum": float, "count": int}
+        self._counters = {}    # (name, label_key) -> float
+        self._sessions = {}    # session_id -> {(name, label_key): {"count", "total", "max"}} / counters
+
+    def observe(self, name: str, seconds: float, labels: dict = None, session_id: str = None):
+        """Records one duration (in seconds) for a span."""
+        if not METRICS_ENABLED:
+            return
+        label_key = _label_key(labels)
+        session_id = session_id or current_session()
+        with self._lock:
+            histogram = self._histograms.setdefault((name, label_key), {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+            spans = self._sessions.setdefault(session_id, {"spans": {}, "counters": {}})["spans"]
+            entry = spans.setdefault((name, label_key), {"count": 0, "total": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def inc(self, name: str, value: float = 1, labels: dict = None, session_id: str = None):
+        """Adds value to a counter."""
+        if not METRICS_ENABLED:
+            return
+        label_key = _label_key(labels)
+        session_id = session_id or current_session()
+        with self._lock:
+            self._counters[(name, label_key)] = self._counters.get((name, label_key), 0) + value
+            counters = self._sessions.setdefault(session_id, {"spans": {}, "counters": {}})["counters"]
+            counters[(name, label_key)] = counters.get((name, label_key), 0) + value
+
+    def session_summary(self, session_id: str) -> dict:
+        """
+        Returns the session's spans as {"name{label=value}": {count, total_ms, avg_ms, max_ms}},
+        its counters, tokens/sec for Ollama generation, and total seconds per span name.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id, {"spans": {}, "counters": {}})
+            spans = {key: dict(value) for key, value in session["spans"].items()}
+            counters = dict(session["counters"])
+
+        summary = {"spans": {}, "counters": {}, "totals_seconds": {}}
+        for (name, label_key), entry in sorted(spans.items()):
+            summary["spans"][name + _format_labels(label_key)] = {
+                "count": entry["count"],
+                "total_ms": round(entry["total"] * 1000, 1),
+                "avg_ms": round(entry["total"] * 1000 / entry["count"], 1),
+                "max_ms": round(entry["max"] * 1000, 1),
+            }
+            summary["totals_seconds"][name] = round(summary["totals_seconds"].get(name, 0.0) + entry["total"], 3)
+        for (name, label_key), value in sorted(counters.items()):
+            summary["counters"][name + _format_labels(label_key)] = value
+            if name == "llm_eval_tokens":
+                eval_entry = spans.get(("llm_eval", label_key))
+                if eval_entry and eval_entry["total"] > 0:
+                    summary.setdefault("tokens_per_second", {})[_format_labels(label_key) or "all"] = round(value / eval_entry["total"], 1)
+        return summary
+
+    def forget_session(self, session_id: str):
+        """Drops a finished session's aggregate; the process-wide histograms keep its spans."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def render_prometheus(self) -> str:
+        """Renders all histograms and counters in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for metric_name in sorted({name for name, _ in histograms}):
+            full_name = f"{METRIC_PREFIX}_{metric_name}_seconds"
+            lines.append(f"# HELP {full_name} {METRIC_HELP.get(metric_name, 'Span duration.')}")
+            lines.append(f"# TYPE {full_name} histogram")
+            for (name, label_key), histogram in sorted(histograms.items()):
+                if name != metric_name:
+                    continue
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f"{full_name}_bucket{_format_labels(label_key, (('le', repr(bound)),))} {count}")
+                lines.append(f"{full_name}_bucket{_format_labels(label_key, (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{full_name}_sum{_format_labels(label_key)} {histogram['sum']:.6f}")
+                lines.append(f"{full_name}_count{_format_labels(label_key)} {histogram['count']}")
+        for metric_name in sorted({name for name, _ in counters}):
+            full_name = f"{METRIC_PREFIX}_{metric_name}_total"
+            lines.append(f"# HELP {full_name} {METRIC_HELP.get(metric_name, 'Counter.')}")
+            lines.append(f"# TYPE {full_name} counter")
+            for (name, label_key), value in sorted(counters.items()):
+                if name == metric_name:
+                    lines.append(f"{full_name}{_format_labels(label_key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path = METRICS_TEXTFILE):
+        """Atomically writes the Prometheus export (node_exporter textfile collector format)."""
+        if not METRICS_ENABLED:
+            return
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The temp name is per process, and concurrent sessions (fan-out, batch, DAG) share it
+        with self._textfile_lock:
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+
+
+METRICS = MetricsRegistry()
+
+
+class span:
+    """
+    Times a block and records it in METRICS on exit:
+
+        with metrics.span("mcp_call", tool=tool_name) as s:
+            result = ...
+            s.labels["status"] = "ok"
+
+    Labels may be changed inside the block; elapsed_ms can be read at any time.
+    A block that raises is recorded with status="error".
+    """
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.labels["status"] = "error"
+        METRICS.observe(self.name, time.perf_counter() - self._started, self.labels)
+        return False
+
+    @property
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._started) * 1000, 1)
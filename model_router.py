@@ -0,0 +1,319 @@
+import os
+import json
+import fnmatch
+import threading
+import contextvars
+from pathlib import Path
+
+import metrics
+
+# --- Configuration Section: Model Router ---
+# Picks the LLM backend and model for each agent turn, fails over to the next target when
+# a call errors or times out, and can hedge a slow Ollama call against the next target.
+#
+# Without a routes file, every turn goes to the backend chosen for the session, and only
+# to it: a session that chose local Ollama never sends its prompts to the Claude API
+# unless a route lists Claude as a target. A routes file (AI_RAILS_MODEL_ROUTES) sends
+# turns elsewhere by agent role and prompt size, with failover:
+#
+#   {
+#     "routes": [
+#       {"name": "long prompts", "min_prompt_chars": 60000,
+#        "targets": [{"backend": "claude"}, {"backend": "ollama"}]},
+#       {"name": "reviews", "agent_roles": ["Code Review Agent"],
+#        "targets": [{"backend": "ollama", "model": "qwen2.5-coder:32b", "timeout_s": 120},
+#                    {"backend": "claude", "model": "claude-3-opus-20240229"}]}
+#     ]
+#   }
+#
+# Routes are checked in order and the first match wins; turns no route matches use the
+# session default. Route fields:
+#   - agent_roles:      agent roles or glob patterns (default: every role)
+#   - min_prompt_chars: / max_prompt_chars: bounds on system prompt + messages, in characters
+#   - targets:          tried in order; "model" defaults to AI_RAILS_OLLAMA_MODEL /
+#                       AI_RAILS_CLAUDE_MODEL and "timeout_s" to LLM_TIMEOUT
+#
+# Hedging (LLM_HEDGE_AFTER_S > 0): if an Ollama target has not produced its first token
+# within that many seconds, the same request is also sent to the next target and the
+# first backend to answer wins; the other one is abandoned. Without streaming, "answer"
+# means a complete response.
+#
+# First-token timeout (LLM_FIRST_TOKEN_TIMEOUT_S > 0): a streamed call to a target that is
+# not hedged but has a target after it is abandoned if it produces no token within that
+# many seconds, and the turn fails over, instead of waiting the full LLM_TIMEOUT for a
+# stalled host. It is generous by default because Ollama may first load the model.
+#
+# With AI_RAILS_LLM_FAILOVER=false each turn only goes to its first target (no hedging).
+
+MODEL_ROUTES_FILE = os.getenv("AI_RAILS_MODEL_ROUTES", "")
+LLM_FAILOVER = os.getenv("AI_RAILS_LLM_FAILOVER", "true").lower() == "true"
+LLM_HEDGE_AFTER_S = float(os.getenv("AI_RAILS_LLM_HEDGE_AFTER_S", "20"))
+LLM_FIRST_TOKEN_TIMEOUT_S = float(os.getenv("AI_RAILS_LLM_FIRST_TOKEN_TIMEOUT_S", "60"))
+
+BACKENDS = ("ollama", "claude")
+
+
+class RouteTarget:
+    """One backend/model an agent turn can be sent to."""
+
+    def __init__(self, backend: str, model: str = None, timeout_s: float = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown LLM backend '{backend}'. Known backends: {', '.join(BACKENDS)}.")
+        self.backend = backend
+        self.model = model
+        self.timeout_s = timeout_s
+
+    def __repr__(self):
+        return f"{self.backend}:{self.model or 'default'}"
+
+
+class Route:
+    """One compiled routing rule."""
+
+    def __init__(self, spec: dict, index: int):
+        self.name = spec.get("name") or f"route {index}"
+        self.agent_roles = spec.get("agent_roles") or ["*"]
+        self.min_prompt_chars = spec.get("min_prompt_chars", 0)
+        self.max_prompt_chars = spec.get("max_prompt_chars")
+        try:
+            self.targets = [RouteTarget(t["backend"], t.get("model"), t.get("timeout_s")) for t in spec.get("targets", [])]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Model route {self.name}: every target needs a 'backend' ({e}).")
+        if not self.targets:
+            raise ValueError(f"Model route {self.name}: 'targets' must not be empty.")
+
+    def matches(self, agent_role: str, prompt_chars: int) -> bool:
+        if prompt_chars < self.min_prompt_chars:
+            return False
+        if self.max_prompt_chars is not None and prompt_chars > self.max_prompt_chars:
+            return False
+        return any(fnmatch.fnmatchcase(agent_role, pattern) for pattern in self.agent_roles)
+
+
+def load_routes(routes_file: Path) -> list:
+    """Reads and compiles a routes file. Raises OSError/ValueError (including JSON errors)."""
+    with open(routes_file, "r") as f:
+        spec = json.load(f)
+    return [Route(route, index) for index, route in enumerate(spec.get("routes", []), start=1)]
+
+
+def _failed(response: str) -> bool:
+    # The LLM clients report failures as "Error: ..." strings rather than raising
+    return not response or response.startswith("Error:")
+
+
+class _HedgeCancelled(Exception):
+    """Raised inside the losing call of a hedged race to abandon its stream."""
+
+
+class _Race:
+    """Shared state of a hedged call: the first target to answer becomes the winner."""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.condition = threading.Condition()
+        self.winner = None
+        self.results = {}  # racer index -> response (None if abandoned)
+
+    def abandon(self) -> bool:
+        """Abandons every racer that has not answered yet; False if one already has."""
+        with self.condition:
+            if self.winner is not None or self.results:
+                return False
+            self.winner = -1
+            self.condition.notify_all()
+            return True
+
+    def claim(self, racer: int) -> bool:
+        with self.condition:
+            if self.winner is None:
+                self.winner = racer
+                self.condition.notify_all()
+            return self.winner == racer
+
+    def finish(self, racer: int, response):
+        with self.condition:
+            self.results[racer] = response
+            if self.winner is None and response is not None and not _failed(response):
+                self.winner = racer
+            self.condition.notify_all()
+
+
+class _RaceOutput:
+    """
+    Output file handed to one racer: the first racer to write a token claims the race and
+    streams into the real output file; any other racer is abandoned on its next write.
+    tell() is the number of characters this racer has written, so a client can tell
+    whether anything was streamed before a failure (and must not retry elsewhere).
+    """
+
+    def __init__(self, race: _Race, racer: int):
+        self.race = race
+        self.racer = racer
+        self._written = 0
+
+    def write(self, text: str):
+        if not text:
+            return
+        if not self.race.claim(self.racer):
+            raise _HedgeCancelled()
+        self.race.output_file.write(text)
+        self._written += len(text)
+
+    def tell(self) -> int:
+        return self._written
+
+    def flush(self):
+        if self.race.winner == self.racer:
+            self.race.output_file.flush()
+
+
+class ModelRouter:
+    """
+    Routes agent turns to LLM targets with failover and optional hedging.
+    clients maps each backend to its chat function, e.g. call_ollama_chat, called as
+    client(messages, system_prompt=..., model=..., stream=..., output_file=..., timeout=...).
+    """
+
+    def __init__(self, routes: list, clients: dict, log_event, default_models: dict,
+                 failover: bool = LLM_FAILOVER, hedge_after_s: float = LLM_HEDGE_AFTER_S,
+                 first_token_timeout_s: float = LLM_FIRST_TOKEN_TIMEOUT_S):
+        self.routes = routes
+        self.clients = clients
+        self._log_event = log_event
+        self.default_models = default_models
+        self.failover = failover
+        self.hedge_after_s = hedge_after_s
+        self.first_token_timeout_s = first_token_timeout_s
+
+    def route(self, agent_role: str, prompt_chars: int, llm_choice: str) -> tuple:
+        """Returns (route name, [RouteTarget, ...]) for one turn, with models filled in."""
+        # The session default never crosses to another backend; only routes list failover targets
+        name, targets = "session default", [RouteTarget(llm_choice)]
+        for route in self.routes:
+            if route.matches(agent_role, prompt_chars):
+                name, targets = route.name, route.targets
+                break
+        if not self.failover:
+            targets = targets[:1]
+        return name, [RouteTarget(t.backend, t.model or self.default_models[t.backend], t.timeout_s) for t in targets]
+
+    def chat(self, agent_role: str, llm_choice: str, messages: list, system_prompt: str, stream: bool = False,
+             output_file=None, session_id: str = "default", client_kwargs: dict = None) -> tuple:
+        """
+        Sends one agent turn through its route. Returns (response, target that produced it).
+        If every target fails, the last error response is returned.
+        client_kwargs holds extra keyword arguments per backend (e.g. the OllamaSession).
+        """
+        prompt_chars = len(system_prompt) + sum(len(m["content"]) for m in messages)
+        route_name, targets = self.route(agent_role, prompt_chars, llm_choice)
+        self._log_event("LLM_ROUTE", f"Routing {agent_role} turn via '{route_name}'.", agent_role=agent_role, session_id=session_id,
+                        details={"route": route_name, "prompt_chars": prompt_chars, "targets": [repr(t) for t in targets]})
+        client_kwargs = client_kwargs or {}
+
+        response, index = "", 0
+        while index < len(targets):
+            target = targets[index]
+            hedge_target = targets[index + 1] if self.hedge_after_s > 0 and target.backend == "ollama" and index + 1 < len(targets) else None
+            if output_file and index:
+                # Discard whatever a failed target streamed before it gave up
+                output_file.seek(0)
+                output_file.truncate()
+            if hedge_target:
+                response, winner, tried = self._hedged_call([target, hedge_target], messages, system_prompt, stream, output_file, agent_role, session_id, client_kwargs)
+            elif stream and output_file and self.first_token_timeout_s > 0 and index + 1 < len(targets):
+                response, winner, tried = self._first_token_call(target, messages, system_prompt, output_file, agent_role, session_id, client_kwargs), target, 1
+            else:
+                response, winner = self._call(target, messages, system_prompt, stream, output_file, client_kwargs), target
+                tried = 1
+            if not _failed(response):
+                return response, winner
+            index += tried
+            if index < len(targets):
+                metrics.METRICS.inc("llm_failover", labels={"from_backend": target.backend, "to_backend": targets[index].backend})
+                self._log_event("LLM_FAILOVER", f"{repr(winner)} failed; failing over to {repr(targets[index])}.", agent_role=agent_role, session_id=session_id,
+                                llm_model=winner.model, details={"route": route_name, "error": response[:500]})
+                print(f"LLM call to {repr(winner)} failed; retrying with {repr(targets[index])}.")
+        return response, targets[-1]
+
+    def _call(self, target: RouteTarget, messages: list, system_prompt: str, stream: bool, output_file, client_kwargs: dict) -> str:
+        kwargs = dict(client_kwargs.get(target.backend, {}))
+        if target.timeout_s:
+            kwargs["timeout"] = target.timeout_s
+        return self.clients[target.backend](messages, system_prompt=system_prompt, model=target.model, stream=stream, output_file=output_file, **kwargs)
+
+    def _start_racer(self, race: _Race, racer: int, target: RouteTarget, messages: list, system_prompt: str, stream: bool, client_kwargs: dict):
+        """Calls target in a daemon thread as one racer of race; its response is recorded with race.finish."""
+        def run():
+            race_output = _RaceOutput(race, racer) if stream and race.output_file else None
+            try:
+                response = self._call(target, messages, system_prompt, stream and race.output_file is not None, race_output, client_kwargs)
+            except _HedgeCancelled:
+                response = None
+            race.finish(racer, response)
+
+        # Run in a copy of the current context so the call is logged and timed for this session
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name=f"ai-rails-hedge-{target.backend}", daemon=True).start()
+
+    def _first_token_call(self, target: RouteTarget, messages: list, system_prompt: str, output_file,
+                          agent_role: str, session_id: str, client_kwargs: dict) -> str:
+        """
+        Streams one call, abandoning it (and returning an error) if it produces no token
+        within first_token_timeout_s. An abandoned call keeps its thread until its next write
+        or its request timeout; its result is discarded.
+        """
+        race = _Race(output_file)
+        self._start_racer(race, 0, target, messages, system_prompt, True, client_kwargs)
+        with race.condition:
+            race.condition.wait_for(lambda: race.winner is not None or 0 in race.results, timeout=self.first_token_timeout_s)
+        if race.abandon():
+            metrics.METRICS.inc("llm_first_token_timeout", labels={"backend": target.backend})
+            self._log_event("LLM_FIRST_TOKEN_TIMEOUT", f"{repr(target)} produced no token within {self.first_token_timeout_s}s; abandoning the call.",
+                            agent_role=agent_role, session_id=session_id, llm_model=target.model)
+            return f"Error: {repr(target)} produced no token within {self.first_token_timeout_s}s."
+        with race.condition:
+            race.condition.wait_for(lambda: 0 in race.results)
+            return race.results[0] or ""
+
+    def _hedged_call(self, targets: list, messages: list, system_prompt: str, stream: bool, output_file,
+                     agent_role: str, session_id: str, client_kwargs: dict) -> tuple:
+        """
+        Races targets[0] against targets[1], which is only started if targets[0] has not
+        answered within hedge_after_s. Returns (response, target, targets tried) for the
+        winner, or for the last failure if neither answered. "Targets tried" counts
+        targets[1] only if its call ran to completion, so a target abandoned because the
+        other one claimed the race and then failed still gets its own attempt. A losing
+        call keeps its thread until its stream is abandoned or its request times out; its
+        result is discarded.
+        """
+        race = _Race(output_file)
+
+        def start(racer: int):
+            self._start_racer(race, racer, targets[racer], messages, system_prompt, stream, client_kwargs)
+
+        start(0)
+        with race.condition:
+            race.condition.wait_for(lambda: race.winner is not None or 0 in race.results, timeout=self.hedge_after_s)
+            hedged = race.winner is None and 0 not in race.results
+        if hedged:
+            metrics.METRICS.inc("llm_hedge", labels={"backend": targets[1].backend})
+            self._log_event("LLM_HEDGE", f"{repr(targets[0])} gave no answer within {self.hedge_after_s}s; also sending the request to {repr(targets[1])}.",
+                            agent_role=agent_role, session_id=session_id, llm_model=targets[0].model)
+            print(f"{repr(targets[0])} is slow to answer; also trying {repr(targets[1])}.")
+            start(1)
+        started = 2 if hedged else 1
+
+        with race.condition:
+            race.condition.wait_for(lambda: (race.winner is not None and race.winner in race.results) or len(race.results) == started)
+            if race.winner is not None and race.winner in race.results:
+                winner = race.winner
+            else:
+                # Nobody answered: report the failure of the last target started
+                winner = started - 1
+            response = race.results[winner] or ""
+            tried = 2 if race.results.get(1) is not None else 1
+        if hedged:
+            self._log_event("LLM_HEDGE_RESULT", f"Hedged call answered by {repr(targets[winner])}.", agent_role=agent_role, session_id=session_id,
+                            llm_model=targets[winner].model, details={"winner": repr(targets[winner]), "failed": _failed(response)})
+        return response, targets[winner], tried
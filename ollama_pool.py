@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+
+import requests
+
+import http_transport
+
+# --- Configuration Section: Ollama Node Pool ---
+# OLLAMA_BASE_URL may list several Ollama hosts, comma-separated, e.g.
+#   OLLAMA_BASE_URL=http://gpu1:11434,http://gpu2:11434
+# Each call_ollama_chat request is sent to one node, picked by OLLAMA_BALANCE:
+#   - least_outstanding: the node with the fewest requests in flight
+#   - model_affinity:    the node that last served this session and model (its KV cache
+#                        still holds the conversation prefix), else the least loaded node
+#                        that has the model
+# Either way, only nodes whose last /api/tags listing includes the model are considered
+# (nodes that have not been checked yet are assumed to have it).
+#
+# With more than one node, a background thread GETs /api/tags on every node every
+# OLLAMA_HEALTH_INTERVAL seconds. A node is ejected after OLLAMA_EJECT_AFTER consecutive
+# failures (health checks or connection failures of real requests) and readmitted by
+# the first health check that succeeds. If every node is ejected, requests go to the
+# node that failed least recently rather than failing outright.
+
+OLLAMA_BALANCE = os.getenv("AI_RAILS_OLLAMA_BALANCE", "least_outstanding")
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("AI_RAILS_OLLAMA_HEALTH_INTERVAL", "15"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("AI_RAILS_OLLAMA_HEALTH_TIMEOUT", "2"))
+OLLAMA_EJECT_AFTER = int(os.getenv("AI_RAILS_OLLAMA_EJECT_AFTER", "2"))
+
+BALANCE_STRATEGIES = ["least_outstanding", "model_affinity"]
+
+
+class OllamaNode:
+    """One Ollama host and its health and load statistics (guarded by the pool's lock)."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.models = None            # Model names from the last /api/tags, None until checked
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.last_failure = 0.0
+        self.total_seconds = 0.0
+
+    def has_model(self, model: str) -> bool:
+        if self.models is None:
+            return True
+        # Ollama lists "name:tag"; a bare name means ":latest"
+        return model in self.models or (":" not in model and f"{model}:latest" in self.models)
+
+    def stats(self) -> dict:
+        completed = self.requests - self.outstanding
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "avg_ms": round(self.total_seconds * 1000 / completed, 1) if completed else 0.0,
+            "models": sorted(self.models) if self.models is not None else None,
+        }
+
+
+class OllamaPool:
+    """Balances Ollama requests across nodes, with health checks and ejection/readmission."""
+
+    def __init__(self, urls: list, balance: str = OLLAMA_BALANCE, health_interval: float = OLLAMA_HEALTH_INTERVAL,
+                 eject_after: int = OLLAMA_EJECT_AFTER, log_event=None):
+        if balance not in BALANCE_STRATEGIES:
+            raise ValueError(f"Unknown Ollama balance strategy '{balance}'. Known strategies: {', '.join(BALANCE_STRATEGIES)}.")
+        self.nodes = [OllamaNode(url) for url in urls]
+        if not self.nodes:
+            raise ValueError("The Ollama pool needs at least one node.")
+        self.balance = balance
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self._log_event = log_event
+        self._lock = threading.Lock()
+        self._affinity = {}  # (session_id, model) -> node url
+        self._health_thread = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, base_urls: str, log_event=None) -> "OllamaPool":
+        return cls([url.strip() for url in base_urls.split(",") if url.strip()], log_event=log_event)
+
+    # --- Node Selection ---
+    def acquire(self, model: str, session_id: str = "default", exclude: tuple = ()) -> OllamaNode:
+        """Picks a node for one request and counts it as outstanding until release()."""
+        self._start_health_checks()
+        with self._lock:
+            candidates = [n for n in self.nodes if n.url not in exclude] or list(self.nodes)
+            healthy = [n for n in candidates if n.healthy]
+            if healthy:
+                candidates = [n for n in healthy if n.has_model(model)] or healthy
+            else:
+                # Every node is ejected; try the one that failed least recently
+                candidates = [min(candidates, key=lambda n: n.last_failure)]
+
+            node = None
+            if self.balance == "model_affinity":
+                sticky = self._affinity.get((session_id, model))
+                node = next((n for n in candidates if n.url == sticky), None)
+            if node is None:
+                node = min(candidates, key=lambda n: (n.outstanding, n.requests))
+            if self.balance == "model_affinity":
+                self._affinity[(session_id, model)] = node.url
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def release(self, node: OllamaNode, seconds: float, ok: bool = True, connection_failed: bool = False):
+        """
+        Ends a request started with acquire(). connection_failed marks a node-level failure
+        (could not connect, or no response in time) that counts towards ejection.
+        """
+        with self._lock:
+            node.outstanding -= 1
+            node.total_seconds += seconds
+            if not ok:
+                node.failures += 1
+            if connection_failed:
+                self._record_failure(node, "request failed")
+            elif ok:
+                node.consecutive_failures = 0
+
+    def forget_session(self, session_id: str):
+        """Drops a finished session's model affinity."""
+        with self._lock:
+            for key in [key for key in self._affinity if key[0] == session_id]:
+                del self._affinity[key]
+
+    # --- Health Checks ---
+    def _record_failure(self, node: OllamaNode, reason: str):
+        """Counts a node failure and ejects the node once it reaches eject_after (lock held)."""
+        node.consecutive_failures += 1
+        node.last_failure = time.time()
+        if node.healthy and node.consecutive_failures >= self.eject_after and len(self.nodes) > 1:
+            node.healthy = False
+            node.ejections += 1
+            self._log("OLLAMA_NODE_EJECTED", f"Ollama node {node.url} ejected after {node.consecutive_failures} consecutive failures ({reason}).", node)
+
+    def check_health(self):
+        """GETs /api/tags on every node once, updating models, ejections and readmissions."""
+        for node in list(self.nodes):
+            try:
+                response = http_transport.get(f"{node.url}/api/tags", timeout=OLLAMA_HEALTH_TIMEOUT)
+                response.raise_for_status()
+                models = {m.get("name") for m in response.json().get("models", []) if m.get("name")}
+            except (requests.exceptions.RequestException, ValueError) as e:
+                with self._lock:
+                    self._record_failure(node, f"health check: {e}")
+                continue
+            with self._lock:
+                node.models = models
+                node.consecutive_failures = 0
+                if not node.healthy:
+                    node.healthy = True
+                    self._log("OLLAMA_NODE_READMITTED", f"Ollama node {node.url} passed its health check and was readmitted.", node)
+
+    def _start_health_checks(self):
+        if len(self.nodes) < 2 or self.health_interval <= 0 or self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is not None:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, name="ai-rails-ollama-health", daemon=True)
+            self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            self.check_health()
+            if self._stop.wait(self.health_interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def _log(self, event_type: str, message: str, node: OllamaNode):
+        print(message)
+        if self._log_event:
+            self._log_event(event_type, message, details={"node": node.url, **node.stats()})
+
+    def stats(self) -> dict:
+        """Per-node health and load statistics, keyed by node URL."""
+        with self._lock:
+            return {node.url: node.stats() for node in self.nodes}
@@ -0,0 +1,358 @@
+import os
+import re
+import sys
+import json
+import time
+import stat
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+
+# --- Configuration Section: Output Store ---
+# Content-addressed store for agent outputs. Every turn's output is still written to
+# <project>/<role>_output_[<node>_]<timestamp>_turn<N>.md (<node> for workflow DAG
+# nodes), a regular file you can edit (e.g. to refine a plan by hand), and is also stored
+# as an immutable blob, OUTPUT_STORE_DIR/<sha256[:2]>/<sha256>, so identical outputs are
+# stored once however many projects and turns produce them. Project files are never linked to blobs: editing
+# one cannot change a blob or any other project's output.
+#
+# Each project directory keeps an append-only manifest, <project>/.manifest.jsonl, with one
+# line per stored output:
+#   {"role": "Coder Agent", "session_id": "...", "turn": 2, "hash": "...", "size": 1234,
+#    "ts": 1700000000.0, "file": "coder_agent_output_20240101_120000_turn2.md"}
+# OutputStore reads a manifest once (then only the lines appended since) and indexes it
+# by role, so the latest output of a role, or the one of a given session and turn, is a
+# dictionary lookup instead of a directory listing. Turns restart at 1 each time a role is
+# engaged, so a turn is identified by its engagement too: the output file name without
+# "_turn<N>.md", which carries the engagement's start time.
+#
+# Usage:
+#   python output_store.py latest <project_dir> <role>
+#   python output_store.py history <project_dir> [--role <role>]
+#   python output_store.py ingest <project_dir>        # Adds existing *_output_*.md files
+#   python output_store.py trim <project_dir> --keep 5  # Keeps the files of the last 5 outputs per role
+#   python output_store.py prune <project_dir> --keep 5 # Also drops older outputs from the manifest
+#   python output_store.py gc [--dry-run]              # Deletes blobs no manifest references
+#
+# To keep project directories from growing to thousands of files, OUTPUT_KEEP_FILES
+# (default 10 per role, applied after every turn) and trim delete the project files of
+# older outputs while their manifest entries stay, so they can still be read with `history`/`latest`
+# from the store, where duplicates take one file. trim and prune only delete a file whose
+# content still matches its stored blob; edited files are kept.
+
+PROJECT_ROOT = Path(__file__).parent.resolve()
+OUTPUT_STORE_ENABLED = os.getenv("AI_RAILS_OUTPUT_STORE", "true").lower() == "true"
+OUTPUT_STORE_DIR = Path(os.getenv("AI_RAILS_OUTPUT_STORE_DIR", str(PROJECT_ROOT / "output" / ".objects")))
+OUTPUT_KEEP_FILES = int(os.getenv("AI_RAILS_OUTPUT_KEEP_FILES", "10"))  # Per role; 0 keeps every file
+
+MANIFEST_NAME = ".manifest.jsonl"
+
+# Blobs younger than this are never collected: a session may have written the blob and
+# not yet appended its manifest entry.
+GC_MIN_AGE_S = 3600
+
+_OUTPUT_FILE_PATTERN = re.compile(r"^(?P<role>.+)_output_(?:[A-Za-z0-9-]+_)?\d{8}_\d{6}_turn(?P<turn>\d+)\.md$")
+_TURN_SUFFIX = re.compile(r"_turn\d+\.md$")
+
+
+def role_key(role: str) -> str:
+    """Index key of an agent role: "Coder Agent" and "coder_agent" are the same role."""
+    return role.strip().lower().replace(" ", "_")
+
+
+def engagement_of(filename: str) -> str:
+    """The engagement an output file belongs to: its name without the _turn<N>.md suffix."""
+    return _TURN_SUFFIX.sub("", filename)
+
+
+def _hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class OutputStore:
+    """
+    One project's manifest and index, over the blob directory shared by all projects.
+    Safe to share between threads of one process (see get_store).
+    """
+
+    def __init__(self, project_dir: Path, store_dir: Path = None):
+        self.project_dir = Path(project_dir)
+        self.store_dir = Path(store_dir or OUTPUT_STORE_DIR)
+        self.manifest_path = self.project_dir / MANIFEST_NAME
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._by_role = {}      # role key -> [entry, ...] in manifest order
+        self._by_turn = {}      # (role key, session_id, engagement, turn) -> entry
+        self._engagements = {}  # (role key, session_id) -> latest engagement
+
+    def blob_path(self, content_hash: str) -> Path:
+        return self.store_dir / content_hash[:2] / content_hash
+
+    # --- Manifest Index ---
+    def _refresh(self):
+        """Indexes manifest lines appended since the last refresh, by this or another process (lock held)."""
+        try:
+            size = self.manifest_path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size < self._offset:
+            # The manifest was rewritten (prune); index it from the start
+            self._offset, self._by_role, self._by_turn, self._engagements = 0, {}, {}, {}
+        if size == self._offset:
+            return
+        with open(self.manifest_path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]  # A line still being written is read next time
+        self._offset += len(complete)
+        for line in complete.decode("utf-8").splitlines():
+            try:
+                self._index(json.loads(line))
+            except (json.JSONDecodeError, KeyError):
+                continue
+
+    def _index(self, entry: dict):
+        key = role_key(entry["role"])
+        self._by_role.setdefault(key, []).append(entry)
+        engagement = engagement_of(entry["file"])
+        self._by_turn[(key, entry.get("session_id"), engagement, entry.get("turn"))] = entry
+        self._engagements[(key, entry.get("session_id"))] = engagement
+
+    def latest(self, role: str):
+        """Returns the newest manifest entry of a role, or None."""
+        with self._lock:
+            self._refresh()
+            entries = self._by_role.get(role_key(role))
+            return entries[-1] if entries else None
+
+    def get(self, role: str, session_id: str, turn: int, engagement: str = None):
+        """
+        Returns the manifest entry of one turn of one session, or None. engagement (see
+        engagement_of) selects among several engagements of the role in the session; by
+        default the latest one is used.
+        """
+        with self._lock:
+            self._refresh()
+            key = role_key(role)
+            if engagement is None:
+                engagement = self._engagements.get((key, session_id))
+            return self._by_turn.get((key, session_id, engagement, turn))
+
+    def history(self, role: str = None) -> list:
+        """Returns the manifest entries of a role (every role if None), oldest first."""
+        with self._lock:
+            self._refresh()
+            if role is not None:
+                return list(self._by_role.get(role_key(role), []))
+            return sorted((e for entries in self._by_role.values() for e in entries), key=lambda e: e["ts"])
+
+    def read(self, entry: dict) -> str:
+        with open(self.blob_path(entry["hash"]), "r") as f:
+            return f.read()
+
+    # --- Adding Outputs ---
+    def add(self, role: str, session_id: str, turn: int, path: Path, content: str = None) -> dict:
+        """
+        Stores the output file at path (or content, if the file could not be written) and
+        appends its manifest entry. Returns the entry; entry["deduplicated"] is True if an
+        identical blob was already stored.
+        """
+        path = Path(path)
+        data = path.read_bytes() if path.exists() else (content or "").encode("utf-8")
+        content_hash = _hash_bytes(data)
+        blob = self.blob_path(content_hash)
+        deduplicated = blob.exists()
+        if not deduplicated:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp_blob = blob.with_name(f"{content_hash}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_blob, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_blob, blob)
+
+        entry = {"role": role, "session_id": session_id, "turn": turn, "hash": content_hash,
+                 "size": len(data), "ts": time.time(), "file": path.name}
+        with self._lock:
+            self.project_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.manifest_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._refresh()
+        return {**entry, "deduplicated": deduplicated}
+
+    def _unedited(self, entry: dict) -> bool:
+        """True if the entry's project file exists and still holds exactly the stored output."""
+        path = self.project_dir / entry["file"]
+        try:
+            return path.stat().st_size == entry["size"] and _hash_bytes(path.read_bytes()) == entry["hash"]
+        except OSError:
+            return False
+
+    def _delete_unedited(self, entries: list, keep_files: set) -> int:
+        """Deletes the project files of entries that are unedited and not in keep_files. Returns the count."""
+        deleted = 0
+        for entry in entries:
+            if entry["file"] in keep_files or not self._unedited(entry):
+                continue
+            try:
+                (self.project_dir / entry["file"]).unlink()
+                deleted += 1
+            except OSError:
+                pass
+        return deleted
+
+    def ingest(self) -> int:
+        """Adds the project's *_output_*_turn*.md files that are not in the manifest yet. Returns the count."""
+        known = {entry["file"] for entry in self.history()}
+        added = 0
+        for path in sorted(self.project_dir.glob("*_output_*_turn*.md"), key=lambda p: p.stat().st_mtime):
+            match = _OUTPUT_FILE_PATTERN.match(path.name)
+            if not match or path.name in known:
+                continue
+            role = match.group("role").replace("_", " ").title()
+            self.add(role, "unknown", int(match.group("turn")), path)
+            added += 1
+        return added
+
+    # --- Pruning ---
+    def trim_files(self, keep: int, role: str = None) -> int:
+        """
+        Deletes the project files of all but the newest `keep` outputs per role (of one role
+        if given), unless they were edited. Their manifest entries and blobs stay. Returns
+        the number of files deleted.
+        """
+        if keep <= 0:
+            return 0
+        deleted = 0
+        with self._lock:
+            self._refresh()
+            groups = [self._by_role.get(role_key(role), [])] if role is not None else list(self._by_role.values())
+            groups = [list(entries) for entries in groups]
+        for entries in groups:
+            deleted += self._delete_unedited(entries[:-keep], {e["file"] for e in entries[-keep:]})
+        return deleted
+
+    def prune(self, keep: int) -> list:
+        """
+        Keeps the newest `keep` entries per role. Older entries are dropped from the manifest
+        (rewritten atomically) and their project files deleted unless they were edited.
+        Returns the dropped entries; run gc to reclaim their blobs.
+        """
+        with self._lock:
+            self._refresh()
+            kept, dropped = [], []
+            for entries in self._by_role.values():
+                kept += entries[-keep:] if keep > 0 else []
+                dropped += entries[:-keep] if keep > 0 else entries
+            kept.sort(key=lambda e: e["ts"])
+            tmp_manifest = self.manifest_path.with_suffix(".tmp")
+            with open(tmp_manifest, "w") as f:
+                for entry in kept:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_manifest, self.manifest_path)
+            self._offset, self._by_role, self._by_turn, self._engagements = 0, {}, {}, {}
+            self._refresh()
+
+        self._delete_unedited(dropped, {e["file"] for e in kept})
+        return dropped
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(project_dir: Path) -> OutputStore:
+    """Returns the process-wide OutputStore of a project directory."""
+    project_dir = Path(project_dir).resolve()
+    with _stores_lock:
+        if project_dir not in _stores:
+            _stores[project_dir] = OutputStore(project_dir)
+        return _stores[project_dir]
+
+
+def collect_garbage(output_dir: Path, store_dir: Path = None, min_age_s: float = GC_MIN_AGE_S, dry_run: bool = False) -> dict:
+    """
+    Deletes blobs that no manifest under output_dir references (and that are older than
+    min_age_s). Returns {"referenced", "deleted", "freed_bytes"}.
+    """
+    store_dir = Path(store_dir or OUTPUT_STORE_DIR)
+    referenced = set()
+    for manifest in Path(output_dir).rglob(MANIFEST_NAME):
+        with open(manifest, "r") as f:
+            for line in f:
+                try:
+                    referenced.add(json.loads(line)["hash"])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+
+    deleted, freed = 0, 0
+    cutoff = time.time() - min_age_s
+    for blob in store_dir.glob("*/*"):
+        if blob.name in referenced or blob.name.endswith(".tmp"):
+            continue
+        blob_stat = blob.stat()
+        if blob_stat.st_mtime > cutoff:
+            continue
+        if not dry_run:
+            blob.unlink()
+        deleted += 1
+        freed += blob_stat.st_size
+    return {"referenced": len(referenced), "deleted": deleted, "freed_bytes": freed}
+
+
+def _print_entries(entries: list):
+    for entry in entries:
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['ts']))}  {entry['role']:<28} "
+              f"session {entry['session_id']} turn {entry['turn']}  {entry['size']:>8} B  {entry['hash'][:12]}  {entry['file']}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Query and maintain the AI Rails agent output store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    latest_parser = subparsers.add_parser("latest", help="Print the latest output of a role")
+    latest_parser.add_argument("project_dir", type=Path)
+    latest_parser.add_argument("role", help="Agent role, e.g. 'Coder Agent' or coder_agent")
+    history_parser = subparsers.add_parser("history", help="List a project's stored outputs")
+    history_parser.add_argument("project_dir", type=Path)
+    history_parser.add_argument("--role")
+    ingest_parser = subparsers.add_parser("ingest", help="Add a project's existing output files to the store")
+    ingest_parser.add_argument("project_dir", type=Path)
+    trim_parser = subparsers.add_parser("trim", help="Delete the files of older outputs, keeping them in the store")
+    trim_parser.add_argument("project_dir", type=Path)
+    trim_parser.add_argument("--keep", type=int, required=True)
+    prune_parser = subparsers.add_parser("prune", help="Keep only the newest outputs per role")
+    prune_parser.add_argument("project_dir", type=Path)
+    prune_parser.add_argument("--keep", type=int, required=True)
+    gc_parser = subparsers.add_parser("gc", help="Delete blobs no manifest references")
+    gc_parser.add_argument("--output-dir", type=Path, default=PROJECT_ROOT / "output")
+    gc_parser.add_argument("--min-age", type=float, default=GC_MIN_AGE_S, help="Only delete blobs older than this (seconds)")
+    gc_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "gc":
+        result = collect_garbage(args.output_dir, min_age_s=args.min_age, dry_run=args.dry_run)
+        verb = "Would delete" if args.dry_run else "Deleted"
+        print(f"{verb} {result['deleted']} unreferenced blob(s), {result['freed_bytes']} bytes; {result['referenced']} referenced.")
+        return 0
+
+    store = get_store(args.project_dir)
+    if args.command == "latest":
+        entry = store.latest(args.role)
+        if entry is None:
+            print(f"No stored output for {args.role} in {args.project_dir}.")
+            return 1
+        _print_entries([entry])
+        print(store.read(entry))
+    elif args.command == "history":
+        _print_entries(store.history(args.role))
+    elif args.command == "ingest":
+        print(f"Ingested {store.ingest()} output file(s) into the store.")
+    elif args.command == "trim":
+        print(f"Deleted {store.trim_files(args.keep)} output file(s); they can still be read with 'history' and 'latest'.")
+    elif args.command == "prune":
+        print(f"Dropped {len(store.prune(args.keep))} manifest entries. Run 'gc' to delete their blobs.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
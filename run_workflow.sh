@@ -31,9 +31,11 @@ echo "What are you looking to do today?"
 echo "1) Start a NEW Project (from scratch)"
 echo "2) Add/Update a FEATURE to an existing project"
 echo "3) Enter EXECUTION Phase (Code, Test, Document, n8n Flows)"
+echo "4) Run a WORKFLOW pipeline from a file (e.g. templates/workflows/plan_to_review.json)"
+echo "5) RESUME an interrupted session"
 echo "Q) Quit AI Rails"
 echo ""
-read -p "Enter your choice (1, 2, 3, or Q): " choice
+read -p "Enter your choice (1, 2, 3, 4, 5, or Q): " choice
 
 case "$choice" in
     1)
@@ -132,12 +134,40 @@ case "$choice" in
         # Pass the plan file path as the third argument
         python3 "$PYTHON_BACKEND" "$(basename "$PLAN_DIR")" "execution" "$FINAL_PLAN_FILE"
         ;;
+    4)
+        # Run a declarative agent pipeline (see workflow_dag.py)
+        echo ""
+        echo "--- Workflow Pipeline ---"
+        read -p "Workflow file [templates/workflows/plan_to_review.json]: " workflow_file
+        workflow_file=${workflow_file:-templates/workflows/plan_to_review.json}
+        read -p "Project name (outputs go to $OUTPUT_DIR/workflows/<project>): " project_name
+        if [ -z "$project_name" ]; then
+            echo "Project name cannot be empty. Exiting."
+            exit 1
+        fi
+        read -p "Idea or plan file for the workflow's 'idea' input: " idea_raw
+        IDEA_FILE=$(eval echo "$idea_raw")
+
+        python3 "$PROJECT_ROOT/workflow_dag.py" "$workflow_file" --project "$project_name" --input "idea=$IDEA_FILE"
+        ;;
+    5)
+        # Continue a session from its checkpoint (see session_checkpoint.py)
+        echo ""
+        echo "--- Resume Session ---"
+        python3 "$PYTHON_BACKEND" --list-checkpoints
+        read -p "Session ID to resume: " session_id
+        if [ -z "$session_id" ]; then
+            echo "Session ID cannot be empty. Exiting."
+            exit 1
+        fi
+        python3 "$PYTHON_BACKEND" --resume "$session_id"
+        ;;
     q|Q)
         echo "Exiting AI Rails. Goodbye!"
         exit 0
         ;;
     *)
-        echo "Invalid choice. Please enter 1, 2, 3, or Q."
+        echo "Invalid choice. Please enter 1, 2, 3, 4, 5, or Q."
         ;;
 esac
 
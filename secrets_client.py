@@ -0,0 +1,232 @@
+import os
+import time
+import atexit
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+import http_transport
+import metrics
+
+# --- Configuration Section: Secrets Client ---
+# All SecretsMCP lookups (call_mcp's "SecretsMCP" tool and the orchestrator's own, e.g.
+# the Claude API key) go through one SecretsClient per SecretsMCP URL. It
+#   - fetches several secrets in one round trip from POST /get_secrets
+#       {"secret_names": [...], "project_name": ...}
+#       -> {"status": "success", "secrets": {name: <the /get_secret response for name>}}
+#     and, against servers without that endpoint (404/405), falls back to concurrent
+#     POST /get_secret calls,
+#   - prefetches the secrets listed in SECRETS_PREFETCH in a background thread when an
+#     interactive session starts, while the human answers the LLM-choice prompt; a lookup
+#     of a secret that is being prefetched waits for that request instead of sending another,
+#   - keeps successful lookups for SECRETS_CACHE_TTL_S seconds, keyed by project and name.
+#
+# The cache lives in this process's memory only: values are never written to disk or
+# passed to log_event/print by this module, the cache is wiped when an interactive
+# session or a batch (batch_runner.py) ends and at interpreter exit, and failed lookups
+# are not cached.
+# Set AI_RAILS_SECRETS_CACHE_TTL_S=0 to disable the cache (prefetching then has no effect).
+
+SECRETS_MCP_URL = os.getenv("SECRETS_MCP_URL", "http://10.0.0.2:8004")
+SECRETS_CACHE_TTL_S = float(os.getenv("AI_RAILS_SECRETS_CACHE_TTL_S", "300"))
+SECRETS_PREFETCH = [n.strip() for n in os.getenv("AI_RAILS_SECRETS_PREFETCH", "ANTHROPIC_API_KEY").split(",") if n.strip()]
+
+REQUEST_TIMEOUT_S = 30
+MAX_PARALLEL_LOOKUPS = 8
+
+
+class SecretsClient:
+    """Batched, prefetching and caching SecretsMCP client for one server URL. Thread-safe."""
+
+    def __init__(self, base_url: str, ttl_seconds: float = SECRETS_CACHE_TTL_S):
+        self.base_url = base_url.rstrip("/")
+        self.ttl_seconds = ttl_seconds
+        self._cache = {}        # (project_name, secret_name) -> (response dict, expires_at)
+        self._pending = {}      # (project_name, secret_name) -> Future of the prefetch fetching it
+        self._batch_supported = True
+        self._lock = threading.Lock()
+
+    # --- Lookups ---
+    def get(self, secret_name: str, project_name: str = None) -> dict:
+        """Returns the /get_secret-style response for one secret ({"status", "value", ...})."""
+        return self.get_many([secret_name], project_name)[secret_name]
+
+    def get_many(self, secret_names: list, project_name: str = None) -> dict:
+        """
+        Returns {secret name: response} for several secrets, fetching the ones that are not
+        cached or being prefetched in a single request.
+        """
+        results, waits, missing = {}, [], []
+        with self._lock:
+            for name in dict.fromkeys(secret_names):
+                key = (project_name, name)
+                cached = self._cached(key)
+                if cached is not None:
+                    results[name] = cached
+                elif key in self._pending:
+                    waits.append((name, self._pending[key]))
+                else:
+                    missing.append(name)
+
+        for name, future in waits:
+            try:
+                future.result(timeout=REQUEST_TIMEOUT_S)
+            except Exception:  # Includes the wait timing out
+                pass  # Fetched again below
+            with self._lock:
+                cached = self._cached((project_name, name))
+            if cached is not None:
+                results[name] = cached
+            else:
+                missing.append(name)
+
+        if missing:
+            results.update(self._fetch(missing, project_name))
+        return {name: results[name] for name in secret_names}
+
+    def prefetch(self, secret_names: list, project_name: str = None) -> Future:
+        """
+        Starts fetching secrets in a background thread and returns its Future (None if they are
+        all cached or already being fetched). The Future resolves to {name: response}.
+        """
+        with self._lock:
+            names = [name for name in dict.fromkeys(secret_names)
+                     if self._cached((project_name, name)) is None and (project_name, name) not in self._pending]
+            if not names or self.ttl_seconds <= 0:
+                return None
+            future = Future()
+            for name in names:
+                self._pending[(project_name, name)] = future
+
+        def run():
+            try:
+                future.set_result(self._fetch(names, project_name))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    for name in names:
+                        if self._pending.get((project_name, name)) is future:
+                            del self._pending[(project_name, name)]
+
+        # A daemon thread, so an unanswered prefetch never holds up interpreter exit
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name="ai-rails-secrets-prefetch", daemon=True).start()
+        return future
+
+    def clear(self):
+        """Drops every cached secret."""
+        with self._lock:
+            self._cache.clear()
+
+    def _cached(self, key: tuple):
+        """A copy of a fresh cached response, or None (lock held)."""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._cache[key]
+            return None
+        return dict(entry[0])
+
+    # --- Requests ---
+    def _headers(self) -> dict:
+        return {"X-API-Key": os.getenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN", ""), "Content-Type": "application/json"}
+
+    def _fetch(self, secret_names: list, project_name: str = None) -> dict:
+        """Fetches secrets from the server (batched when it can) and caches the successful ones."""
+        if not os.getenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN"):
+            error = {"status": "error", "message": "SecretsMCP authentication token not configured in environment variables."}
+            return {name: dict(error) for name in secret_names}
+
+        results = None
+        if len(secret_names) > 1 and self._batch_supported:
+            with metrics.span("secrets_fetch", mode="batch"):
+                results = self._fetch_batch(secret_names, project_name)
+        if results is None:
+            with metrics.span("secrets_fetch", mode="single"):
+                if len(secret_names) == 1:
+                    results = {secret_names[0]: self._fetch_one(secret_names[0], project_name)}
+                else:
+                    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_LOOKUPS, len(secret_names)), thread_name_prefix="ai-rails-secrets") as pool:
+                        results = dict(zip(secret_names, pool.map(lambda name: self._fetch_one(name, project_name), secret_names)))
+
+        if self.ttl_seconds > 0:
+            expires_at = time.monotonic() + self.ttl_seconds
+            with self._lock:
+                for name, result in results.items():
+                    if isinstance(result, dict) and result.get("status") == "success":
+                        self._cache[(project_name, name)] = (dict(result), expires_at)
+        return results
+
+    def _fetch_batch(self, secret_names: list, project_name: str = None):
+        """One POST /get_secrets for several secrets; None if the server has no such endpoint."""
+        payload = {"secret_names": list(secret_names)}
+        if project_name:
+            payload["project_name"] = project_name
+        try:
+            response = http_transport.post(f"{self.base_url}/get_secrets", retry=True, json=payload, headers=self._headers(), timeout=REQUEST_TIMEOUT_S)
+            if response.status_code in (404, 405):
+                self._batch_supported = False
+                return None
+            response.raise_for_status()
+            body = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = {"status": "error", "message": f"SecretsMCP call failed: {e}", "details": str(e)}
+            return {name: dict(error) for name in secret_names}
+        secrets = body.get("secrets") if isinstance(body, dict) else None
+        if not isinstance(secrets, dict):
+            message = body.get("message") if isinstance(body, dict) and body.get("message") else "SecretsMCP batch response has no 'secrets' field."
+            return {name: {"status": "error", "message": message} for name in secret_names}
+        return {name: secrets.get(name) or {"secret_name": name, "status": "error", "message": f"Secret {name} missing from the batch response"}
+                for name in secret_names}
+
+    def _fetch_one(self, secret_name: str, project_name: str = None) -> dict:
+        """One POST /get_secret."""
+        payload = {"secret_name": secret_name}
+        if project_name:
+            payload["project_name"] = project_name
+        try:
+            response = http_transport.post(f"{self.base_url}/get_secret", retry=True, json=payload, headers=self._headers(), timeout=REQUEST_TIMEOUT_S)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return {"status": "error", "message": f"SecretsMCP call failed: {e}", "details": str(e)}
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url: str = None) -> SecretsClient:
+    """Returns the process-wide client for a SecretsMCP URL (default SECRETS_MCP_URL)."""
+    base_url = (base_url or SECRETS_MCP_URL).rstrip("/")
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = SecretsClient(base_url)
+        return _clients[base_url]
+
+
+def prefetch_session_secrets(secret_names: list = None, project_name: str = None) -> Future:
+    """
+    Starts prefetching SECRETS_PREFETCH (or secret_names), skipping secrets already set in
+    the environment. Returns the Future, or None if there is nothing to fetch or SecretsMCP
+    is not configured.
+    """
+    names = [name for name in (SECRETS_PREFETCH if secret_names is None else secret_names) if not os.getenv(name)]
+    if not names or not SECRETS_MCP_URL or not os.getenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN"):
+        return None
+    return get_client().prefetch(names, project_name or os.getenv("AI_RAILS_PROJECT_NAME"))
+
+
+def clear_all():
+    """Wipes the cache of every client (registered with atexit)."""
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        client.clear()
+
+
+atexit.register(clear_all)
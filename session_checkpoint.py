@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+
+# --- Configuration Section: Session Checkpoints ---
+# Interactive sessions (main_workflow_loop) write a checkpoint of every step to
+# CHECKPOINT_DIR/<session_id>.jsonl as they go, so that a session interrupted by a crash or
+# a closed terminal can be resumed with
+#   python ai_rails_backend.py --resume <session_id>
+# instead of repeating its LLM calls and tool executions.
+#
+# One JSON record per line, appended and fsync'ed before the session moves on; a record
+# cut short by a crash is ignored when the file is read back. Records belong to a stream,
+# which is replayed in order:
+#   - "main":       the answers typed at the workflow's prompts (LLM choice, menu choices)
+#   - <agent role>: that agent's turns, each an "llm_turn" (prompt hash and response)
+#                   followed, if it asked for tools, by a "tool_batch" (the requests, the
+#                   approval decision and the tool output fed back to the agent)
+#
+# On resume, each step is first looked up in its stream: if the next record there has the
+# same key (the prompt text, prompt hash or tool requests), it is replayed without asking
+# the human, calling the model or running the tools again. The first step that does not
+# match (e.g. an edited template changes a prompt hash) ends the replay of that stream; its
+# remaining records are dropped and the session carries on live, checkpointing as before.
+#
+# SecretsMCP values are never written: tool batches are checkpointed with each secret's
+# value replaced by REDACTED, and a replayed batch fetches those secrets again.
+#
+# A session that ends normally or is quit from the menu gets a "complete" record; it can
+# no longer be resumed and is not listed by --list-checkpoints. Completed checkpoints, and
+# interrupted ones older than CHECKPOINT_RETENTION_DAYS, are deleted by prune_checkpoints()
+# when a new session starts or the checkpoints are listed.
+#
+# Batch jobs and workflow DAGs are not checkpointed; they have their own reruns.
+
+CHECKPOINTS_ENABLED = os.getenv("AI_RAILS_CHECKPOINTS", "true").lower() == "true"
+CHECKPOINT_DIR = Path(os.getenv("AI_RAILS_CHECKPOINT_DIR", str(Path(__file__).parent.resolve() / "output" / ".checkpoints")))
+CHECKPOINT_RETENTION_DAYS = float(os.getenv("AI_RAILS_CHECKPOINT_RETENTION_DAYS", "7"))
+
+MAIN_STREAM = "main"
+REDACTED = "<redacted>"
+
+
+def content_hash(*parts) -> str:
+    """SHA-256 of JSON-serializable parts, used as the key of llm_turn and tool_batch records."""
+    serialized = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class SessionCheckpoint:
+    """
+    Append-only checkpoint of one session, and the replay cursor of a resumed one.
+    Safe to share between the threads of agents running in parallel (one stream each).
+    """
+
+    def __init__(self, session_id: str, path: Path, params: dict, streams: dict = None, completed: bool = False):
+        self.session_id = session_id
+        self.path = Path(path)
+        self.params = params
+        self.completed = completed
+        self.replayed = 0
+        self._streams = streams or {}                     # stream -> [records in seq order]
+        self._cursor = {stream: 0 for stream in self._streams}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, session_id: str, params: dict, checkpoint_dir: Path = None) -> "SessionCheckpoint":
+        """Starts the checkpoint of a new session; params are what --resume needs to restart it."""
+        path = Path(checkpoint_dir or CHECKPOINT_DIR) / f"{session_id}.jsonl"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        checkpoint = cls(session_id, path, params)
+        checkpoint._append({"kind": "session", "session_id": session_id, "params": params, "ts": time.time()})
+        return checkpoint
+
+    @classmethod
+    def load(cls, session_id: str, checkpoint_dir: Path = None) -> "SessionCheckpoint":
+        """Reads a session's checkpoint for resuming. Raises OSError/ValueError."""
+        path = Path(checkpoint_dir or CHECKPOINT_DIR) / f"{session_id}.jsonl"
+        params = None
+        completed = False
+        streams = {}
+        with open(path, "rb") as f:
+            content = f.read()
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) < len(content):
+            # The last record was cut short by a crash; drop it so new records start on a fresh line
+            with open(path, "r+b") as f:
+                f.truncate(len(complete))
+        for line in complete.decode("utf-8").splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("kind") == "session":
+                params = record.get("params")
+            elif record.get("kind") == "complete":
+                completed = True
+            elif record.get("kind") == "truncate":
+                # The stream diverged when it was last resumed: later records replace these
+                del streams.setdefault(record["stream"], [])[record["seq"]:]
+            elif "stream" in record:
+                records = streams.setdefault(record["stream"], [])
+                del records[record["seq"]:]
+                records.append(record)
+        if params is None:
+            raise ValueError(f"{path} has no session record.")
+        return cls(session_id, path, params, streams, completed)
+
+    def _append(self, record: dict):
+        """Appends one record and forces it to disk before returning."""
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self, stream: str, kind: str, key: str):
+        """
+        Returns the next recorded step of the stream if it matches kind and key, else None.
+        A mismatch drops the rest of the stream, which is then recorded afresh.
+        """
+        with self._lock:
+            records = self._streams.get(stream, [])
+            cursor = self._cursor.get(stream, 0)
+            if cursor >= len(records):
+                return None
+            record = records[cursor]
+            if record["kind"] == kind and record["key"] == key:
+                self._cursor[stream] = cursor + 1
+                self.replayed += 1
+                return record
+            del records[cursor:]
+            self._append({"kind": "truncate", "stream": stream, "seq": cursor, "ts": time.time()})
+            return None
+
+    def record(self, stream: str, kind: str, key: str, **data):
+        """Checkpoints one completed step of the stream."""
+        with self._lock:
+            records = self._streams.setdefault(stream, [])
+            seq = self._cursor.get(stream, 0)
+            record = {"stream": stream, "seq": seq, "kind": kind, "key": key, "ts": time.time(), **data}
+            self._append(record)
+            del records[seq:]
+            records.append(record)
+            self._cursor[stream] = seq + 1
+
+    def complete(self):
+        """Marks the session as finished: it is no longer offered for resuming."""
+        with self._lock:
+            self._append({"kind": "complete", "ts": time.time()})
+            self.completed = True
+
+
+def _is_complete(path: Path) -> bool:
+    """True if a checkpoint file ends with a complete record."""
+    with open(path, "rb") as f:
+        f.seek(max(0, f.seek(0, os.SEEK_END) - 4096))
+        lines = f.read().splitlines()
+    try:
+        return bool(lines) and json.loads(lines[-1]).get("kind") == "complete"
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return False
+
+
+def list_checkpoints(checkpoint_dir: Path = None) -> list:
+    """Returns (session_id, params) of every session that can be resumed, most recent first."""
+    checkpoint_dir = Path(checkpoint_dir or CHECKPOINT_DIR)
+    sessions = []
+    for path in sorted(checkpoint_dir.glob("*.jsonl"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            with open(path, "r") as f:
+                header = json.loads(f.readline())
+            if _is_complete(path):
+                continue
+        except (OSError, json.JSONDecodeError):
+            continue
+        if header.get("kind") == "session":
+            sessions.append((header.get("session_id", path.stem), header.get("params", {})))
+    return sessions
+
+
+def prune_checkpoints(checkpoint_dir: Path = None, retention_days: float = CHECKPOINT_RETENTION_DAYS) -> int:
+    """
+    Deletes completed checkpoints, and interrupted ones not written to for retention_days
+    (never, if retention_days <= 0). Returns the number of files deleted.
+    """
+    checkpoint_dir = Path(checkpoint_dir or CHECKPOINT_DIR)
+    cutoff = time.time() - retention_days * 86400
+    deleted = 0
+    for path in checkpoint_dir.glob("*.jsonl"):
+        try:
+            if _is_complete(path) or (retention_days > 0 and path.stat().st_mtime < cutoff):
+                path.unlink()
+                deleted += 1
+        except OSError:
+            continue
+    return deleted
+
+
+# --- Current Session ---
+# Set by main_workflow_loop for the duration of a session; agent threads started with
+# contextvars.copy_context() see it too. Code running outside a checkpointed session gets None.
+_current_checkpoint = contextvars.ContextVar("ai_rails_checkpoint", default=None)
+
+
+@contextmanager
+def checkpoint_context(checkpoint: SessionCheckpoint):
+    token = _current_checkpoint.set(checkpoint)
+    try:
+        yield checkpoint
+    finally:
+        _current_checkpoint.reset(token)
+
+
+def current() -> SessionCheckpoint:
+    return _current_checkpoint.get()
@@ -0,0 +1,35 @@
+import os
+import sys
+import importlib
+from pathlib import Path
+
+import pytest
+
+# Tests run against the in-process stub servers from benchmarks/stub_servers.py; no real
+# Ollama, Anthropic or MCP service is needed.
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "benchmarks")]
+
+os.environ.setdefault("AI_RAILS_LOG_ECHO", "false")
+os.environ.setdefault("AI_RAILS_HTTP_MAX_RETRIES", "0")
+
+from stub_servers import StubConfig, StubServer  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    server = StubServer(StubConfig()).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def backend(stub, tmp_path, monkeypatch):
+    """ai_rails_backend with its Anthropic URL pointed at the stub and its log in tmp_path."""
+    module = importlib.import_module("ai_rails_backend")
+    # The module may have been imported before this fixture ran (e.g. by workflow_dag)
+    monkeypatch.setattr(module, "_write_metrics_textfile", lambda: module.metrics.METRICS.write_textfile(tmp_path / "ai-rails.prom"))
+    monkeypatch.setattr(module, "ANTHROPIC_API_URL", f"{stub.url}/v1/messages")
+    monkeypatch.setattr(module, "CLAUDE_API_KEY", "test-key")
+    monkeypatch.setattr(module, "LOG_FILE", tmp_path / "ai-rails.log")
+    return module
@@ -0,0 +1,111 @@
+import pytest
+
+import call_mcp
+from approval_policy import ApprovalPolicy, PolicyApproval, load_policy
+from batch_runner import HeadlessApproval
+from stub_servers import secret_value
+
+POLICY = {
+    "default": "escalate",
+    "rules": [
+        {"name": "no n8n from reviewers", "tools": ["n8n_*"], "agent_roles": ["Code Review Agent"], "decision": "deny",
+         "reason": "Reviewers do not trigger automations."},
+        {"name": "n8n on main", "tools": ["n8n_automation"], "parameters": {"data.branch": "main"}, "decision": "approve"},
+        {"name": "read-only lookups", "tools": ["CodebaseSummaryMCP", "Context7"], "decision": "approve"},
+        {"name": "project defaults", "tools": ["SecretsMCP"], "parameters": {"secret_name": "DEFAULT_.*"}, "decision": "approve"},
+        {"name": "everything else", "decision": "deny"},
+    ],
+}
+
+
+class RecordingFallback:
+    """Stands in for the human: approves every escalated request and remembers what it was shown."""
+
+    decided_by = "human"
+
+    def __init__(self):
+        self.shown = []
+
+    def approve(self, agent_role, tool_requests, sensitive, session_id):
+        self.shown.append([request["tool_name"] for request in tool_requests])
+        return set(range(len(tool_requests)))
+
+    def feedback(self, agent_role, tool_requests, session_id):
+        return "Not now."
+
+
+@pytest.mark.parametrize("tool_name, agent_role, parameters, expected", [
+    # The first matching rule wins, even when a later one would decide otherwise
+    ("n8n_automation", "Code Review Agent", {"data": {"branch": "main"}}, ("deny", "no n8n from reviewers")),
+    ("n8n_automation", "Coder Agent", {"data": {"branch": "main"}}, ("approve", "n8n on main")),
+    # Parameter patterns match whole values, and missing parameters do not match
+    ("n8n_automation", "Coder Agent", {"data": {"branch": "main-hotfix"}}, ("deny", "everything else")),
+    ("n8n_automation", "Coder Agent", {}, ("deny", "everything else")),
+    ("Context7", "Coder Agent", {}, ("approve", "read-only lookups")),
+    ("SecretsMCP", "Coder Agent", {"secret_name": "DEFAULT_REGION"}, ("approve", "project defaults")),
+    ("SecretsMCP", "Coder Agent", {"secret_name": "MY_DEFAULT_REGION"}, ("deny", "everything else")),
+])
+def test_rules_are_checked_in_order(tool_name, agent_role, parameters, expected):
+    decision, rule_name, _ = ApprovalPolicy(POLICY).evaluate(tool_name, agent_role, parameters)
+    assert (decision, rule_name) == expected
+
+
+def test_default_applies_when_no_rule_matches():
+    policy = ApprovalPolicy({"rules": [{"tools": ["Context7"], "decision": "approve"}]})
+    assert policy.evaluate("GitHubMCP", "Coder Agent", {}) == ("escalate", "default", "")
+    assert policy.evaluate("Context7", "Coder Agent", {})[:2] == ("approve", "rule 1")
+
+
+def test_sensitive_secrets_always_escalate():
+    policy = ApprovalPolicy({"default": "approve", "rules": [{"tools": ["SecretsMCP"], "decision": "approve"}]})
+    decision, rule_name, _ = policy.evaluate("SecretsMCP", "Coder Agent", {"secret_name": "GITHUB_TOKEN"}, sensitive=True)
+    assert (decision, rule_name) == ("escalate", "sensitive secret")
+
+
+def test_invalid_policies_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match="decision must be one of"):
+        ApprovalPolicy({"rules": [{"name": "typo", "decision": "allow"}]})
+    with pytest.raises(ValueError, match="invalid parameter pattern"):
+        ApprovalPolicy({"rules": [{"parameters": {"secret_name": "("}, "decision": "deny"}]})
+    policy_file = tmp_path / "policy.json"
+    policy_file.write_text("{not json")
+    with pytest.raises(ValueError):
+        load_policy(policy_file)
+
+
+def test_only_escalated_requests_reach_the_fallback():
+    events = []
+    fallback = RecordingFallback()
+    approval = PolicyApproval(ApprovalPolicy(POLICY), fallback, lambda event_type, message, **kwargs: events.append((event_type, kwargs["details"])))
+    requests = [
+        {"tool_name": "Context7", "parameters": {}},
+        {"tool_name": "GitHubMCP", "parameters": {}},
+        {"tool_name": "SecretsMCP", "parameters": {"secret_name": "DEFAULT_GITHUB_TOKEN"}},
+    ]
+
+    approved = approval.approve("Coder Agent", requests, [False, False, True], "session-1")
+    assert approved == {0, 2}
+    # The sensitive secret escalated although the "project defaults" rule matches it
+    assert fallback.shown == [["SecretsMCP"]]
+    assert [(event_type, details.get("rule")) for event_type, details in events] == [
+        ("AUTO_DECISION", "read-only lookups"), ("AUTO_DECISION", "everything else"),
+        ("ESCALATED", "sensitive secret"), ("HUMAN_DECISION", None)]
+    assert approval.feedback("Coder Agent", requests, "session-1") == "GitHubMCP: denied by policy rule 'everything else'; Not now."
+
+
+def test_backend_escalates_sensitive_secrets_under_an_approve_all_policy(backend, stub, monkeypatch):
+    monkeypatch.setenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN", "test-token")
+    monkeypatch.setitem(call_mcp.MCP_BASE_URLS, "SecretsMCP", stub.url)
+    events = []
+    monkeypatch.setattr(backend, "log_event", lambda event_type, message, **kwargs: events.append((event_type, kwargs.get("details") or {})))
+    approval = PolicyApproval(ApprovalPolicy({"default": "approve"}), HeadlessApproval("deny"), backend.log_event)
+
+    output = backend._handle_tool_requests("Coder Agent", [{"tool_name": "SecretsMCP", "parameters": {"secret_name": "GITHUB_TOKEN"}},
+                                                           {"tool_name": "SecretsMCP", "parameters": {"secret_name": "DEFAULT_REGION"}}],
+                                           "session-1", approval=approval)
+
+    assert ("ESCALATED", {"tool_name": "SecretsMCP", "rule": "sensitive secret", "decision": "escalate", "policy": "<inline>"}) in events
+    # Only the non-sensitive secret was fetched
+    assert [body for path, body in stub.recent_requests if path.startswith("/get_secret")] == [{"secret_name": "DEFAULT_REGION"}]
+    assert output.startswith("### Tool Request 1: SecretsMCP\nDenied by approval policy; not executed.")
+    assert secret_value("DEFAULT_REGION") in output and secret_value("GITHUB_TOKEN") not in output
@@ -0,0 +1,82 @@
+import json
+import sys
+
+import pytest
+
+import batch_runner
+import output_store
+import secrets_client
+
+
+@pytest.fixture
+def batch_dir(backend, stub, tmp_path, monkeypatch):
+    """Batch runs, project output and the output store in tmp_path."""
+    monkeypatch.setattr(backend, "OUTPUT_DIR", tmp_path / "output")
+    monkeypatch.setattr(output_store, "OUTPUT_STORE_DIR", tmp_path / "objects")
+    monkeypatch.setattr(batch_runner, "BATCH_RUNS_DIR", tmp_path / "output" / "batch_runs")
+    return tmp_path / "output" / "batch_runs"
+
+
+def _jobs_file(tmp_path, data) -> object:
+    (tmp_path / "plans").mkdir(exist_ok=True)
+    for project in ("my-app", "billing-api"):
+        (tmp_path / "plans" / f"{project}.md").write_text(f"# {project} plan\n")
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(data))
+    return path
+
+
+def test_jobs_file_defaults_and_relative_paths(tmp_path):
+    jobs = batch_runner.load_jobs(_jobs_file(tmp_path, {
+        "defaults": {"workflow_type": "execution", "llm": "claude"},
+        "jobs": [{"project": "my-app", "plan_path": "plans/my-app.md", "agents": ["coder", "Unit Tester Agent"]}],
+    }))
+
+    assert len(jobs) == 1
+    job = jobs[0]
+    assert (job["name"], job["llm"], job["approval"]) == ("execution-my-app", "claude", "deny")
+    assert job["plan_path"] == tmp_path / "plans" / "my-app.md"
+    assert [agent_role for _, agent_role, _ in job["agents"]] == ["Coder Agent", "Unit Tester Agent"]
+
+
+@pytest.mark.parametrize("jobs, error", [
+    ([{"workflow_type": "execution"}], "'project' is required"),
+    ([{"project": "my-app", "approval": "always"}], "approval must be one of"),
+    ([{"project": "my-app", "workflow_type": "execution", "plan_path": "plans/missing.md", "agents": ["coder"]}], "existing plan_path"),
+    ([{"project": "my-app", "workflow_type": "execution", "plan_path": "plans/my-app.md", "agents": ["tester"]}], "Unknown execution agent"),
+    ([{"project": "my-app"}, {"project": "my-app", "name": "again"}], "another job already writes to"),
+])
+def test_invalid_jobs_are_rejected(tmp_path, jobs, error):
+    with pytest.raises(ValueError, match=error):
+        batch_runner.load_jobs(_jobs_file(tmp_path, jobs))
+
+
+def test_batch_jobs_run_headlessly_with_their_own_logs(batch_dir, stub, tmp_path, monkeypatch):
+    cleared = []
+    monkeypatch.setattr(secrets_client, "clear_all", lambda: cleared.append(True))
+    jobs = batch_runner.load_jobs(_jobs_file(tmp_path, {
+        "defaults": {"workflow_type": "execution", "llm": "claude"},
+        "jobs": [
+            {"project": "my-app", "plan_path": "plans/my-app.md", "agents": ["coder"]},
+            {"project": "billing-api", "plan_path": "plans/billing-api.md", "agents": ["unit_tester", "documentation"], "parallel": True},
+        ],
+    }))
+    stdout = sys.stdout
+
+    results = batch_runner.run_batch(jobs, workers=2)
+
+    assert [(result["name"], result["status"]) for result in results] == [("execution-my-app", "completed"), ("execution-billing-api", "completed")]
+    assert sys.stdout is stdout
+    assert cleared == [True]
+    (run_dir,) = batch_dir.iterdir()
+    assert json.loads((run_dir / "summary.json").read_text()) == results
+    for result in results:
+        job_dir = run_dir / result["name"]
+        events = [json.loads(line) for line in (job_dir / "session.log").read_text().splitlines()]
+        # Only the job's own session, even with the jobs running concurrently
+        assert {event["session_id"] for event in events} == {result["session_id"]}
+        assert events[0]["event_type"] == "WORKFLOW_START" and events[-1]["event_type"] == "WORKFLOW_END"
+        # Tool requests were decided without a human
+        assert "AUTO_DECISION" in {event["event_type"] for event in events}
+        assert (job_dir / "console.log").read_text()
+    assert len(list((tmp_path / "output" / "execution_plans" / "billing-api").glob("*_output_*.md"))) >= 2
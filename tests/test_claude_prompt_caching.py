@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+
+import metrics
+
+SYSTEM_PROMPT = "You are the Coder Agent. " * 200
+MESSAGES = [{"role": "user", "content": "--- ADDITIONAL CONTEXT ---\nWrite the module.\n--------------------------"}]
+
+
+@pytest.fixture
+def responses(backend, monkeypatch):
+    """Details of the LLM_RESPONSE events logged by the backend."""
+    logged = []
+    log_event = backend.log_event
+
+    def recording_log_event(event_type, message, **kwargs):
+        if event_type == "LLM_RESPONSE":
+            logged.append(kwargs.get("details", {}))
+        log_event(event_type, message, **kwargs)
+
+    monkeypatch.setattr(backend, "log_event", recording_log_event)
+    return logged
+
+
+def _last_body(stub) -> dict:
+    path, body = stub.recent_requests[-1]
+    assert path == "/v1/messages"
+    return body
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_system_prompt_is_sent_as_a_cached_block(backend, stub, stream):
+    backend.call_claude_chat(MESSAGES, system_prompt=SYSTEM_PROMPT, stream=stream)
+
+    body = _last_body(stub)
+    assert body["system"] == [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+    assert body["messages"] == MESSAGES
+    assert body["max_tokens"] == backend.CLAUDE_MAX_TOKENS
+    assert body.get("stream", False) is stream
+
+
+def test_prompt_caching_can_be_disabled(backend, stub, monkeypatch):
+    monkeypatch.setattr(backend, "CLAUDE_PROMPT_CACHING", False)
+    backend.call_claude_chat(MESSAGES, system_prompt=SYSTEM_PROMPT)
+
+    assert _last_body(stub)["system"] == SYSTEM_PROMPT
+
+
+def test_no_system_field_without_a_system_prompt(backend, stub):
+    backend.call_claude_chat(MESSAGES)
+
+    assert "system" not in _last_body(stub)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_usage_reports_cache_creation_then_cache_reads(backend, responses, stream):
+    session_id = f"test-{uuid.uuid4().hex}"
+    with metrics.session_context(session_id):
+        backend.call_claude_chat(MESSAGES, system_prompt=SYSTEM_PROMPT, stream=stream)
+        backend.call_claude_chat(MESSAGES, system_prompt=SYSTEM_PROMPT, stream=stream)
+
+    first, second = responses
+    assert first["cache_creation_input_tokens"] == len(SYSTEM_PROMPT) // 4
+    assert "cache_read_input_tokens" not in first
+    assert second["cache_read_input_tokens"] == len(SYSTEM_PROMPT) // 4
+    assert "cache_creation_input_tokens" not in second
+    for usage in (first, second):
+        # The cached system prompt is not billed as regular input
+        assert 0 < usage["input_tokens"] < len(SYSTEM_PROMPT) // 4
+        assert usage["output_tokens"] > 0
+
+    counters = metrics.METRICS.session_summary(session_id)["counters"]
+    labels = f'{{backend="claude",model="{backend.CLAUDE_MODEL}"}}'
+    assert counters[f"llm_prompt_tokens{labels}"] == first["input_tokens"] + second["input_tokens"]
+    assert counters[f"llm_eval_tokens{labels}"] == first["output_tokens"] + second["output_tokens"]
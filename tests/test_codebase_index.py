@@ -0,0 +1,83 @@
+import pytest
+
+from codebase_index import CodebaseIndex, answer
+
+ROUTER = '''class Router:
+    """Routes requests."""
+
+    def route(self, request):
+        return "TODO(auth)"
+
+
+def parse_args(argv):
+    return argv
+'''
+
+
+@pytest.fixture
+def repo(tmp_path):
+    root = tmp_path / "repo"
+    (root / "src").mkdir(parents=True)
+    (root / "src" / "router.py").write_text(ROUTER)
+    (root / "README.md").write_text("# Demo\n")
+    (root / "node_modules" / "left-pad").mkdir(parents=True)
+    (root / "node_modules" / "left-pad" / "index.js").write_text("module.exports = 1;\n")
+    return root
+
+
+def _refresh(index: CodebaseIndex) -> tuple:
+    stats = index.refresh(force=True)
+    return stats["added"], stats["updated"], stats["removed"]
+
+
+def test_refresh_reindexes_only_what_changed(repo, tmp_path):
+    index = CodebaseIndex(repo, tmp_path / "index.sqlite")
+    assert _refresh(index) == (2, 0, 0)
+    assert index.tree()[0] == ["README.md", "src/router.py"]
+    assert [s["qualname"] for s in index.find_symbols("route")] == ["Router.route"]
+    assert _refresh(index) == (0, 0, 0)
+
+    # Changed, added and deleted files
+    (repo / "src" / "router.py").write_text(ROUTER.replace("def route(", "def dispatch(").replace("TODO(auth)", "TODO(routing)"))
+    (repo / "src" / "cli.py").write_text("def main():\n    pass\n")
+    (repo / "README.md").unlink()
+    assert _refresh(index) == (1, 1, 1)
+
+    assert index.find_symbols("route") == []
+    assert [s["qualname"] for s in index.find_symbols("dispatch")] == ["Router.dispatch"]
+    assert index.search("TODO(auth)") == []
+    assert index.search("todo(routing)") == [("src/router.py", 5, '        return "TODO(routing)"')]
+    assert index.tree()[0] == ["src/cli.py", "src/router.py"]
+    assert index.stats()["symbols"] == 4
+    index.close()
+
+    # A new process starts from the saved index
+    reopened = CodebaseIndex(repo, tmp_path / "index.sqlite")
+    assert _refresh(reopened) == (0, 0, 0)
+    assert [s["path"] for s in reopened.find_symbols("main")] == ["src/cli.py"]
+    reopened.close()
+
+
+def test_refresh_is_throttled_by_the_interval(repo, tmp_path):
+    index = CodebaseIndex(repo, tmp_path / "index.sqlite", refresh_interval=60)
+    assert index.refresh()["added"] == 2
+    (repo / "src" / "cli.py").write_text("def main():\n    pass\n")
+    assert index.refresh()["added"] == 0
+    assert index.refresh(force=True)["added"] == 1
+    index.close()
+
+
+@pytest.mark.parametrize("query, answer_type, expected", [
+    ("Where is parse_args defined?", "symbols", "def parse_args(argv)"),
+    ("Show me the contents of src/router.py", "contents", "class Router:"),
+    ("Search for 'TODO(auth)'", "search", 'src/router.py:5: return "TODO(auth)"'),
+    ("What is the structure of the src directory?", "structure", "### Files under src (1)\nsrc/router.py"),
+])
+def test_questions_are_answered_from_the_index(repo, tmp_path, query, answer_type, expected):
+    index = CodebaseIndex(repo, tmp_path / "index.sqlite")
+    result = answer(index, {"query": query})
+    assert (result["status"], result["answer_type"]) == ("success", answer_type)
+    assert expected in result["result"]
+    # Questions it does not understand are left to the remote service
+    assert answer(index, {"query": "Summarize the architecture decisions"}) is None
+    index.close()
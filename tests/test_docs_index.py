@@ -0,0 +1,109 @@
+import pytest
+
+import call_mcp
+import docs_index
+from docs_index import DocsIndex
+
+APPROVAL = """# Approval policy
+
+## Sensitive secrets
+Requests for a sensitive secret always escalate to a human reviewer, whatever the policy rules say.
+
+## Rule order
+Policy rules are checked in order and the first matching rule wins.
+"""
+
+WORKFLOWS = """# Workflow DAGs
+
+## Skipping nodes
+A node whose input hash is unchanged reuses its saved output instead of engaging the agent.
+"""
+
+
+@pytest.fixture
+def docs(tmp_path):
+    """A docs root with enough unrelated sections for realistic BM25 weights."""
+    root = tmp_path / "docs"
+    root.mkdir()
+    (root / "approval.md").write_text(APPROVAL)
+    (root / "workflows.md").write_text(WORKFLOWS)
+    (root / "glossary.md").write_text("".join(f"## Term {i}\nGlossary entry {i} explains concept{i} and example{i}.\n\n" for i in range(40)))
+    return tmp_path
+
+
+def _index(docs, name: str = "docs.bm25") -> DocsIndex:
+    return DocsIndex(roots=["docs"], index_path=docs / "index" / name, base_dir=docs, refresh_interval=60)
+
+
+def _ranking(index: DocsIndex, query: str) -> list:
+    return [(result["source"], result["score"]) for result in index.search(query, num_results=10)]
+
+
+def test_rebuild_reuses_the_chunks_of_unchanged_files(docs):
+    index = _index(docs)
+    stats = index.refresh(force=True)
+    assert (stats["rebuilt"], stats["reindexed"], stats["reused"]) == (True, 3, 0)
+    assert index.refresh(force=True)["rebuilt"] is False
+
+    (docs / "docs" / "workflows.md").write_text(WORKFLOWS.replace("input hash", "fingerprint"))
+    stats = index.refresh(force=True)
+    assert (stats["rebuilt"], stats["reindexed"], stats["reused"]) == (True, 1, 2)
+
+    # Carried-over chunks rank exactly as in an index built from scratch
+    fresh = _index(docs, "fresh.bm25")
+    for query in ("sensitive secret escalate", "first matching rule", "fingerprint unchanged", "concept7 example7"):
+        assert _ranking(index, query) == _ranking(fresh, query)
+    assert index.search("input") == []
+    assert index.search("fingerprint")[0]["content"].startswith("## Skipping nodes")
+
+    (docs / "docs" / "workflows.md").unlink()
+    stats = index.refresh(force=True)
+    assert (stats["reindexed"], stats["reused"]) == (0, 2)
+    assert index.search("fingerprint") == []
+    index.close()
+    fresh.close()
+
+
+def test_index_file_is_reopened_by_a_new_process(docs):
+    index = _index(docs)
+    index.refresh(force=True)
+    chunks = index.stats()["chunks"]
+    index.close()
+
+    reopened = _index(docs)
+    assert reopened.stats()["chunks"] == chunks
+    assert reopened.refresh(force=True)["rebuilt"] is False
+    assert reopened.search("sensitive secret")[0]["source"] == "docs/approval.md#sensitive-secrets"
+    reopened.close()
+
+
+@pytest.mark.parametrize("query, answered", [
+    ("Do sensitive secrets escalate to a human reviewer?", True),
+    # One generic word, found somewhere: too little evidence that our docs answer it
+    ("reviewer", False),
+    # The rarest term is not in our docs at all
+    ("escalate kubernetes secrets", False),
+])
+def test_auto_backend_answers_only_well_matched_queries(docs, query, answered):
+    index = _index(docs)
+    result = docs_index.answer(index, {"query": query})
+    assert (result is not None) == answered
+    if answered:
+        assert result["results"][0]["source"] == "docs/approval.md#sensitive-secrets"
+        assert result["results"][0]["matched_terms"] >= docs_index.DOCS_MIN_MATCHED_TERMS
+        assert result["results"][0]["score"] >= docs_index.DOCS_MIN_SCORE
+    index.close()
+
+
+def test_local_backend_relaxes_the_thresholds(docs, monkeypatch):
+    index = _index(docs)
+    monkeypatch.setattr(docs_index, "get_index", lambda: index)
+
+    monkeypatch.setattr(docs_index, "CONTEXT7_BACKEND", "auto")
+    assert call_mcp._query_docs_index({"query": "reviewer"}) is None
+    monkeypatch.setattr(docs_index, "CONTEXT7_BACKEND", "local")
+    result = call_mcp._query_docs_index({"query": "reviewer"})
+    assert result["results"][0]["source"] == "docs/approval.md#sensitive-secrets"
+    # Coverage still applies
+    assert call_mcp._query_docs_index({"query": "kubernetes reviewer"}) is None
+    index.close()
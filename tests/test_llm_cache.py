@@ -0,0 +1,60 @@
+import time
+
+from llm_cache import LLMResponseCache, make_cache_key
+
+RESPONSE = "x" * 1000
+
+
+def _key(prompt: str) -> str:
+    return make_cache_key("ollama", "qwen2.5-coder:32b", "system", [{"role": "user", "content": prompt}])
+
+
+def _entry_bytes(tmp_path) -> int:
+    probe = LLMResponseCache(tmp_path / "probe")
+    probe.put(_key("probe"), RESPONSE)
+    return probe.stats()["bytes"]
+
+
+def test_least_recently_used_entry_is_evicted_first(tmp_path):
+    # Room for two and a half entries
+    cache = LLMResponseCache(tmp_path / "cache", max_bytes=_entry_bytes(tmp_path) * 5 // 2)
+    for prompt in ("first", "second"):
+        cache.put(_key(prompt), RESPONSE)
+        time.sleep(0.01)
+    # Reading "first" makes "second" the least recently used
+    assert cache.get(_key("first")) == RESPONSE
+    time.sleep(0.01)
+    cache.put(_key("third"), RESPONSE)
+
+    assert cache.get(_key("second")) is None
+    assert cache.get(_key("first")) == RESPONSE
+    assert cache.get(_key("third")) == RESPONSE
+    assert cache.stats() | {"bytes": None} == {"hits": 3, "misses": 1, "evictions": 1, "entries": 2, "bytes": None}
+
+
+def test_recency_survives_a_restart(tmp_path):
+    max_bytes = _entry_bytes(tmp_path) * 5 // 2
+    cache = LLMResponseCache(tmp_path / "cache", max_bytes=max_bytes)
+    for prompt in ("first", "second"):
+        cache.put(_key(prompt), RESPONSE)
+        time.sleep(0.01)
+    cache.get(_key("first"))
+    time.sleep(0.01)
+
+    # A new process learns sizes and recency from the files themselves
+    reopened = LLMResponseCache(tmp_path / "cache", max_bytes=max_bytes)
+    reopened.put(_key("third"), RESPONSE)
+    assert reopened.get(_key("second")) is None
+    assert reopened.get(_key("first")) == RESPONSE
+    assert reopened.stats()["entries"] == 2
+
+
+def test_rewriting_an_entry_does_not_count_its_size_twice(tmp_path):
+    entry_bytes = _entry_bytes(tmp_path)
+    cache = LLMResponseCache(tmp_path / "cache", max_bytes=entry_bytes * 5 // 2)
+    for _ in range(3):
+        cache.put(_key("first"), RESPONSE)
+    cache.put(_key("second"), RESPONSE)
+
+    assert cache.stats()["evictions"] == 0
+    assert cache.stats()["bytes"] == sum(path.stat().st_size for path in (tmp_path / "cache").glob("*/*.json"))
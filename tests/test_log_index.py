@@ -0,0 +1,64 @@
+import gzip
+import json
+import os
+
+import log_index
+from log_writer import BackgroundLogWriter
+
+
+def _line(n: int, session_id: str = "session-1") -> str:
+    return json.dumps({"timestamp": f"2024-01-01T12:00:{n:02d}", "session_id": session_id, "agent_role": "Coder Agent",
+                       "event_type": "AGENT_RESPONSE", "message": f"event {n:02d}", "details": {}})
+
+
+def _messages(conn, session_id: str = "session-1") -> list:
+    return [row[3] for row in log_index.query_session(conn, session_id)]
+
+
+def test_each_run_ingests_only_complete_lines_appended_since_the_last(tmp_path):
+    log_file = tmp_path / "ai-rails.log"
+    conn = log_index.connect(tmp_path / "index.sqlite")
+    log_file.write_text("".join(_line(n) + "\n" for n in range(3)))
+    assert log_index.index_log(conn, log_file) == 3
+
+    # A line still being written is left for the next run
+    with open(log_file, "a") as f:
+        f.write(_line(3) + "\n" + _line(4)[:20])
+    assert log_index.index_log(conn, log_file) == 1
+    with open(log_file, "a") as f:
+        f.write(_line(4)[20:] + "\n")
+    assert log_index.index_log(conn, log_file) == 1
+    assert log_index.index_log(conn, log_file) == 0
+
+    assert _messages(conn) == [f"event {n:02d}" for n in range(5)]
+
+
+def test_rotation_between_runs_finishes_the_rotated_backup_first(tmp_path):
+    log_file = tmp_path / "ai-rails.log"
+    # A backup rotated out before the index ever ran, which is not back-filled
+    old_backup = tmp_path / "ai-rails.log.20000101-000000-000000.gz"
+    with gzip.open(old_backup, "wt") as f:
+        f.write(_line(0, session_id="old-session") + "\n")
+    os.utime(old_backup, (0, 0))
+
+    line_bytes = len(_line(0)) + 1
+    writer = BackgroundLogWriter(log_file, max_bytes=5 * line_bytes, backup_count=10, flush_interval=0.05, batch_size=1)
+    conn = log_index.connect(tmp_path / "index.sqlite")
+    try:
+        for n in range(3):
+            writer.write(_line(n))
+        writer.flush()
+        assert log_index.index_log(conn, log_file) == 3
+
+        # Lines 3 and 4 fill the file, line 5 rotates it
+        for n in range(3, 7):
+            writer.write(_line(n))
+        writer.flush()
+    finally:
+        writer.close()
+    assert len(list(tmp_path.glob("ai-rails.log.*.gz"))) == 2
+    assert log_index.index_log(conn, log_file) == 4
+
+    assert _messages(conn) == [f"event {n:02d}" for n in range(7)]
+    assert _messages(conn, "old-session") == []
+    assert log_index.index_log(conn, log_file) == 0
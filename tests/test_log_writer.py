@@ -0,0 +1,86 @@
+import gzip
+import json
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+from log_writer import BackgroundLogWriter
+
+ROOT = Path(__file__).resolve().parent.parent
+PADDING = "x" * 200
+
+
+def _read_all_lines(log_file: Path) -> list:
+    """Every line of the gzip-compressed backups, oldest first, then of the live log."""
+    lines = []
+    for backup in sorted(log_file.parent.glob(f"{log_file.name}.*")):
+        with gzip.open(backup, "rt") as f:
+            lines.extend(f.read().splitlines())
+    return lines + (log_file.read_text().splitlines() if log_file.exists() else [])
+
+
+def _line(writer_id: int, n: int) -> str:
+    return json.dumps({"writer": writer_id, "n": n, "padding": PADDING})
+
+
+def test_concurrent_writers_rotate_without_losing_or_splitting_lines(tmp_path):
+    # Separate writers on one file stand in for processes; each also has several threads
+    log_file = tmp_path / "ai-rails.log"
+    writers = [BackgroundLogWriter(log_file, max_bytes=4096, backup_count=1000, flush_interval=0.05, batch_size=7)
+               for _ in range(3)]
+
+    def emit(writer, writer_id):
+        for n in range(200):
+            writer.write(_line(writer_id, n))
+
+    threads = [threading.Thread(target=emit, args=(writer, i * 10 + t)) for i, writer in enumerate(writers) for t in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for writer in writers:
+        writer.close()
+
+    entries = [json.loads(line) for line in _read_all_lines(log_file)]
+    assert sorted((e["writer"], e["n"]) for e in entries) == sorted((i * 10 + t, n) for i in range(3) for t in range(2) for n in range(200))
+    backups = list(tmp_path.glob("ai-rails.log.*"))
+    assert len(backups) > 5
+    assert all(backup.suffix == ".gz" for backup in backups)
+    # Each thread's lines stay in order across rotations
+    for writer_id in {e["writer"] for e in entries}:
+        assert [e["n"] for e in entries if e["writer"] == writer_id] == list(range(200))
+
+
+def test_writer_processes_sharing_a_log_rotate_it_safely(tmp_path):
+    log_file = tmp_path / "ai-rails.log"
+    script = (
+        "import json, sys\n"
+        "from log_writer import BackgroundLogWriter\n"
+        "writer = BackgroundLogWriter(sys.argv[1], max_bytes=8192, backup_count=1000, flush_interval=0.05)\n"
+        "for n in range(300):\n"
+        "    writer.write(json.dumps({'writer': int(sys.argv[2]), 'n': n, 'padding': 'x' * 200}))\n"
+        "writer.close()\n"
+    )
+    processes = [subprocess.Popen([sys.executable, "-c", script, str(log_file), str(i)], cwd=ROOT) for i in range(4)]
+    assert [process.wait(timeout=60) for process in processes] == [0] * 4
+
+    entries = [json.loads(line) for line in _read_all_lines(log_file)]
+    assert sorted((e["writer"], e["n"]) for e in entries) == sorted((i, n) for i in range(4) for n in range(300))
+    assert all([e["n"] for e in entries if e["writer"] == i] == list(range(300)) for i in range(4))
+    assert all(backup.suffix == ".gz" for backup in tmp_path.glob("ai-rails.log.*"))
+
+
+def test_only_the_newest_backups_are_kept(tmp_path):
+    log_file = tmp_path / "ai-rails.log"
+    writer = BackgroundLogWriter(log_file, max_bytes=1024, backup_count=2, compress=False, flush_interval=0.05, batch_size=1)
+    for n in range(100):
+        writer.write(_line(0, n))
+    writer.close()
+
+    backups = sorted(tmp_path.glob("ai-rails.log.*"))
+    assert len(backups) == 2
+    # The survivors are the most recent lines before the live log
+    newest = [json.loads(line)["n"] for backup in backups for line in backup.read_text().splitlines()]
+    live = [json.loads(line)["n"] for line in log_file.read_text().splitlines()]
+    assert newest + live == list(range(newest[0], 100))
@@ -0,0 +1,17 @@
+import uuid
+
+import metrics
+
+
+def test_session_aggregate_is_dropped_once_logged(backend):
+    session_id = f"test-{uuid.uuid4().hex}"
+    with metrics.session_context(session_id):
+        with metrics.span("mcp_call", tool="GitHubMCP"):
+            pass
+        metrics.METRICS.inc("llm_failover")
+    assert session_id in metrics.METRICS._sessions
+
+    backend._log_workflow_stats(session_id)
+    assert session_id not in metrics.METRICS._sessions
+    # The process-wide export still has the session's span
+    assert 'ai_rails_mcp_call_seconds_count{tool="GitHubMCP"}' in metrics.METRICS.render_prometheus()
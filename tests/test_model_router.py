@@ -0,0 +1,155 @@
+import io
+import threading
+import time
+
+import pytest
+
+from model_router import ModelRouter, Route, _Race, _RaceOutput
+from ollama_pool import OllamaPool
+from stub_servers import StubConfig, StubServer
+
+MESSAGES = [{"role": "user", "content": "Write the module."}]
+FALLBACK_ROUTE = {"name": "fallback", "targets": [{"backend": "ollama"}, {"backend": "claude"}]}
+
+
+class FakeClient:
+    """
+    A chat client that waits `stall_s` (or until released), streams `tokens` to the output
+    file and returns `response`. Every call is counted.
+    """
+
+    def __init__(self, response: str, tokens: tuple = (), stall_s: float = 0.0):
+        self.response = response
+        self.tokens = tokens
+        self.stall_s = stall_s
+        self.calls = 0
+        self.released = threading.Event()
+
+    def __call__(self, messages, system_prompt="", model=None, stream=False, output_file=None, **kwargs):
+        self.calls += 1
+        self.released.wait(self.stall_s)
+        for token in self.tokens:
+            if output_file is not None:
+                output_file.write(token)
+        return self.response
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+def _router(events: list, ollama: FakeClient, claude: FakeClient, routes: list = (FALLBACK_ROUTE,), **kwargs) -> ModelRouter:
+    return ModelRouter([Route(spec, i) for i, spec in enumerate(routes, start=1)], clients={"ollama": ollama, "claude": claude},
+                       log_event=lambda event_type, message, **kw: events.append(event_type),
+                       default_models={"ollama": "qwen", "claude": "opus"}, **kwargs)
+
+
+def test_session_default_stays_on_its_backend(events):
+    ollama, claude = FakeClient("Error: Ollama is down"), FakeClient("claude answer")
+    router = _router(events, ollama, claude, routes=[], hedge_after_s=0)
+
+    response, target = router.chat("Coder Agent", "ollama", MESSAGES, "system")
+    assert response == "Error: Ollama is down"
+    assert target.backend == "ollama"
+    assert claude.calls == 0
+
+
+def test_failed_target_fails_over_to_the_next(events):
+    ollama, claude = FakeClient("Error: Ollama is down"), FakeClient("claude answer", tokens=("claude ", "answer"))
+    router = _router(events, ollama, claude, hedge_after_s=0, first_token_timeout_s=0)
+    output = io.StringIO()
+
+    response, target = router.chat("Coder Agent", "ollama", MESSAGES, "system", stream=True, output_file=output)
+    assert (response, target.backend) == ("claude answer", "claude")
+    assert output.getvalue() == "claude answer"
+    assert "LLM_FAILOVER" in events
+
+
+def test_slow_target_is_hedged_and_the_loser_abandoned(events):
+    ollama = FakeClient("ollama answer", tokens=("ollama ", "answer"), stall_s=5)
+    claude = FakeClient("claude answer", tokens=("claude ", "answer"))
+    router = _router(events, ollama, claude, hedge_after_s=0.1)
+    output = io.StringIO()
+
+    response, target = router.chat("Coder Agent", "ollama", MESSAGES, "system", stream=True, output_file=output)
+    assert (response, target.backend) == ("claude answer", "claude")
+
+    # The stalled call finishes later; its tokens never reach the output file
+    ollama.released.set()
+    time.sleep(0.1)
+    assert output.getvalue() == "claude answer"
+    assert events.count("LLM_HEDGE") == 1 and "LLM_HEDGE_RESULT" in events
+
+
+def test_no_hedge_when_the_first_target_answers_in_time(events):
+    ollama, claude = FakeClient("ollama answer", tokens=("ollama answer",)), FakeClient("claude answer")
+    router = _router(events, ollama, claude, hedge_after_s=1)
+
+    response, target = router.chat("Coder Agent", "ollama", MESSAGES, "system", stream=True, output_file=io.StringIO())
+    assert (response, target.backend) == ("ollama answer", "ollama")
+    assert claude.calls == 0
+    assert "LLM_HEDGE" not in events
+
+
+def test_hedge_target_abandoned_by_a_failing_winner_gets_its_own_attempt(events):
+    # Ollama claims the race with a token, then fails; the hedged Claude call was abandoned
+    ollama = FakeClient("Error: stream dropped", tokens=("partial",), stall_s=0.2)
+    claude = FakeClient("claude answer", tokens=("claude answer",), stall_s=0.4)
+    router = _router(events, ollama, claude, hedge_after_s=0.05)
+    output = io.StringIO()
+
+    response, target = router.chat("Coder Agent", "ollama", MESSAGES, "system", stream=True, output_file=output)
+    assert (response, target.backend) == ("claude answer", "claude")
+    assert claude.calls == 2
+    assert output.getvalue() == "claude answer"
+
+
+def test_stalled_stream_fails_over_after_the_first_token_timeout(events):
+    claude = FakeClient("claude answer", tokens=("claude answer",), stall_s=5)
+    ollama = FakeClient("ollama answer", tokens=("ollama answer",))
+    route = {"name": "claude first", "targets": [{"backend": "claude"}, {"backend": "ollama"}]}
+    router = _router(events, ollama, claude, routes=[route], hedge_after_s=0, first_token_timeout_s=0.1)
+    output = io.StringIO()
+
+    started = time.perf_counter()
+    response, target = router.chat("Coder Agent", "claude", MESSAGES, "system", stream=True, output_file=output)
+    assert time.perf_counter() - started < 2
+    assert (response, target.backend) == ("ollama answer", "ollama")
+    assert "LLM_FIRST_TOKEN_TIMEOUT" in events and "LLM_FAILOVER" in events
+
+    claude.released.set()
+    time.sleep(0.1)
+    assert output.getvalue() == "ollama answer"
+
+
+def test_race_output_reports_what_its_racer_wrote():
+    race = _Race(io.StringIO())
+    winner, loser = _RaceOutput(race, 0), _RaceOutput(race, 1)
+    assert winner.tell() == 0
+    winner.write("abc")
+    winner.write("de")
+    assert winner.tell() == 5
+    assert loser.tell() == 0
+
+
+@pytest.fixture
+def stalling_nodes(backend, monkeypatch):
+    """Two Ollama stubs whose streams hang after two chunks, as the backend's pool."""
+    config = StubConfig(tool_turns=0, stall_after_chunks=2, stall_ms=1500)
+    servers = [StubServer(config).start(), StubServer(config).start()]
+    monkeypatch.setattr(backend, "OLLAMA_POOL", OllamaPool([server.url for server in servers], health_interval=0))
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_stream_stalling_mid_response_is_not_retried_on_another_node(backend, stalling_nodes):
+    # As under hedging or the first-token timeout, the output file is a racer's _RaceOutput
+    output = io.StringIO()
+    response = backend.call_ollama_chat(MESSAGES, system_prompt="system", model="qwen2.5-coder:32b", stream=True,
+                                        output_file=_RaceOutput(_Race(output), 0), timeout=0.3)
+
+    assert response.startswith("Error:")
+    assert sum(server.request_counts.get("/api/chat", 0) for server in stalling_nodes) == 1
+    assert output.getvalue() and output.getvalue().count("lorem") < 200
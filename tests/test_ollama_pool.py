@@ -0,0 +1,105 @@
+import pytest
+
+from ollama_pool import OllamaPool
+from stub_servers import StubConfig, StubServer
+
+MODEL = "qwen2.5-coder:32b"
+
+
+@pytest.fixture
+def nodes():
+    """Three stub Ollama nodes; the last one only has a small model."""
+    servers = [StubServer(StubConfig()).start(), StubServer(StubConfig()).start(),
+               StubServer(StubConfig(ollama_models=("llama3.2:3b",))).start()]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def pool(nodes, events):
+    # No background health thread: the tests call check_health() themselves
+    pool = OllamaPool([server.url for server in nodes], health_interval=0, eject_after=2,
+                      log_event=lambda event_type, message, **kwargs: events.append((event_type, kwargs["details"]["node"])))
+    yield pool
+    pool.stop()
+
+
+def _restart(server: StubServer) -> StubServer:
+    """Starts a fresh stub on the port a stopped one listened on."""
+    return StubServer(server.config, port=server.server_address[1]).start()
+
+
+def test_least_outstanding_spreads_requests(pool, nodes):
+    pool.check_health()
+    first = pool.acquire(MODEL)
+    second = pool.acquire(MODEL)
+    # The third node does not list the model, so it is not used while the others are healthy
+    assert {first.url, second.url} == {nodes[0].url, nodes[1].url}
+    assert pool.acquire(MODEL).url in {nodes[0].url, nodes[1].url}
+
+    # Whichever node finishes a request is the one with the fewest in flight
+    busiest = max((first, second), key=lambda node: node.outstanding)
+    quietest = second if busiest is first else first
+    pool.release(quietest, 0.1)
+    assert pool.acquire(MODEL) is quietest
+    assert pool.stats()[quietest.url]["avg_ms"] == 100.0
+
+
+def test_model_listing_selects_nodes(pool, nodes):
+    pool.check_health()
+    assert pool.acquire("llama3.2:3b").url == nodes[2].url
+    assert pool.stats()[nodes[2].url]["models"] == ["llama3.2:3b"]
+
+
+def test_node_is_ejected_after_consecutive_failures(pool, nodes, events):
+    nodes[0].stop()
+    pool.check_health()
+    assert pool.stats()[nodes[0].url]["healthy"]
+    pool.check_health()
+    assert not pool.stats()[nodes[0].url]["healthy"]
+    assert events == [("OLLAMA_NODE_EJECTED", nodes[0].url)]
+
+    assert all(pool.acquire(MODEL).url == nodes[1].url for _ in range(3))
+
+
+def test_connection_failures_of_requests_count_towards_ejection(pool, nodes, events):
+    for _ in range(2):
+        node = pool.acquire(MODEL, exclude=(nodes[1].url, nodes[2].url))
+        pool.release(node, 0.0, ok=False, connection_failed=True)
+
+    stats = pool.stats()[nodes[0].url]
+    assert not stats["healthy"]
+    assert stats["failures"] == 2
+    assert events == [("OLLAMA_NODE_EJECTED", nodes[0].url)]
+
+
+def test_ejected_node_is_readmitted_when_it_recovers(pool, nodes, events):
+    nodes[0].stop()
+    pool.check_health()
+    pool.check_health()
+    assert not pool.stats()[nodes[0].url]["healthy"]
+
+    nodes[0] = _restart(nodes[0])
+    pool.check_health()
+    assert pool.stats()[nodes[0].url]["healthy"]
+    assert events == [("OLLAMA_NODE_EJECTED", nodes[0].url), ("OLLAMA_NODE_READMITTED", nodes[0].url)]
+
+    busy = pool.acquire(MODEL)
+    assert pool.acquire(MODEL) is not busy
+
+
+def test_requests_go_to_the_least_recently_failed_node_when_all_are_ejected(pool, nodes):
+    for server in nodes:
+        server.stop()
+    pool.check_health()
+    pool.check_health()
+    assert not any(stats["healthy"] for stats in pool.stats().values())
+
+    # The nodes were checked in order, so the first one failed least recently
+    assert pool.acquire(MODEL).url == nodes[0].url
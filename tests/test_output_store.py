@@ -0,0 +1,26 @@
+from output_store import OutputStore, engagement_of
+
+
+def _add(store: OutputStore, project_dir, filename: str, content: str, turn: int):
+    path = project_dir / filename
+    path.write_text(content)
+    return store.add("Coder Agent", "session-1", turn, path)
+
+
+def test_turns_of_two_engagements_in_one_session_are_kept_apart(tmp_path):
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    store = OutputStore(project_dir, tmp_path / "objects")
+    first = _add(store, project_dir, "coder_agent_output_20240101_120000_turn1.md", "first engagement", 1)
+    second = _add(store, project_dir, "coder_agent_output_20240101_130000_turn1.md", "second engagement", 1)
+
+    assert engagement_of(first["file"]) == "coder_agent_output_20240101_120000"
+    assert store.get("coder_agent", "session-1", 1, engagement_of(first["file"]))["hash"] == first["hash"]
+    assert store.get("Coder Agent", "session-1", 1, engagement_of(second["file"]))["hash"] == second["hash"]
+    # Without an engagement, the latest one
+    assert store.read(store.get("Coder Agent", "session-1", 1)) == "second engagement"
+    assert store.get("Coder Agent", "session-1", 2) is None
+
+    # The same lookups from a fresh index of the manifest
+    reopened = OutputStore(project_dir, tmp_path / "objects")
+    assert reopened.read(reopened.get("Coder Agent", "session-1", 1, engagement_of(first["file"]))) == "first engagement"
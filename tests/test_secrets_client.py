@@ -0,0 +1,148 @@
+import json
+import time
+
+import pytest
+
+import call_mcp
+import secrets_client
+import session_checkpoint
+from secrets_client import SecretsClient
+from stub_servers import StubConfig, StubServer, secret_value
+
+NAMES = ["ANTHROPIC_API_KEY", "GITHUB_TOKEN", "OPENAI_API_KEY"]
+
+
+@pytest.fixture(autouse=True)
+def auth_token(monkeypatch):
+    monkeypatch.setenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN", "test-token")
+
+
+@pytest.fixture
+def secrets_stub():
+    """A stub SecretsMCP; tests change its config (read on every request) as needed."""
+    server = StubServer(StubConfig()).start()
+    yield server
+    server.stop()
+
+
+def _requests(server: StubServer, path: str) -> list:
+    return [body for request_path, body in server.recent_requests if request_path == path]
+
+
+def test_several_secrets_are_fetched_in_one_batch(secrets_stub):
+    client = SecretsClient(secrets_stub.url)
+    results = client.get_many(NAMES, "my-app")
+
+    assert {name: result["value"] for name, result in results.items()} == {name: secret_value(name) for name in NAMES}
+    assert _requests(secrets_stub, "/get_secrets") == [{"secret_names": NAMES, "project_name": "my-app"}]
+    assert "/get_secret" not in secrets_stub.request_counts
+
+    # Served from the cache, per project
+    assert client.get("GITHUB_TOKEN", "my-app")["value"] == secret_value("GITHUB_TOKEN")
+    assert secrets_stub.request_counts == {"/get_secrets": 1}
+    client.get("GITHUB_TOKEN", "other-app")
+    assert secrets_stub.request_counts == {"/get_secrets": 1, "/get_secret": 1}
+
+
+@pytest.mark.parametrize("status", [404, 405])
+def test_servers_without_the_batch_endpoint_get_parallel_single_lookups(secrets_stub, status):
+    secrets_stub.config.get_secrets_status = status
+    client = SecretsClient(secrets_stub.url)
+    results = client.get_many(NAMES)
+
+    assert all(results[name]["value"] == secret_value(name) for name in NAMES)
+    assert not client._batch_supported
+    assert secrets_stub.request_counts == {"/get_secrets": 1, "/get_secret": len(NAMES)}
+    assert sorted(body["secret_name"] for body in _requests(secrets_stub, "/get_secret")) == sorted(NAMES)
+
+    # The batch endpoint is not tried again
+    client.clear()
+    client.get_many(NAMES)
+    assert secrets_stub.request_counts == {"/get_secrets": 1, "/get_secret": 2 * len(NAMES)}
+
+
+def test_other_batch_errors_do_not_disable_batching(secrets_stub):
+    secrets_stub.config.get_secrets_status = 500
+    client = SecretsClient(secrets_stub.url)
+    results = client.get_many(NAMES)
+
+    assert all(result["status"] == "error" for result in results.values())
+    assert client._batch_supported
+    assert "/get_secret" not in secrets_stub.request_counts
+
+
+def test_lookup_waits_for_a_pending_prefetch(secrets_stub):
+    secrets_stub.config.latency_ms = 200
+    client = SecretsClient(secrets_stub.url)
+    future = client.prefetch(NAMES)
+    assert future is not None
+    # Already being fetched: no second prefetch
+    assert client.prefetch(NAMES[:1]) is None
+
+    assert client.get(NAMES[0])["value"] == secret_value(NAMES[0])
+    assert future.done()
+    assert secrets_stub.request_counts == {"/get_secrets": 1}
+
+
+def test_cached_secrets_expire_after_the_ttl(secrets_stub):
+    client = SecretsClient(secrets_stub.url, ttl_seconds=0.2)
+    client.get("GITHUB_TOKEN")
+    client.get("GITHUB_TOKEN")
+    assert secrets_stub.request_counts == {"/get_secret": 1}
+
+    time.sleep(0.3)
+    client.get("GITHUB_TOKEN")
+    assert secrets_stub.request_counts == {"/get_secret": 2}
+
+
+def test_failed_lookups_are_not_cached(secrets_stub):
+    secrets_stub.config.missing_secrets = {"GITHUB_TOKEN"}
+    client = SecretsClient(secrets_stub.url)
+    results = client.get_many(NAMES)
+    assert results["GITHUB_TOKEN"]["status"] == "error"
+    assert results["OPENAI_API_KEY"]["status"] == "success"
+
+    # Only the failed secret is requested again, and succeeds once the server has it
+    secrets_stub.config.missing_secrets = set()
+    assert client.get_many(NAMES)["GITHUB_TOKEN"]["value"] == secret_value("GITHUB_TOKEN")
+    assert _requests(secrets_stub, "/get_secret") == [{"secret_name": "GITHUB_TOKEN"}]
+
+
+def test_unreachable_server_errors_are_not_cached(secrets_stub):
+    client = SecretsClient(secrets_stub.url)
+    port = secrets_stub.server_address[1]
+    secrets_stub.stop()
+    assert client.get("GITHUB_TOKEN")["status"] == "error"
+
+    restarted = StubServer(secrets_stub.config, port=port).start()
+    try:
+        assert client.get("GITHUB_TOKEN")["value"] == secret_value("GITHUB_TOKEN")
+        assert restarted.request_counts == {"/get_secret": 1}
+    finally:
+        restarted.stop()
+
+
+class _ApproveAll:
+    decided_by = "policy"
+
+    def approve(self, agent_role, tool_requests, sensitive, session_id):
+        return set(range(len(tool_requests)))
+
+
+def test_secret_values_only_reach_the_agent(backend, secrets_stub, tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(call_mcp.MCP_BASE_URLS, "SecretsMCP", secrets_stub.url)
+    logged = []
+    monkeypatch.setattr(backend, "log_event", lambda event_type, message, **kwargs: logged.append((event_type, message, kwargs)))
+    checkpoint = session_checkpoint.SessionCheckpoint.create("test-secrets", {}, tmp_path / "checkpoints")
+
+    with session_checkpoint.checkpoint_context(checkpoint):
+        output = backend._handle_tool_requests("Coder Agent", [{"tool_name": "SecretsMCP", "parameters": {"secret_name": "GITHUB_TOKEN"}}],
+                                               "test-secrets", approval=_ApproveAll())
+    secrets_client.clear_all()
+
+    value = secret_value("GITHUB_TOKEN")
+    assert json.loads(output)["value"] == value
+    assert value not in capsys.readouterr().out
+    assert value not in json.dumps(logged)
+    assert value not in checkpoint.path.read_text()
+    assert session_checkpoint.REDACTED in checkpoint.path.read_text()
@@ -0,0 +1,107 @@
+import builtins
+
+import pytest
+
+import call_mcp
+import codebase_index
+import secrets_client
+import session_checkpoint
+from session_checkpoint import MAIN_STREAM, SessionCheckpoint, content_hash
+from stub_servers import secret_value
+
+LLM_PROMPT = "Use Ollama (default) or Claude? (ollama/claude): "
+MENU_PROMPT = "Choose an action: "
+
+
+@pytest.fixture
+def checkpoint_dir(backend, tmp_path, monkeypatch):
+    """Checkpoints and project output in tmp_path; the human is never asked anything."""
+    monkeypatch.setattr(session_checkpoint, "CHECKPOINT_DIR", tmp_path / "checkpoints")
+    monkeypatch.setattr(backend, "OUTPUT_DIR", tmp_path / "output")
+    monkeypatch.setattr(builtins, "input", lambda prompt="": pytest.fail(f"Unexpected prompt: {prompt}"))
+    return tmp_path / "checkpoints"
+
+
+def test_resumed_session_that_quits_is_completed(backend, checkpoint_dir, tmp_path):
+    plan = tmp_path / "plan.md"
+    plan.write_text("# Plan\n")
+    checkpoint = SessionCheckpoint.create("quit-session", {"project_name": "my-app", "workflow_type": "execution", "plan_path": str(plan)})
+    checkpoint.record(MAIN_STREAM, "input", LLM_PROMPT, answer="ollama")
+    checkpoint.record(MAIN_STREAM, "input", MENU_PROMPT, answer="q")
+    assert [session_id for session_id, _ in session_checkpoint.list_checkpoints()] == ["quit-session"]
+
+    with pytest.raises(SystemExit) as exit_info:
+        backend.resume_workflow("quit-session")
+    assert exit_info.value.code == 0
+
+    resumed = SessionCheckpoint.load("quit-session")
+    assert resumed.completed
+    assert session_checkpoint.list_checkpoints() == []
+    assert not backend.resume_workflow("quit-session")
+
+
+class _ApproveFirstTwo:
+    decided_by = "human"
+
+    def approve(self, agent_role, tool_requests, sensitive, session_id):
+        return {0, 1}
+
+
+def test_replayed_tool_batch_fetches_its_redacted_secrets_again(backend, stub, checkpoint_dir, monkeypatch):
+    monkeypatch.setenv("AI_RAILS_SECRETS_MCP_AUTH_TOKEN", "test-token")
+    monkeypatch.setattr(codebase_index, "CODEBASE_BACKEND", "remote")
+    for tool_name in ("CodebaseSummaryMCP", "SecretsMCP"):
+        monkeypatch.setitem(call_mcp.MCP_BASE_URLS, tool_name, stub.url)
+    requests = [{"tool_name": "CodebaseSummaryMCP", "parameters": {"query": "Where is the router?"}},
+                {"tool_name": "SecretsMCP", "parameters": {"secret_name": "GITHUB_TOKEN"}},
+                {"tool_name": "BraveSearchMCP", "parameters": {"query": "routers"}}]
+
+    checkpoint = SessionCheckpoint.create("secret-session", {})
+    with session_checkpoint.checkpoint_context(checkpoint):
+        output = backend._handle_tool_requests("Coder Agent", requests, "secret-session", approval=_ApproveFirstTwo())
+    secrets_client.clear_all()
+    assert secret_value("GITHUB_TOKEN") in output
+    assert secret_value("GITHUB_TOKEN") not in checkpoint.path.read_text()
+    counts = dict(stub.request_counts)
+
+    # As after a restart: the batch is replayed from the file, only the secret is fetched again
+    resumed = SessionCheckpoint.load("secret-session")
+    recorded = resumed.replay("Coder Agent", "tool_batch", content_hash(requests))
+    assert (recorded["approved"], recorded["decided_by"]) == ([0, 1], "human")
+    assert recorded["results"][1]["value"] == session_checkpoint.REDACTED
+    assert backend._replayed_tool_output(requests, recorded) == output
+    assert stub.request_counts == {**counts, "/get_secret": counts.get("/get_secret", 0) + 1}
+    secrets_client.clear_all()
+
+
+def test_diverging_step_ends_the_replay_of_its_stream(checkpoint_dir):
+    checkpoint = SessionCheckpoint.create("diverging-session", {})
+    for turn in range(3):
+        checkpoint.record("Coder Agent", "llm_turn", f"prompt-{turn}", response=f"response {turn}")
+    checkpoint.record(MAIN_STREAM, "input", MENU_PROMPT, answer="a")
+
+    resumed = SessionCheckpoint.load("diverging-session")
+    assert resumed.replay("Coder Agent", "llm_turn", "prompt-0")["response"] == "response 0"
+    # An edited prompt: this and the later turns are recorded afresh
+    assert resumed.replay("Coder Agent", "llm_turn", "edited-prompt-1") is None
+    resumed.record("Coder Agent", "llm_turn", "edited-prompt-1", response="new response 1")
+    # Other streams are unaffected
+    assert resumed.replay(MAIN_STREAM, "input", MENU_PROMPT)["answer"] == "a"
+
+    reloaded = SessionCheckpoint.load("diverging-session")
+    assert reloaded.replay("Coder Agent", "llm_turn", "prompt-0") is not None
+    assert reloaded.replay("Coder Agent", "llm_turn", "edited-prompt-1")["response"] == "new response 1"
+    assert reloaded.replay("Coder Agent", "llm_turn", "prompt-2") is None
+
+
+def test_record_cut_short_by_a_crash_is_ignored(checkpoint_dir):
+    checkpoint = SessionCheckpoint.create("crashed-session", {"project_name": "my-app"})
+    checkpoint.record(MAIN_STREAM, "input", LLM_PROMPT, answer="claude")
+    with open(checkpoint.path, "a") as f:
+        f.write('{"stream": "main", "seq": 1, "kind": "inp')
+
+    resumed = SessionCheckpoint.load("crashed-session")
+    assert resumed.replay(MAIN_STREAM, "input", LLM_PROMPT)["answer"] == "claude"
+    assert resumed.replay(MAIN_STREAM, "input", MENU_PROMPT) is None
+    resumed.record(MAIN_STREAM, "input", MENU_PROMPT, answer="q")
+    assert SessionCheckpoint.load("crashed-session").replay(MAIN_STREAM, "input", LLM_PROMPT) is not None
@@ -0,0 +1,72 @@
+import pytest
+
+import output_store
+import workflow_dag
+from batch_runner import HeadlessApproval
+
+
+@pytest.fixture
+def workflows_dir(backend, stub, tmp_path, monkeypatch):
+    """Workflow outputs and the output store in tmp_path; agents answer without tool requests."""
+    stub.config.tool_turns = 0
+    monkeypatch.setattr(workflow_dag, "WORKFLOWS_OUTPUT_DIR", tmp_path / "workflows")
+    monkeypatch.setattr(output_store, "OUTPUT_STORE_DIR", tmp_path / "objects")
+    return tmp_path / "workflows"
+
+
+def _workflow(tmp_path, nodes: dict, **spec) -> workflow_dag.Workflow:
+    return workflow_dag.Workflow({"name": "test", "nodes": nodes, **spec}, tmp_path / "test.json")
+
+
+def test_nodes_running_the_same_agent_write_separate_turn_files(workflows_dir, tmp_path):
+    workflow = _workflow(tmp_path, {"code-a": {"agent": "coder", "prompt": "Part A"},
+                                    "code-b": {"agent": "coder", "prompt": "Part B"}}, max_concurrency=2)
+    results = workflow_dag.run_workflow(workflow, "my-app", "claude", HeadlessApproval("deny"))
+
+    assert {name: result["status"] for name, result in results.items()} == {"code-a": "completed", "code-b": "completed"}
+    turn_files = sorted(path.name for path in (workflows_dir / "my-app").glob("coder_agent_output_*_turn1.md"))
+    assert [name.split("_")[3] for name in turn_files] == ["code-a", "code-b"]
+
+
+@pytest.mark.parametrize("nodes, cycle", [
+    ({"a": {"agent": "coder", "inputs": ["b"]}, "b": {"agent": "coder", "inputs": ["a"]}, "c": {"agent": "coder"}}, "a, b"),
+    ({"a": {"agent": "coder", "inputs": ["a"]}}, "a"),
+    ({"a": {"agent": "coder"}, "b": {"agent": "coder", "inputs": ["a", "d"]}, "c": {"agent": "coder", "inputs": ["b"]},
+      "d": {"agent": "coder", "inputs": ["c"]}}, "b, c, d"),
+])
+def test_cycles_are_rejected_naming_their_nodes(tmp_path, nodes, cycle):
+    with pytest.raises(ValueError, match=f"cycle between: {cycle}\\."):
+        _workflow(tmp_path, nodes)
+
+
+def test_nodes_are_ordered_after_their_inputs(tmp_path):
+    workflow = _workflow(tmp_path, {"review": {"agent": "code_review", "inputs": ["code", "plan"]},
+                                    "code": {"agent": "coder", "inputs": ["plan"]},
+                                    "plan": {"agent": "planning", "inputs": ["input:idea"]}})
+    assert workflow.order == ["plan", "code", "review"]
+    assert workflow.required_inputs() == {"idea"}
+
+
+def test_unchanged_nodes_are_skipped_on_the_next_run(workflows_dir, stub, tmp_path):
+    (tmp_path / "idea.md").write_text("A to-do app.")
+    (tmp_path / "notes.md").write_text("Use SQLite.")
+    workflow = _workflow(tmp_path, {"plan": {"agent": "planning", "inputs": ["file:idea.md"]},
+                                    "code": {"agent": "coder", "inputs": ["plan", "file:notes.md"]}})
+
+    def run(**kwargs) -> dict:
+        before = stub.request_counts.get("/v1/messages", 0)
+        results = workflow_dag.run_workflow(workflow, "my-app", "claude", HeadlessApproval("deny"), **kwargs)
+        return {name: result["status"] for name, result in results.items()}, stub.request_counts.get("/v1/messages", 0) - before
+
+    assert run() == ({"plan": "completed", "code": "completed"}, 2)
+    assert run() == ({"plan": "skipped", "code": "skipped"}, 0)
+    assert (workflows_dir / "my-app" / "code.md").read_text()
+
+    # Only the node reading the changed file reruns
+    (tmp_path / "notes.md").write_text("Use PostgreSQL.")
+    assert run() == ({"plan": "skipped", "code": "completed"}, 1)
+    assert run(force=True) == ({"plan": "completed", "code": "completed"}, 2)
+
+    # A deleted output is regenerated even though the inputs are unchanged
+    (workflows_dir / "my-app" / "plan.md").unlink()
+    assert run()[0]["plan"] == "completed"
@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from pathlib import Path
+
+import metrics
+import ai_rails_backend as backend
+from ai_rails_backend import log_event
+from batch_runner import APPROVAL_MODES, HeadlessApproval
+
+# --- Configuration Section: Workflow DAGs ---
+# Runs an agent pipeline defined in a JSON file instead of picking agents from the menu.
+# Each node is one agent engagement; its inputs are other nodes' final responses and/or
+# files, and nodes whose inputs are all available run concurrently:
+#
+#   {
+#     "name": "plan-to-review",
+#     "max_concurrency": 3,
+#     "limits": {"ollama": 2},
+#     "nodes": {
+#       "plan":   {"agent": "planning", "inputs": ["input:idea"]},
+#       "code":   {"agent": "coder", "inputs": ["plan"]},
+#       "tests":  {"agent": "unit_tester", "inputs": ["plan", "code"]},
+#       "review": {"agent": "code_review", "inputs": ["plan", "code"], "llm": "claude"}
+#     }
+#   }
+#
+# Node fields:
+#   - agent:  agent slug ("unit_tester") or role ("Unit Tester Agent"), or use
+#             "role" + "template" for a custom agent template in templates/agents/
+#   - inputs: node names (that node's final response), "file:<path>" (relative to the
+#             workflow file) or "input:<name>" (given on the command line: --input name=path)
+#   - prompt: optional instructions placed before the inputs
+#   - llm:    "ollama" or "claude" (default: the run's --llm)
+# "max_concurrency" caps the nodes running at once and "limits" caps them per LLM backend.
+#
+# Every node's final response is saved as <node>.md in output/workflows/<project>/, and
+# a hash of its agent prompt, LLM and input content in .workflow_state.json. On the next
+# run, a node whose hash is unchanged reuses its saved output instead of engaging the
+# agent again, so editing the coder's input only reruns the coder and what depends on it.
+#
+# Usage:
+#   python workflow_dag.py templates/workflows/plan_to_review.json --project my-app --input idea=idea.md
+
+WORKFLOW_MAX_CONCURRENCY = int(os.getenv("AI_RAILS_WORKFLOW_MAX_CONCURRENCY", "2"))
+WORKFLOWS_OUTPUT_DIR = backend.OUTPUT_DIR / "workflows"
+STATE_FILENAME = ".workflow_state.json"
+
+LLM_CHOICES = ["ollama", "claude"]
+
+
+def _agent_slug(agent_role: str) -> str:
+    return agent_role.lower().replace(" agent", "").replace(" ", "_")
+
+
+def _known_agents() -> dict:
+    """Maps agent slugs and lower-case roles to (role, template) for the planning and execution agents."""
+    agents = {}
+    for agent_role, template in [backend.PLANNING_AGENT, *backend.EXECUTION_AGENTS.values()]:
+        agents[_agent_slug(agent_role)] = (agent_role, template)
+        agents[agent_role.lower()] = (agent_role, template)
+    return agents
+
+
+class WorkflowNode:
+    """One agent engagement in a workflow."""
+
+    def __init__(self, name: str, spec: dict):
+        self.name = name
+        if spec.get("agent"):
+            agent = _known_agents().get(spec["agent"].strip().lower())
+            if agent is None:
+                raise ValueError(f"Node {name}: unknown agent '{spec['agent']}'. Known agents: {', '.join(sorted(k for k in _known_agents() if ' ' not in k))}.")
+            self.agent_role, self.template = agent
+        elif spec.get("role") and spec.get("template"):
+            self.agent_role, self.template = spec["role"], spec["template"]
+        else:
+            raise ValueError(f"Node {name}: needs an 'agent', or a 'role' and 'template'.")
+        self.inputs = list(spec.get("inputs", []))
+        self.prompt = spec.get("prompt", "")
+        self.llm = spec.get("llm")
+        if self.llm is not None and self.llm not in LLM_CHOICES:
+            raise ValueError(f"Node {name}: llm must be one of {', '.join(LLM_CHOICES)}.")
+
+    @property
+    def dependencies(self) -> list:
+        return [ref for ref in self.inputs if ":" not in ref]
+
+
+class Workflow:
+    """A validated, acyclic workflow loaded from a file."""
+
+    def __init__(self, spec: dict, source: Path):
+        self.source = Path(source)
+        self.name = spec.get("name") or self.source.stem
+        self.max_concurrency = int(spec.get("max_concurrency", WORKFLOW_MAX_CONCURRENCY))
+        self.limits = dict(spec.get("limits", {}))
+        if self.max_concurrency < 1 or any(key not in LLM_CHOICES or not isinstance(value, int) or value < 1 for key, value in self.limits.items()):
+            raise ValueError(f"max_concurrency must be at least 1, and limits must map {' / '.join(LLM_CHOICES)} to at least 1.")
+        if not spec.get("nodes"):
+            raise ValueError("A workflow needs at least one node.")
+        self.nodes = {name: WorkflowNode(name, node_spec) for name, node_spec in spec["nodes"].items()}
+        for node in self.nodes.values():
+            for ref in node.inputs:
+                kind = ref.split(":", 1)[0] if ":" in ref else None
+                if kind is None and ref not in self.nodes:
+                    raise ValueError(f"Node {node.name}: input '{ref}' is not a node of this workflow.")
+                if kind not in (None, "file", "input"):
+                    raise ValueError(f"Node {node.name}: input '{ref}' must be a node name, 'file:<path>' or 'input:<name>'.")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> list:
+        """Kahn's algorithm; raises ValueError naming the nodes of a cycle."""
+        remaining = {name: set(node.dependencies) for name, node in self.nodes.items()}
+        order = []
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items() if not deps)
+            if not ready:
+                raise ValueError(f"Workflow has a cycle between: {', '.join(sorted(remaining))}.")
+            for name in ready:
+                del remaining[name]
+                for deps in remaining.values():
+                    deps.discard(name)
+            order.extend(ready)
+        return order
+
+    def required_inputs(self) -> set:
+        return {ref.split(":", 1)[1] for node in self.nodes.values() for ref in node.inputs if ref.startswith("input:")}
+
+
+def load_workflow(workflow_file: Path) -> Workflow:
+    """Reads and validates a workflow file. Raises OSError/ValueError (including JSON errors)."""
+    with open(workflow_file, "r") as f:
+        return Workflow(json.load(f), workflow_file)
+
+
+# --- Running Workflows ---
+class WorkflowRun:
+    """Schedules a workflow's nodes for one project, skipping nodes whose inputs are unchanged."""
+
+    def __init__(self, workflow: Workflow, project: str, llm_choice: str, approval, session_id: str,
+                 inputs: dict = None, force: bool = False):
+        self.workflow = workflow
+        self.project = project
+        self.llm_choice = llm_choice
+        # Nodes running concurrently share one approval queue; their console output is prefixed
+        # with the node name and held back while another node's tool requests are presented
+        self.console = backend.ParallelConsole()
+        self.approval = backend.ApprovalQueue(approval, self.console)
+        self.session_id = session_id
+        self.inputs = inputs or {}
+        self.force = force
+        self.output_dir = WORKFLOWS_OUTPUT_DIR / project
+        self.state_path = self.output_dir / STATE_FILENAME
+        self.state = self._load_state()
+        self.results = {}
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f).get(self.workflow.name, {})
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        """Writes the node hashes (scheduler thread only; atomic replace)."""
+        try:
+            with open(self.state_path, "r") as f:
+                all_state = json.load(f)
+        except (OSError, ValueError):
+            all_state = {}
+        all_state[self.workflow.name] = self.state
+        tmp_path = self.state_path.with_name(f".{self.state_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(all_state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _input_content(self, node: WorkflowNode) -> str:
+        sections = [node.prompt] if node.prompt else []
+        for ref in node.inputs:
+            if ref.startswith("file:"):
+                path = Path(ref[len("file:"):]).expanduser()
+                path = path if path.is_absolute() else self.workflow.source.parent / path
+                sections.append(f"--- INPUT: {path.name} ---\n{path.read_text()}")
+            elif ref.startswith("input:"):
+                path = Path(self.inputs[ref[len("input:"):]])
+                sections.append(f"--- INPUT: {path.name} ---\n{path.read_text()}")
+            else:
+                producer = self.workflow.nodes[ref]
+                sections.append(f"--- OUTPUT OF {ref} ({producer.agent_role}) ---\n{self.results[ref]['output']}")
+        return "\n\n".join(sections)
+
+    def _input_hash(self, node: WorkflowNode, llm_choice: str, input_content: str) -> str:
+        # The compiled prompt covers the agent template and the MCP definitions it embeds
+        system_prompt = backend.compile_agent_prompt(backend.AGENT_TEMPLATES_DIR / node.template, backend.MCP_REGISTRY)
+        payload = json.dumps([node.agent_role, llm_choice, system_prompt, input_content])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _run_node(self, node: WorkflowNode) -> dict:
+        """Runs (or skips) one node in a worker thread and returns its result."""
+        started = time.perf_counter()
+        llm_choice = node.llm or self.llm_choice
+        result = {"node": node.name, "agent_role": node.agent_role, "llm": llm_choice, "output_path": str(self.output_dir / f"{node.name}.md")}
+        try:
+            input_content = self._input_content(node)
+            input_hash = self._input_hash(node, llm_choice, input_content)
+        except (OSError, KeyError) as e:
+            return {**result, "status": "failed", "error": f"could not assemble inputs: {e}", "duration_s": 0.0}
+        result["input_hash"] = input_hash
+
+        output_path = Path(result["output_path"])
+        if not self.force and self.state.get(node.name, {}).get("input_hash") == input_hash and output_path.exists():
+            log_event("WORKFLOW_NODE_SKIPPED", f"Workflow node {node.name} skipped: inputs unchanged, reusing {output_path.name}.", agent_role=node.agent_role, session_id=self.session_id, details={"node": node.name})
+            return {**result, "status": "skipped", "output": output_path.read_text(), "duration_s": 0.0}
+
+        log_event("WORKFLOW_NODE_START", f"Workflow node {node.name} started ({node.agent_role}).", agent_role=node.agent_role, session_id=self.session_id, details={"node": node.name, "inputs": node.inputs})
+        with self.console.agent(node.name):
+            response = backend.engage_agent(
+                agent_role=node.agent_role,
+                agent_template_filename=node.template,
+                user_input_content=input_content,
+                project_output_path=self.output_dir,
+                session_id=self.session_id,
+                llm_choice=llm_choice,
+                approval=self.approval,
+                output_label=node.name
+            )
+        duration_s = round(time.perf_counter() - started, 1)
+        if not response or response.startswith("Error:"):
+            return {**result, "status": "failed", "error": (response or "no response")[:500], "duration_s": duration_s}
+        output_path.write_text(response)
+        return {**result, "status": "completed", "output": response, "duration_s": duration_s}
+
+    def run(self) -> dict:
+        """Runs every node, as concurrently as dependencies and limits allow. Returns {node: result}."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        nodes = self.workflow.nodes
+        pending = list(self.workflow.order)
+        running = {}  # future -> node name
+        llm_running = {}
+
+        with self.console.active(), ThreadPoolExecutor(max_workers=max(1, self.workflow.max_concurrency), thread_name_prefix="ai-rails-workflow") as pool:
+            while pending or running:
+                for name in list(pending):
+                    deps = nodes[name].dependencies
+                    if any(self.results.get(dep, {}).get("status") in ("failed", "blocked") for dep in deps):
+                        pending.remove(name)
+                        self.results[name] = {"node": name, "agent_role": nodes[name].agent_role, "status": "blocked", "duration_s": 0.0}
+                        log_event("WORKFLOW_NODE_BLOCKED", f"Workflow node {name} not run: an input node failed.", session_id=self.session_id, details={"node": name})
+                        continue
+                    if not all(dep in self.results for dep in deps) or len(running) >= self.workflow.max_concurrency:
+                        continue
+                    llm_choice = nodes[name].llm or self.llm_choice
+                    if llm_running.get(llm_choice, 0) >= self.workflow.limits.get(llm_choice, self.workflow.max_concurrency):
+                        continue
+                    pending.remove(name)
+                    llm_running[llm_choice] = llm_running.get(llm_choice, 0) + 1
+                    # Each node runs in a copy of this context (metrics session, session log file)
+                    running[pool.submit(contextvars.copy_context().run, self._run_node, nodes[name])] = name
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    llm_choice = nodes[name].llm or self.llm_choice
+                    llm_running[llm_choice] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"node": name, "agent_role": nodes[name].agent_role, "status": "failed", "error": str(e), "duration_s": 0.0}
+                    self.results[name] = result
+                    if result["status"] == "completed":
+                        self.state[name] = {"input_hash": result["input_hash"], "completed_at": datetime.now().isoformat()}
+                        self._save_state()
+                    log_event("WORKFLOW_NODE_END", f"Workflow node {name} {result['status']}.", agent_role=result["agent_role"], session_id=self.session_id,
+                              details={k: v for k, v in result.items() if k != "output"})
+                    detail = {"completed": f" in {result['duration_s']}s", "skipped": " (inputs unchanged)"}.get(result["status"], "")
+                    print(f"[{name}] {result['status']}{detail}" + (f": {result['error']}" if result.get("error") else ""))
+        return self.results
+
+
+def run_workflow(workflow: Workflow, project: str, llm_choice: str = "ollama", approval=None, inputs: dict = None, force: bool = False) -> dict:
+    """Runs a workflow for a project in a new session and returns {node: result}."""
+    session_id = backend.new_session_id()
+    missing = workflow.required_inputs() - set(inputs or {})
+    if missing:
+        raise ValueError(f"Missing --input for: {', '.join(sorted(missing))}.")
+    with metrics.session_context(session_id):
+        log_event("WORKFLOW_START", f"Workflow {workflow.name} started for {project} ({len(workflow.nodes)} nodes).", session_id=session_id, details={"workflow": str(workflow.source)})
+        for choice in {node.llm or llm_choice for node in workflow.nodes.values()}:
+            if backend.resolve_llm_choice(choice, session_id) != choice:
+                raise ValueError(f"LLM backend '{choice}' is not available for this workflow.")
+        started = time.perf_counter()
+        run = WorkflowRun(workflow, project, llm_choice, approval or backend.default_approval(session_id), session_id, inputs, force)
+        results = run.run()
+        counts = {}
+        for result in results.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        backend._log_workflow_stats(session_id)
+        log_event("WORKFLOW_END", f"Workflow {workflow.name} finished in {time.perf_counter() - started:.1f}s: {summary}.", session_id=session_id, details={"output_dir": str(run.output_dir)})
+        print(f"\nWorkflow {workflow.name}: {summary}. Outputs in {run.output_dir}")
+    return results
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Run an AI Rails agent pipeline defined as a workflow DAG.")
+    parser.add_argument("workflow_file", type=Path, help="JSON workflow file")
+    parser.add_argument("--project", required=True, help="Project name (outputs go to output/workflows/<project>)")
+    parser.add_argument("--input", action="append", default=[], metavar="NAME=PATH", help="Value for an 'input:<name>' reference (repeatable)")
+    parser.add_argument("--llm", choices=LLM_CHOICES, default="ollama", help="Default LLM for nodes without their own")
+    parser.add_argument("--approval", choices=["interactive"] + APPROVAL_MODES[:2], default="interactive",
+                        help="Ask at the console (default, honours AI_RAILS_APPROVAL_POLICY) or decide headlessly")
+    parser.add_argument("--force", action="store_true", help="Rerun every node, even if its inputs are unchanged")
+    args = parser.parse_args(argv)
+
+    inputs = {}
+    for item in args.input:
+        name, sep, path = item.partition("=")
+        if not sep or not Path(path).expanduser().exists():
+            print(f"Error: --input {item} must be NAME=PATH of an existing file.")
+            return 1
+        inputs[name] = Path(path).expanduser().resolve()
+
+    try:
+        workflow = load_workflow(args.workflow_file)
+    except (OSError, ValueError) as e:
+        print(f"Error: invalid workflow file {args.workflow_file}: {e}")
+        return 1
+
+    approval = None if args.approval == "interactive" else HeadlessApproval(args.approval)
+    try:
+        results = run_workflow(workflow, args.project, args.llm, approval, inputs, args.force)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    return 0 if all(result["status"] in ("completed", "skipped") for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())